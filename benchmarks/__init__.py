@@ -0,0 +1,24 @@
+"""
+Micro benchmarks for the request hot path. They use the test_app settings
+and are run from the repository root, e.g.::
+
+    fab benchmark:cache_entries
+"""
+import os
+import timeit
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_app.settings')
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def measure(func, number):
+    """Returns the best time per call, in microseconds, out of 3 runs"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def report(label, microseconds):
+    print '%-50s %10.2f us' % (label, microseconds)
@@ -0,0 +1,26 @@
+"""
+Compares the ``resolve()`` probe route used to decide whether to append a
+slash with :func:`~urlographer.views.resolves_elsewhere`, on paths that
+resolve to another view, into an include, and to route.
+"""
+from benchmarks import measure, report, setup_django
+
+PATHS = ['/test_page/', '/admin/auth/user/', '/admin/fake_page/',
+         '/some-product/', '/category/electronics/tvs/']
+
+
+def main():
+    setup_django()
+    from django.core.urlresolvers import resolve
+    from urlographer.views import resolves_elsewhere, route
+
+    for path in PATHS:
+        assert resolves_elsewhere(path) == (resolve(path).func != route)
+        report('%-25s resolve' % path,
+               measure(lambda: resolve(path).func != route, 10000))
+        report('%-25s resolves_elsewhere' % path,
+               measure(lambda: resolves_elsewhere(path), 10000))
+
+
+if __name__ == '__main__':
+    main()
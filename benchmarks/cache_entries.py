@@ -0,0 +1,42 @@
+"""
+Compares the size and decode time of the compact
+:class:`~urlographer.records.URLRecord` cache entries with the pickled
+URLMap instances cached by previous releases.
+"""
+import cPickle as pickle
+
+from benchmarks import measure, report, setup_django
+
+
+def main():
+    setup_django()
+    from django.contrib.sites.models import Site
+    from urlographer.models import ContentMap, URLMap
+    from urlographer.records import URLRecord
+
+    site = Site(id=1, domain='www.example.com', name='example')
+    content_map = ContentMap(
+        id=1, view='urlographer.sample_views.sample_view',
+        options={'test_val': 'testing 1 2 3', 'article_id': 1234})
+    target = URLMap(id=1, site=site, path='/reviews/some-product/',
+                    status_code=200, content_map=content_map)
+    source = URLMap(id=2, site=site, path='/old/some-product.htm',
+                    status_code=301, redirect=target)
+    target.set_hexdigest()
+    source.set_hexdigest()
+
+    for label, urlmap in [('200', target), ('301', source)]:
+        pickled = pickle.dumps(urlmap, pickle.HIGHEST_PROTOCOL)
+        compact = pickle.dumps(
+            URLRecord.from_urlmap(urlmap).encode(), pickle.HIGHEST_PROTOCOL)
+        print '%s entry size: pickled URLMap %d bytes, URLRecord %d bytes' % (
+            label, len(pickled), len(compact))
+        report('%s pickled URLMap decode' % label,
+               measure(lambda: pickle.loads(pickled), 10000))
+        report('%s URLRecord decode' % label,
+               measure(lambda: URLRecord.decode(pickle.loads(compact)),
+                       10000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares :func:`~urlographer.utils.canonicalize_path` with the quadratic
+implementation of previous releases, on realistic paths and on the 2000
+character paths full of ``//`` and ``/../`` an attacker can send.
+"""
+from benchmarks import measure, report, setup_django
+
+REALISTIC = [
+    '/',
+    '/reviews/some-product/',
+    '/Reviews/Some-Product.html',
+    '/category/electronics/tvs/page/2/',
+    '//old//path/./to/../some-product.htm',
+    u'/caf\xe9/menu/',
+]
+ADVERSARIAL = [
+    '/' + '/' * 1999,
+    '/a' * 1000,
+    '/a/..' * 400,
+    '/' + 'a/' * 500 + '../' * 333,
+    '/./' * 666,
+    '//..' * 500,
+]
+
+
+def previous_canonicalize_path(path):
+    from urlographer.utils import force_ascii
+    while '//' in path:
+        path = path.replace('//', '/')
+    if path.startswith('./'):
+        path = path[1:]
+    elif path.startswith('../'):
+        path = path[2:]
+    while '/./' in path:
+        path = path.replace('/./', '/')
+    while '/../' in path:
+        pre, post = path.split('/../', 1)
+        if pre.startswith('/') and '/' in pre[1:]:
+            pre = '/'.join(pre.split('/')[:-1])
+            path = '/'.join([pre, post])
+        else:
+            path = '/' + post
+    return force_ascii(path.lower())
+
+
+def main():
+    setup_django()
+    from urlographer.utils import canonicalize_path
+
+    for label, corpus, number in [('realistic', REALISTIC, 10000),
+                                  ('adversarial', ADVERSARIAL, 100)]:
+        for function in (previous_canonicalize_path, canonicalize_path):
+            assert [function(path) for path in corpus] == [
+                previous_canonicalize_path(path) for path in corpus]
+            report('%s, %s (%d paths)' % (
+                function.__name__, label, len(corpus)),
+                measure(lambda: [function(path) for path in corpus], number))
+    for path in ADVERSARIAL:
+        report('%-20r previous' % path[:20],
+               measure(lambda: previous_canonicalize_path(path), 100))
+        report('%-20r current' % path[:20],
+               measure(lambda: canonicalize_path(path), 100))
+
+
+if __name__ == '__main__':
+    main()
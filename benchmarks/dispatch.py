@@ -0,0 +1,47 @@
+"""
+Compares calling the view of a ContentMap as route used to, importing it,
+copying its options and calling ``as_view()`` on every request, with
+calling its :class:`~urlographer.dispatch.CompiledView` memoized by
+:data:`~urlographer.dispatch.compiled_views`.
+"""
+from benchmarks import measure, report, setup_django
+
+CONTENTS = [
+    ('urlographer.sample_views.sample_view', {'test_val': 'a'}),
+    ('urlographer.sample_views.SampleClassView',
+     {'initkwargs': {'test_val': 'b'}}),
+]
+
+
+def previous_dispatch(request, record):
+    from urlographer.utils import get_view
+    view = get_view(record.view)
+    options = dict(record.options)
+    if hasattr(view, 'as_view'):
+        initkwargs = options.pop('initkwargs', {})
+        return view.as_view(**initkwargs)(request, **options)
+    return view(request, **options)
+
+
+def main():
+    setup_django()
+    from django.test.client import RequestFactory
+    from urlographer.dispatch import compiled_views
+    from urlographer.records import URLRecord
+
+    request = RequestFactory().get('/')
+    for i, (view, options) in enumerate(CONTENTS):
+        record = URLRecord(i, 200, False, 'http://example.com/',
+                           content_map_id=i, view=view, options=options,
+                           content_modified=0.0)
+        assert (previous_dispatch(request, record).content ==
+                compiled_views.get(record)(request).content)
+        name = view.rsplit('.', 1)[1]
+        report('%-20s previous' % name,
+               measure(lambda: previous_dispatch(request, record), 10000))
+        report('%-20s compiled' % name,
+               measure(lambda: compiled_views.get(record)(request), 10000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares lookups through :meth:`~urlographer.models.URLMapManager.cached_get`
+answered by an in-memory :class:`~urlographer.routetable.RouteTable` or a
+memory-mapped :class:`~urlographer.routefile.RouteFile` with lookups answered
+by the (local memory) django cache, and reports the memory used by the table
+and the size of the file.
+"""
+import os
+import shutil
+import tempfile
+
+from benchmarks import measure, report, setup_django
+
+URLMAPS = 100000
+
+
+def main():
+    setup_django()
+    from django.conf import settings
+    from django.contrib.sites.models import Site
+    from django.core.cache import cache
+    from urlographer.caching import set_record
+    from urlographer.models import ContentMap, URLMap
+    from urlographer.records import ContentRecord, URLRecord
+    from urlographer.routefile import RouteFile, write_route_file
+    from urlographer.routetable import RouteTable, route_tables
+
+    settings.URLOGRAPHER_CACHE_TIMEOUT = 3600
+    site = Site(id=1, domain='www.example.com', name='example')
+    content_map = ContentMap(
+        id=1, view='urlographer.sample_views.sample_view',
+        options={'test_val': 'testing 1 2 3', 'article_id': 1234})
+    cache.set(content_map.cache_key(),
+              ContentRecord.from_content_map(content_map).encode(), 3600)
+    content = ContentRecord.from_content_map(content_map)
+
+    records = {}
+    for i in xrange(URLMAPS):
+        urlmap = URLMap(id=i + 1, site=site, path='/reviews/product-%d/' % i,
+                        status_code=200, content_map=content_map)
+        urlmap.set_hexdigest()
+        record = URLRecord.from_urlmap(urlmap)
+        record.set_content(content)
+        records[urlmap.hexdigest] = record
+        if i < 100:
+            set_record(urlmap.cache_key(), URLRecord.from_urlmap(urlmap))
+    table = RouteTable(site.id, None, records, 1)
+    route_tables.set(table)
+
+    stats = table.stats()
+    print '%d URLMaps: %.1f MB, %d bytes per URLMap' % (
+        stats['urlmaps'], stats['bytes'] / 1048576.0,
+        stats['bytes'] / stats['urlmaps'])
+
+    path = '/reviews/product-50/'
+    report('cached_get from the django cache',
+           measure(lambda: URLMap.objects.cached_get(site, path), 10000))
+    settings.URLOGRAPHER_ROUTE_TABLE_SITES = [site.id]
+    report('cached_get from the route table',
+           measure(lambda: URLMap.objects.cached_get(site, path), 10000))
+    hexdigest = next(iter(records))
+    report('RouteTable.get', measure(lambda: table.get(hexdigest), 10000))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'example.routes')
+        write_route_file(table, path)
+        print '%d URLMaps: route file of %.1f MB' % (
+            len(table), os.path.getsize(path) / 1048576.0)
+        route_file = RouteFile(path)
+        report('RouteFile.get',
+               measure(lambda: route_file.get(hexdigest), 10000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
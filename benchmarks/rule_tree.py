@@ -0,0 +1,62 @@
+"""
+Matches paths against :class:`~urlographer.ruletree.RuleTree`\ s of 1000,
+10000 and 100000 rules, to show that the cost depends on the path rather
+than on the number of rules, and against a linear scan of the rules for
+comparison.
+"""
+import re
+import time
+
+from benchmarks import measure, report, setup_django
+
+PATHS = [
+    '/reviews/brand-7/some-product/',
+    '/reviews/brand-99999/some/deep/product/page/',
+    '/section-42/product-42/specs/',
+    '/not/covered/by/any/rule/',
+]
+
+
+def patterns(count):
+    for i in xrange(count):
+        if i % 10:
+            yield '/reviews/brand-%d/*' % i
+        else:
+            yield '/section-%d/*/specs/' % (i % 1000)
+
+
+def linear_scan(rules, path):
+    for regex, record in rules:
+        match = regex.match(path)
+        if match:
+            return record, match.groupdict().get('rest', u'')
+
+
+def main():
+    setup_django()
+    from urlographer.ruletree import RuleRecord, RuleTree
+
+    for count in (1000, 10000, 100000):
+        started = time.time()
+        tree = RuleTree()
+        for id, pattern in enumerate(patterns(count)):
+            tree.add(RuleRecord(id, pattern, 301, '/new/'))
+        report('build %d rules' % count, (time.time() - started) * 1e6)
+        for path in PATHS:
+            report('%-6d rules %-38s' % (count, path[:38]),
+                   measure(lambda: tree.match(path), 10000))
+
+    rules = []
+    for id, pattern in enumerate(patterns(1000)):
+        regex = re.escape(pattern).replace('\\*', '[^/]+')
+        if pattern.endswith('/*'):
+            regex = regex[:-len('[^/]+')] + '(?P<rest>.*)'
+        rules.append((re.compile(regex + '$'),
+                      RuleRecord(id, pattern, 301, '/new/')))
+    for path in PATHS:
+        report('scan 1000 rules %-34s' % path[:34],
+               measure(lambda: linear_scan(rules, path), 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,11 @@ def test_coverage():
     _local('coverage run --source=%s --omit=*/migrations/*.py $(which django-admin.py) test' % APP_NAME)
 
 
+def benchmark(name):
+    """Run one of the benchmarks in the benchmarks package."""
+    _local('python -m benchmarks.%s' % name)
+
+
 def ipdb_test():
     """
     Run the test suite with ipdbplugin enabled for errors and failures,
@@ -25,7 +25,7 @@ setup(
     description='URL mapper for django',
     license='Apache License 2.0',
     url='https://github.com/ConsumerAffairs/django-urlographer',
-    packages=find_packages(exclude=('tests*',)),
+    packages=find_packages(exclude=('tests*', 'benchmarks*')),
     install_requires=[
         'Django>=1.5',
         'django-extensions>=0.9',
@@ -3,7 +3,8 @@ from django import forms
 from django.contrib import admin
 from django.contrib.sites.models import Site
 
-from urlographer.models import URLMap, ContentMap
+from urlographer.caching import bump_generation
+from urlographer.models import URLMap, URLRule, ContentMap
 
 
 SQL_COUNT_REDIRECTS = """
@@ -78,6 +79,18 @@ class URLMapAdmin(admin.ModelAdmin):
     def redirects_count(self, obj):
         return obj.redirects_count
 
+    def invalidate_site_caches(self, request, queryset):
+        site_ids = list(queryset.order_by().values_list(
+            'site_id', flat=True).distinct())
+        for site_id in site_ids:
+            bump_generation(site_id)
+        self.message_user(
+            request, 'Invalidated the cache of %d site(s).' % len(site_ids))
+    invalidate_site_caches.short_description = (
+        'Invalidate the cache of the sites of the selected URL maps')
+
+    actions = ['invalidate_site_caches']
+
     list_display = (
         'id',
         'path',
@@ -96,5 +109,20 @@ class URLMapAdmin(admin.ModelAdmin):
     search_fields = ('path',)
 
 
+class URLRuleAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'pattern',
+        'status_code',
+        'redirect_to',
+        'content_map',
+        'carry_suffix',
+        'modified')
+    list_filter = ('site', 'status_code')
+    raw_id_fields = ('content_map',)
+    search_fields = ('pattern', 'redirect_to')
+
+
 admin.site.register(URLMap, URLMapAdmin)
+admin.site.register(URLRule, URLRuleAdmin)
 admin.site.register(ContentMap)
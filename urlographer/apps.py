@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class UrlographerConfig(AppConfig):
+    name = 'urlographer'
+
+    def ready(self):
+        """
+        Compiles :attr:`~urlographer.dispatch.settings.URLOGRAPHER_HANDLERS`
+        into :data:`~urlographer.dispatch.handlers`, and registers the system
+        check reporting misconfigured handlers
+        """
+        from .checks import check_handlers
+        from .dispatch import handlers
+        handlers.compile()
+        checks.register()(check_handlers)
@@ -0,0 +1,279 @@
+"""
+Bloom filters over the hexdigests of the URLMaps of a site, to answer
+lookups of paths that never had a URLMap without any cache or db access.
+
+For the sites in
+:attr:`~urlographer.caching.settings.URLOGRAPHER_BLOOM_FILTER_SITES`,
+:meth:`~urlographer.models.URLMapManager.cached_get` raises DoesNotExist
+right away for hexdigests the site's :class:`BloomFilter` does not contain.
+A positive answer may be wrong with a probability of about
+:attr:`~urlographer.caching.settings.URLOGRAPHER_BLOOM_FILTER_ERROR_RATE`,
+and the lookup then proceeds as usual.
+
+A filter is built in bulk from the hexdigests in the db, and stored in the
+shared cache so that other processes can load it instead of building their
+own (see the ``build_urlographer_bloom_filters`` management command).
+Filters are versioned by the site's change marker:
+:meth:`~urlographer.models.URLMap.save` adds its hexdigest to the filter of
+the saving process, and logs it with the new marker once the transaction
+commits (see :func:`~urlographer.models.mark_changed_on_commit`). A filter
+built from the db in the meantime keeps the previous marker as its version,
+so like every other process, it catches up with the change log at most once
+every
+:attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL`
+seconds. Until then, it may answer that a new URLMap does not exist. A
+filter that can't catch up, e.g. after a bulk import followed by
+:func:`~urlographer.caching.bump_generation`, or got too full to keep its
+error rate, is rebuilt. The stored filter is also rebuilt every
+:attr:`~urlographer.caching.settings.URLOGRAPHER_BLOOM_FILTER_TIMEOUT`
+seconds.
+"""
+import math
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import REBUILD, change_log_key, get_marker
+
+MAGIC = 'UBF1'
+HEADER = struct.Struct('<4sQQIQd')
+# most changes caught up with from the change log before rebuilding instead
+MAX_CATCH_UP = 1000
+
+
+def bloom_filter_key(site_id):
+    """Shared cache key holding the serialized bloom filter of a site"""
+    return '%sbloom:%s' % (settings.URLOGRAPHER_CACHE_PREFIX, site_id)
+
+
+class BloomFilter(object):
+    """
+    A bloom filter of hexdigests, sized for *capacity* hexdigests at a false
+    positive rate of *error_rate*. As hexdigests are already md5 hashes, the
+    bit positions are derived from the hexdigest itself by double hashing.
+
+    Also counts the lookups it answered (*checks*), those it answered
+    negatively (*rejections*), and those it answered positively for paths
+    that turned out to have no URLMap (*false_positives*).
+    """
+
+    def __init__(self, capacity, error_rate, size=None, hashes=None,
+                 count=0, bits=None):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = size or int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(
+            1, int(round(self.size / float(self.capacity) * math.log(2))))
+        self.count = count
+        self._bits = bits if bits is not None else bytearray(
+            (self.size + 7) // 8)
+        self.version = None
+        self.checks = self.rejections = self.false_positives = 0
+
+    @classmethod
+    def build(cls, site_id, error_rate=None):
+        """
+        Builds the filter of a site from the hexdigests in the db, with room
+        for half as many more
+        """
+        from .models import URLMap
+        version = get_marker(site_id)
+        queryset = URLMap.objects.filter(site_id=site_id).order_by()
+        bloom = cls(queryset.count() * 1.5 + 1000,
+                    error_rate or settings.URLOGRAPHER_BLOOM_FILTER_ERROR_RATE)
+        for hexdigest in queryset.values_list(
+                'hexdigest', flat=True).iterator():
+            bloom.add(hexdigest)
+        bloom.version = version
+        return bloom
+
+    def _positions(self, hexdigest):
+        first = int(hexdigest[:16], 16)
+        second = int(hexdigest[16:], 16) | 1
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, hexdigest):
+        """
+        Adds a hexdigest, counting it unless all of its bits were set
+        already, e.g. because it was added before
+        """
+        bits = self._bits
+        added = False
+        for position in self._positions(hexdigest):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, hexdigest):
+        bits = self._bits
+        for position in self._positions(hexdigest):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def check(self, hexdigest):
+        """Like ``hexdigest in bloom``, but counted in the stats"""
+        self.checks += 1
+        if hexdigest in self:
+            return True
+        self.rejections += 1
+        return False
+
+    def expected_error_rate(self):
+        """Returns the false positive rate expected at the current count"""
+        return (1 - math.exp(
+            -self.hashes * self.count / float(self.size))) ** self.hashes
+
+    def dumps(self):
+        """Returns the filter serialized as a string"""
+        return HEADER.pack(MAGIC, self.capacity, self.size, self.hashes,
+                           self.count, self.error_rate) + str(self._bits)
+
+    @classmethod
+    def loads(cls, data):
+        """Returns a filter serialized by :meth:`dumps`"""
+        magic, capacity, size, hashes, count, error_rate = (
+            HEADER.unpack_from(data))
+        if magic != MAGIC:
+            raise ValueError('Not a serialized bloom filter')
+        return cls(capacity, error_rate, size, hashes, count,
+                   bytearray(data[HEADER.size:]))
+
+    def stats(self):
+        """
+        Returns a dict with the size of the filter, and its configured,
+        expected and observed false positive rates
+        """
+        negatives = self.rejections + self.false_positives
+        return {
+            'version': self.version,
+            'capacity': self.capacity,
+            'count': self.count,
+            'bytes': len(self._bits),
+            'hashes': self.hashes,
+            'error_rate': self.error_rate,
+            'expected_error_rate': self.expected_error_rate(),
+            'checks': self.checks,
+            'rejections': self.rejections,
+            'false_positives': self.false_positives,
+            'observed_error_rate': (
+                self.false_positives / float(negatives) if negatives
+                else None),
+        }
+
+
+def catch_up(bloom, site_id, marker):
+    """
+    Adds the hexdigests logged by the changes between the filter's version
+    and marker. Returns False if the filter needs to be rebuilt instead, e.g.
+    because one of them logged :data:`~urlographer.caching.REBUILD`.
+    """
+    if marker == bloom.version:
+        return True
+    if not (isinstance(marker, (int, long)) and
+            isinstance(bloom.version, (int, long)) and
+            0 < marker - bloom.version <= MAX_CATCH_UP):
+        return False
+    keys = [change_log_key(site_id, version)
+            for version in xrange(bloom.version + 1, marker + 1)]
+    added = cache.get_many(keys)
+    if len(added) != len(keys) or REBUILD in added.values():
+        return False
+    for hexdigest in added.values():
+        if hexdigest:
+            bloom.add(hexdigest)
+    bloom.version = marker
+    return bloom.expected_error_rate() <= 2 * bloom.error_rate
+
+
+def store(site_id, bloom):
+    """Stores the filter in the shared cache for other processes to load"""
+    cache.set(bloom_filter_key(site_id), (bloom.version, bloom.dumps()),
+              settings.URLOGRAPHER_BLOOM_FILTER_TIMEOUT)
+
+
+class BloomFilters(object):
+    """
+    Holds the current :class:`BloomFilter` of each site in
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_BLOOM_FILTER_SITES`
+    """
+
+    def __init__(self):
+        self._filters = {}
+        self._checked = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, site_id):
+        """
+        Returns the site's filter, or None if it has none or it is being
+        loaded by another thread
+        """
+        if site_id not in settings.URLOGRAPHER_BLOOM_FILTER_SITES:
+            return None
+        bloom = self._filters.get(site_id)
+        now = time.time()
+        if bloom is not None and (
+                now - self._checked.get(site_id, 0) <
+                settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL):
+            return bloom
+        self._checked[site_id] = now
+        marker = get_marker(site_id)
+        if bloom is not None and catch_up(bloom, site_id, marker):
+            return bloom
+        return self.refresh(site_id, marker)
+
+    def refresh(self, site_id, marker):
+        """
+        Loads the filter stored in the shared cache and catches it up to
+        marker, or else builds and stores a new one
+        """
+        with self._lock:
+            loading = self._loading.setdefault(site_id, threading.Lock())
+        if not loading.acquire(False):
+            return None
+        try:
+            # never use an outdated filter, even while loading a new one
+            self._filters.pop(site_id, None)
+            bloom = None
+            value = cache.get(bloom_filter_key(site_id))
+            if value:
+                bloom = BloomFilter.loads(value[1])
+                bloom.version = value[0]
+                if not catch_up(bloom, site_id, marker):
+                    bloom = None
+            if bloom is None:
+                bloom = BloomFilter.build(site_id)
+                store(site_id, bloom)
+            self._filters[site_id] = bloom
+            return bloom
+        finally:
+            loading.release()
+
+    def add(self, site_id, hexdigest):
+        """Adds a hexdigest to the site's filter, if it is loaded"""
+        bloom = self._filters.get(site_id)
+        if bloom is not None:
+            bloom.add(hexdigest)
+
+    def clear(self):
+        self._filters.clear()
+        self._checked.clear()
+
+    def stats(self):
+        """Returns the :meth:`BloomFilter.stats` of each loaded filter"""
+        stats = []
+        for site_id, bloom in sorted(self._filters.items()):
+            stats.append(dict(bloom.stats(), site_id=site_id))
+        return stats
+
+
+bloom_filters = BloomFilters()
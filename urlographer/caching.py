@@ -0,0 +1,526 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .records import URLRecord
+from .utils import canonicalize_path
+
+# maximum number of entries kept in each process' local cache; 0 disables it
+settings.URLOGRAPHER_LOCAL_CACHE_SIZE = getattr(
+    settings, 'URLOGRAPHER_LOCAL_CACHE_SIZE', 0)
+# seconds an entry may be served from the local cache
+settings.URLOGRAPHER_LOCAL_CACHE_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_LOCAL_CACHE_TIMEOUT', 30)
+# seconds between checks of a site's change marker in the shared cache
+settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL = getattr(
+    settings, 'URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL', 1)
+# ids of the sites whose URLMaps are all held in each process' memory, see
+# urlographer.routetable
+settings.URLOGRAPHER_ROUTE_TABLE_SITES = getattr(
+    settings, 'URLOGRAPHER_ROUTE_TABLE_SITES', ())
+# paths of compiled route files by site id, see urlographer.routefile
+settings.URLOGRAPHER_ROUTE_FILES = getattr(
+    settings, 'URLOGRAPHER_ROUTE_FILES', {})
+# ids of the sites whose lookups are first checked against a bloom filter of
+# their hexdigests, see urlographer.bloom
+settings.URLOGRAPHER_BLOOM_FILTER_SITES = getattr(
+    settings, 'URLOGRAPHER_BLOOM_FILTER_SITES', ())
+# target false positive rate of the bloom filters
+settings.URLOGRAPHER_BLOOM_FILTER_ERROR_RATE = getattr(
+    settings, 'URLOGRAPHER_BLOOM_FILTER_ERROR_RATE', 0.01)
+# seconds a bloom filter stays in the shared cache, after which the next
+# process to need it builds it anew
+settings.URLOGRAPHER_BLOOM_FILTER_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_BLOOM_FILTER_TIMEOUT', 86400)
+# seconds a process may keep using a site's generation before checking it
+settings.URLOGRAPHER_GENERATION_CHECK_INTERVAL = getattr(
+    settings, 'URLOGRAPHER_GENERATION_CHECK_INTERVAL', 5)
+# maximum number of raw paths whose canonical path and hexdigest each
+# process remembers, see PathMemo; 0 disables it
+settings.URLOGRAPHER_PATH_MEMO_SIZE = getattr(
+    settings, 'URLOGRAPHER_PATH_MEMO_SIZE', 0)
+# seconds a path without a URLMap is remembered as such; 0 disables it, but
+# for the lookups waiting on the lock, see LOCKED_TOMBSTONE_TIMEOUT
+settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT', 60)
+
+# fraction of the timeout added at random to each cached URLMap's timeout
+settings.URLOGRAPHER_CACHE_TIMEOUT_JITTER = getattr(
+    settings, 'URLOGRAPHER_CACHE_TIMEOUT_JITTER', 0.1)
+# seconds an expired URLMap stays cached, to be served while it is refreshed
+settings.URLOGRAPHER_CACHE_STALE_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_CACHE_STALE_TIMEOUT', 60)
+# seconds a process may hold the lock for refreshing a cached URLMap
+settings.URLOGRAPHER_CACHE_LOCK_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_CACHE_LOCK_TIMEOUT', 5)
+# seconds to wait for another process to refresh a missing URLMap before
+# querying the db anyway
+settings.URLOGRAPHER_CACHE_LOCK_WAIT = getattr(
+    settings, 'URLOGRAPHER_CACHE_LOCK_WAIT', 0.5)
+
+# cached in place of a URLMap for paths that have none
+TOMBSTONE = 'urlographer:not-found'
+
+LOCK_POLL_INTERVAL = 0.05
+# seconds a lookup holding the lock caches a tombstone for when tombstones
+# are disabled, so that lookups waiting for it don't wait until the timeout
+LOCKED_TOMBSTONE_TIMEOUT = 1
+
+# seconds the change log keeps the hexdigest added by each change
+CHANGE_LOG_TIMEOUT = 3600
+# logged in place of a hexdigest by changes that may have added any number
+# of them, e.g. a bulk import, so that the bloom filters are rebuilt
+REBUILD = 'urlographer:rebuild'
+
+
+_generations = {}
+
+
+def generation_key(site_id):
+    """Shared cache key holding the generation of a site"""
+    return '%sgeneration:%s' % (settings.URLOGRAPHER_CACHE_PREFIX, site_id)
+
+
+def get_generation(site_id):
+    """
+    Returns the current generation of the site, which is part of the cache
+    keys of its URLMaps and sitemap. It is read from the shared cache at most
+    once every
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_GENERATION_CHECK_INTERVAL`
+    seconds. A missing generation is initialized from the current time, so
+    that entries from before it was evicted are never used again.
+    """
+    now = time.time()
+    generation, checked_at = _generations.get(site_id, (None, None))
+    if checked_at is None or (
+            now - checked_at >=
+            settings.URLOGRAPHER_GENERATION_CHECK_INTERVAL):
+        key = generation_key(site_id)
+        generation = cache.get(key)
+        if generation is None:
+            generation = int(now * 1000)
+            if not cache.add(key, generation, None):
+                generation = cache.get(key) or generation
+        _generations[site_id] = (generation, now)
+    return generation
+
+
+def bump_generation(site_id):
+    """
+    Starts a new generation for the site, which orphans all of its cache
+    entries at once: the URLMaps and sitemap of the site are cached again as
+    they are requested. Other processes pick the new generation up within
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_GENERATION_CHECK_INTERVAL`
+    seconds. Also advances the site's change marker, logging :data:`REBUILD`
+    so that the site's bloom filters are rebuilt, see :func:`mark_changed`.
+    Returns the new generation.
+    """
+    key = generation_key(site_id)
+    try:
+        generation = cache.incr(key)
+    except ValueError:
+        # the generation was evicted; never go back to one used before
+        generation = int(time.time() * 1000)
+        if site_id in _generations:
+            generation = max(generation, _generations[site_id][0] + 1)
+        cache.set(key, generation, None)
+    _generations[site_id] = (generation, time.time())
+    mark_changed(site_id, added=REBUILD)
+    return generation
+
+
+def key_prefix(site_id):
+    """
+    Returns the prefix of the site's cache keys:
+    :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_PREFIX` followed by
+    the site's generation
+    """
+    return '%s%s:' % (
+        settings.URLOGRAPHER_CACHE_PREFIX, get_generation(site_id))
+
+
+_site_prefixes = {}
+
+
+def urlmap_hexdigest(site_id, path):
+    """
+    Returns the hexdigest of the URLMap for a site id and canonical path: the
+    md5 of the site id followed by the path. Needs no URLMap instance, which
+    makes it many times faster than
+    :meth:`~urlographer.models.URLMap.set_hexdigest` on a throwaway one.
+    """
+    prefix = _site_prefixes.get(site_id)
+    if prefix is None:
+        prefix = _site_prefixes[site_id] = str(site_id)
+    return md5(prefix + path).hexdigest()
+
+
+def urlmap_key(site_id, hexdigest):
+    """Returns the cache key of the URLMap with hexdigest"""
+    return key_prefix(site_id) + hexdigest
+
+
+def change_marker_key(site_id):
+    """Shared cache key holding the change marker of a site"""
+    return '%schanges:%s' % (settings.URLOGRAPHER_CACHE_PREFIX, site_id)
+
+
+def change_log_key(site_id, marker):
+    """
+    Shared cache key holding the hexdigest added by the change that advanced
+    the site's change marker to marker
+    """
+    return '%schangelog:%s:%s' % (
+        settings.URLOGRAPHER_CACHE_PREFIX, site_id, marker)
+
+
+def content_map_key(content_map_id):
+    """Shared cache key of a ContentMap's record"""
+    return '%scontentmap:%s' % (
+        settings.URLOGRAPHER_CACHE_PREFIX, content_map_id)
+
+
+class LocalCache(object):
+    """
+    A bounded, in-process LRU cache with a per-entry timeout, used as a first
+    tier in front of the shared django cache.
+
+    Each entry is tagged with the change marker its site had when it was
+    stored. The marker is read from the shared cache at most once every
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL`
+    seconds, and entries tagged with an outdated marker are treated as misses,
+    so changes made by other processes become visible without any explicit
+    messaging.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._markers = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return settings.URLOGRAPHER_LOCAL_CACHE_SIZE
+
+    def _marker(self, site_id, now):
+        marker, checked_at = self._markers.get(site_id, (None, None))
+        if checked_at is None or (
+                now - checked_at >=
+                settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL):
+            marker = cache.get(change_marker_key(site_id))
+            self._markers[site_id] = (marker, now)
+        return marker
+
+    def get(self, key, site_id):
+        """
+        Returns the value cached for key, or None on a miss or if the local
+        cache is disabled
+        """
+        if not self.maxsize:
+            return None
+        now = time.time()
+        marker = self._marker(site_id, now)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] != marker or entry[2] <= now:
+                self.misses += 1
+                return None
+            # re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, site_id, value, timeout=None):
+        """
+        Stores value for the lesser of timeout and
+        :attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_TIMEOUT`
+        seconds
+        """
+        maxsize = self.maxsize
+        if not maxsize:
+            return
+        now = time.time()
+        if timeout is None:
+            timeout = settings.URLOGRAPHER_LOCAL_CACHE_TIMEOUT
+        else:
+            timeout = min(timeout, settings.URLOGRAPHER_LOCAL_CACHE_TIMEOUT)
+        entry = (value, self._marker(site_id, now), now + timeout)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def set_marker(self, site_id, marker):
+        """
+        Records a new change marker for the site, which invalidates all of
+        the site's entries stored so far
+        """
+        self._markers[site_id] = (marker, time.time())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._markers.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict with the hit and miss counters, current size and
+        maximum size, to help tune
+        :attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_SIZE`
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+
+local_cache = LocalCache()
+
+
+class PathMemo(object):
+    """
+    A bounded, in-process memo mapping a raw request path and site id to the
+    canonical path (see :func:`~urlographer.utils.canonicalize_path`) and
+    the hexdigest of the URLMap for it (see :func:`urlmap_hexdigest`).
+
+    Entries are kept in two generations of plain dicts, so that a hit is a
+    single dict lookup, without any lock: when the recent generation is
+    full, it becomes the old one and the old one is dropped, and hits in the
+    old generation are moved back to the recent one. This approximates LRU
+    eviction while holding up to
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_PATH_MEMO_SIZE`
+    entries.
+
+    A path is only admitted the second time it is seen, so that scanners
+    requesting ever new paths don't evict the popular ones. Paths seen once
+    are remembered by hash, in generations of the same size.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    @property
+    def maxsize(self):
+        return settings.URLOGRAPHER_PATH_MEMO_SIZE
+
+    def get(self, site_id, path):
+        """Returns the canonical path and hexdigest for a raw path"""
+        maxsize = self.maxsize
+        if maxsize:
+            key = (site_id, path)
+            entry = self._recent.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            entry = self._old.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._add(key, entry, maxsize)
+                return entry
+            self.misses += 1
+        canonical = canonicalize_path(path)
+        entry = (canonical, urlmap_hexdigest(site_id, canonical))
+        if maxsize:
+            seen = hash(key)
+            if seen in self._seen or seen in self._old_seen:
+                self._seen.discard(seen)
+                self._old_seen.discard(seen)
+                self._add(key, entry, maxsize)
+            else:
+                if len(self._seen) >= max(maxsize // 2, 1):
+                    self._old_seen, self._seen = self._seen, set()
+                self._seen.add(seen)
+        return entry
+
+    def _add(self, key, entry, maxsize):
+        if len(self._recent) >= max(maxsize // 2, 1):
+            self._old, self._recent = self._recent, {}
+        self._recent[key] = entry
+
+    def clear(self):
+        self._recent = {}
+        self._old = {}
+        self._seen = set()
+        self._old_seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict with the hit and miss counters, hit ratio, current
+        size and maximum size, to help tune
+        :attr:`~urlographer.caching.settings.URLOGRAPHER_PATH_MEMO_SIZE`
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / float(lookups) if lookups else None,
+            'size': len(self._recent) + len(self._old),
+            'maxsize': self.maxsize,
+        }
+
+
+path_memo = PathMemo()
+
+
+def markers_enabled():
+    """
+    Returns whether change markers are in use, i.e. whether the local cache,
+    route tables, route files or bloom filters are enabled
+    """
+    return bool(local_cache.maxsize or
+                settings.URLOGRAPHER_ROUTE_TABLE_SITES or
+                settings.URLOGRAPHER_ROUTE_FILES or
+                settings.URLOGRAPHER_BLOOM_FILTER_SITES)
+
+
+def get_marker(site_id):
+    """
+    Returns the site's change marker, initializing it from the current time
+    if it is missing
+    """
+    key = change_marker_key(site_id)
+    marker = cache.get(key)
+    if marker is None:
+        marker = int(time.time() * 1000)
+        if not cache.add(key, marker, None):
+            marker = cache.get(key)
+    return marker
+
+
+def mark_changed(site_id, added=None):
+    """
+    Advances the site's change marker in the shared cache, invalidating the
+    site's entries in the local cache and the site's
+    :class:`~urlographer.routetable.RouteTable` in every process. Does nothing
+    unless :func:`markers_enabled`.
+
+    The marker is a counter, initialized from the current time if it is
+    missing. While bloom filters are enabled, the hexdigest *added* by the
+    change, if any, or :data:`REBUILD`, is logged under the new marker for
+    :data:`CHANGE_LOG_TIMEOUT` seconds, so that other processes can catch up
+    with the changes, see :mod:`urlographer.bloom`.
+
+    Returns the new marker.
+    """
+    if not markers_enabled():
+        return None
+    key = change_marker_key(site_id)
+    try:
+        marker = cache.incr(key)
+    except (TypeError, ValueError):
+        # missing, or not a counter yet
+        marker = int(time.time() * 1000)
+        cache.set(key, marker, None)
+    if settings.URLOGRAPHER_BLOOM_FILTER_SITES:
+        cache.set(change_log_key(site_id, marker), added or '',
+                  CHANGE_LOG_TIMEOUT)
+    local_cache.set_marker(site_id, marker)
+    return marker
+
+
+def entry_timeout(timeout):
+    """
+    Returns a (stale_at, cache timeout) tuple for an entry that should be
+    refreshed after timeout seconds, plus a random jitter of up to
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_CACHE_TIMEOUT_JITTER`
+    times the timeout so entries cached together don't expire together.
+    The entry stays in the cache for another
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_CACHE_STALE_TIMEOUT`
+    seconds so it can be served while being refreshed.
+
+    A timeout of 0 or None is passed through to the backend as-is, and the
+    entry never becomes stale.
+    """
+    if not timeout:
+        return None, timeout
+    timeout += int(random.uniform(
+        0, timeout * settings.URLOGRAPHER_CACHE_TIMEOUT_JITTER))
+    return (time.time() + timeout,
+            timeout + settings.URLOGRAPHER_CACHE_STALE_TIMEOUT)
+
+
+def set_record(key, record):
+    """
+    Caches a :class:`~urlographer.records.URLRecord` for
+    :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_TIMEOUT` seconds,
+    see :func:`entry_timeout`
+    """
+    record.stale_at, timeout = entry_timeout(
+        settings.URLOGRAPHER_CACHE_TIMEOUT)
+    cache.set(key, record.encode(), timeout=timeout)
+
+
+def decode_entry(value):
+    if value == TOMBSTONE:
+        return value
+    return URLRecord.decode(value)
+
+
+def get_entry(key):
+    """
+    Returns the :class:`~urlographer.records.URLRecord` or :data:`TOMBSTONE`
+    cached for key, or None
+    """
+    return decode_entry(cache.get(key))
+
+
+def get_entries(keys):
+    """
+    Like :func:`get_entry`, for many keys with a single get_many. Returns a
+    dict of the entries found, by key.
+    """
+    entries = {}
+    for key, value in cache.get_many(keys).items():
+        entry = decode_entry(value)
+        if entry:
+            entries[key] = entry
+    return entries
+
+
+def acquire_lock(key):
+    """
+    Tries to take the short-lived lock for refreshing the entry cached for
+    key, returning whether it succeeded
+    """
+    return cache.add(
+        key + ':lock', 1, settings.URLOGRAPHER_CACHE_LOCK_TIMEOUT)
+
+
+def release_lock(key):
+    cache.delete(key + ':lock')
+
+
+def wait_for_entry(key):
+    """
+    Polls the cache for up to
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_CACHE_LOCK_WAIT` seconds
+    while another process refreshes the entry for key. Returns the entry, or
+    None if it did not show up in time. A path without a URLMap shows up as
+    a :data:`TOMBSTONE`, even when tombstones are disabled (see
+    :data:`LOCKED_TOMBSTONE_TIMEOUT`).
+    """
+    deadline = time.time() + settings.URLOGRAPHER_CACHE_LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = get_entry(key)
+        if entry:
+            return entry
+    return None
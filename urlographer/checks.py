@@ -0,0 +1,19 @@
+from django.core import checks
+
+from .dispatch import handlers
+
+
+def check_handlers(app_configs, **kwargs):
+    """
+    Reports the values of
+    :attr:`~urlographer.dispatch.settings.URLOGRAPHER_HANDLERS` that are not
+    views or can't be imported, which would otherwise only raise
+    ImproperlyConfigured when route answers with their status code
+    """
+    return [
+        checks.Error(
+            unicode(error),
+            hint='Use a view or the import string of one.',
+            obj='URLOGRAPHER_HANDLERS[%r]' % status_code,
+            id='urlographer.E001')
+        for status_code, error in sorted(handlers.compile().items())]
@@ -0,0 +1,202 @@
+"""
+Compiled views: the view of a :class:`~urlographer.models.ContentMap`, or a
+handler in :attr:`~urlographer.dispatch.settings.URLOGRAPHER_HANDLERS`,
+resolved once into a :class:`CompiledView`, so that
+:func:`~urlographer.views.route` does not import the view, call
+``as_view()`` or copy its options on every request.
+
+ContentMaps are compiled at most once per version, as
+:data:`compiled_views` memoizes them by id and last modification (see
+:class:`~urlographer.records.ContentRecord`). Handlers are compiled into
+:data:`handlers` at startup, by
+:meth:`~urlographer.apps.UrlographerConfig.ready`, and misconfigured ones
+are reported by the ``urlographer.E001`` system check.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .utils import get_view
+
+# views processing the responses of route, by status code
+settings.URLOGRAPHER_HANDLERS = getattr(settings, 'URLOGRAPHER_HANDLERS', {})
+# maximum number of compiled ContentMaps kept in memory by each process
+settings.URLOGRAPHER_COMPILED_VIEWS_SIZE = getattr(
+    settings, 'URLOGRAPHER_COMPILED_VIEWS_SIZE', 10000)
+
+
+class CompiledView(object):
+    """
+    A view ready to be called with the request, and any further arguments:
+    class-based views are turned into a callable with ``as_view`` and the
+    *initkwargs* option, and the other options are kept as the keyword
+    arguments to pass, along with those given. Calling unpacks them into a
+    new dict, so views can't modify them, although they should not modify
+    their values.
+    """
+    __slots__ = ('view', 'func', 'kwargs', 'name', 'names')
+
+    def __init__(self, view, options=None):
+        if isinstance(view, basestring):
+            view = get_view(view)
+        kwargs = dict(options or {})
+        if hasattr(view, 'as_view'):
+            self.func = view.as_view(**kwargs.pop('initkwargs', {}))
+        else:
+            self.func = view
+        self.view = view
+        self.kwargs = kwargs
+        # partials and callable instances have no name of their own
+        self.name = '%s:%s' % (
+            getattr(view, '__module__', None) or type(view).__module__,
+            getattr(view, '__name__', type(view).__name__))
+        self.names = {}
+        for method in ('GET', 'HEAD', 'POST'):
+            self.transaction_name(method)
+
+    def __call__(self, request, *args, **kwargs):
+        if kwargs:
+            return self.func(request, *args, **dict(self.kwargs, **kwargs))
+        return self.func(request, *args, **self.kwargs)
+
+    def transaction_name(self, method):
+        """
+        Returns the NewRelic transaction name for a request to the view with
+        the given method, built once per method
+        """
+        try:
+            return self.names[method]
+        except KeyError:
+            name = self.names[method] = '%s.%s' % (self.name, method.lower())
+            return name
+
+    def __repr__(self):
+        return '<CompiledView: %s>' % self.name
+
+
+class CompiledViews(object):
+    """
+    The :class:`CompiledView` of each ContentMap version, by ContentMap id
+    and modification timestamp, holding up to
+    :attr:`~urlographer.dispatch.settings.URLOGRAPHER_COMPILED_VIEWS_SIZE`
+    of them in two generations of dicts, like
+    :class:`~urlographer.caching.PathMemo`.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def get(self, record):
+        """
+        Returns the compiled view of a :class:`~urlographer.records.URLRecord`
+        with a ContentMap. Records without a *content_modified* are compiled
+        every time.
+        """
+        if record.content_modified is None:
+            return CompiledView(record.view, record.options)
+        key = (record.content_map_id, record.content_modified)
+        compiled = self._recent.get(key)
+        if compiled is not None:
+            self.hits += 1
+            return compiled
+        compiled = self._old.pop(key, None)
+        if compiled is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            compiled = CompiledView(record.view, record.options)
+        maxsize = settings.URLOGRAPHER_COMPILED_VIEWS_SIZE
+        if maxsize:
+            if len(self._recent) >= max(maxsize // 2, 1):
+                self._old, self._recent = self._recent, {}
+            self._recent[key] = compiled
+        return compiled
+
+    def clear(self):
+        self._recent = {}
+        self._old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dict with the hit and miss counters and current size"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._recent) + len(self._old),
+            'maxsize': settings.URLOGRAPHER_COMPILED_VIEWS_SIZE,
+        }
+
+
+compiled_views = CompiledViews()
+
+# compiled handlers, by handler
+_compiled_handlers = {}
+
+
+def compile_handler(handler):
+    """
+    Returns the :class:`CompiledView` of a handler, which may be a view or
+    the import string of one, compiling it once. Raises ImproperlyConfigured
+    for anything else.
+    """
+    try:
+        return _compiled_handlers[handler]
+    except (KeyError, TypeError):
+        pass
+    if not (callable(handler) or hasattr(handler, 'as_view') or
+            isinstance(handler, basestring)):
+        raise ImproperlyConfigured(
+            'URLOGRAPHER_HANDLERS values must be views or import strings')
+    compiled = _compiled_handlers[handler] = CompiledView(handler)
+    return compiled
+
+
+class Handlers(object):
+    """
+    The :class:`CompiledView` of each handler in
+    :attr:`~urlographer.dispatch.settings.URLOGRAPHER_HANDLERS`, by status
+    code. The setting is compiled again when it is replaced, e.g. by
+    override_settings.
+    """
+
+    def __init__(self):
+        self._compiled = (None, {}, {})
+
+    def compile(self):
+        """
+        Compiles every handler, keeping the ImproperlyConfigured error of
+        those that are not views or can't be imported, and returns the
+        errors by status code
+        """
+        source = settings.URLOGRAPHER_HANDLERS
+        table = {}
+        errors = {}
+        for status_code, handler in source.items():
+            try:
+                table[status_code] = compile_handler(handler)
+            except ImproperlyConfigured as e:
+                errors[status_code] = e
+            except Exception as e:
+                errors[status_code] = ImproperlyConfigured(
+                    'Could not %s URLOGRAPHER_HANDLERS value %r: %s' % (
+                        'import' if isinstance(handler, basestring)
+                        else 'compile', handler, e))
+        self._compiled = (source, table, errors)
+        return errors
+
+    def get(self, status_code):
+        """
+        Returns the compiled handler for a status code, or None if there is
+        none. Raises ImproperlyConfigured if it is misconfigured.
+        """
+        source, table, errors = self._compiled
+        if source is not settings.URLOGRAPHER_HANDLERS:
+            self.compile()
+            source, table, errors = self._compiled
+        handler = table.get(status_code)
+        if handler is None and status_code in errors:
+            raise errors[status_code]
+        return handler
+
+
+handlers = Handlers()
@@ -0,0 +1,78 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from urlographer.models import URLMap
+from urlographer.redirectgraph import RedirectGraph
+
+
+class Command(BaseCommand):
+    help = ('Analyzes the redirects between URLMaps and reports the redirect '
+            'loops, the histogram of chain lengths, the redirects ending at '
+            'URLMaps that are not a 200 and the URLMaps most redirected to.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to analyze; may be repeated. Defaults to all '
+                 'sites. Redirects to other sites are reported as '
+                 'unresolved.'),
+        make_option(
+            '--top', dest='top', type='int', default=10,
+            help='Number of loops and URLMaps to list. Defaults to 10.'),
+        make_option(
+            '--json', action='store_true', dest='json', default=False,
+            help='Write the report as JSON.'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int',
+            help='Number of URLMaps loaded per query. Defaults to '
+                 'URLOGRAPHER_WARM_CACHE_BATCH_SIZE.'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = URLMap.objects.all()
+        if options.get('sites'):
+            queryset = queryset.filter(site__in=options['sites'])
+        report = RedirectGraph.load(
+            queryset, batch_size=options.get('batch_size')).analyze(
+                top=options['top'])
+        ids = set(id for loop in report['loops'] for id in loop)
+        for entry in report['dangling_targets'] + report['fan_in']:
+            ids.add(entry['id'])
+        paths = dict(URLMap.objects.filter(id__in=ids).values_list(
+            'id', 'path'))
+        for entry in report['dangling_targets'] + report['fan_in']:
+            entry['path'] = paths.get(entry['id'])
+
+        if options['json']:
+            report['loops'] = [
+                [{'id': id, 'path': paths.get(id)} for id in loop]
+                for loop in report['loops']]
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('%d URLMaps, %d redirects' % (
+            report['urlmaps'], report['redirects']))
+        self.stdout.write('Chain lengths:')
+        for length, count in sorted(report['chain_lengths'].items()):
+            self.stdout.write('  %d hop(s): %d' % (length, count))
+        self.stdout.write(
+            '%d redirect loop(s), %d redirect(s) leading into them' % (
+                report['loop_count'], report['into_loops']))
+        for loop in report['loops']:
+            self.stdout.write('  ' + ' -> '.join(
+                '%s (%d)' % (paths.get(id), id) for id in loop + loop[:1]))
+        self.stdout.write(
+            '%d redirect(s) ending at a URLMap that is not a 200, '
+            '%d ending outside the analyzed sites' % (
+                report['dangling'], report['unresolved']))
+        self.write_entries(report['dangling_targets'])
+        self.stdout.write('Most redirected to:')
+        self.write_entries(report['fan_in'])
+
+    def write_entries(self, entries):
+        for entry in entries:
+            self.stdout.write(
+                '  %(path)s (%(id)d, site %(site_id)d, %(status_code)d): '
+                '%(redirects)d redirect(s)' % entry)
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from urlographer.bloom import BloomFilter, store
+
+
+class Command(BaseCommand):
+    help = ('Builds the bloom filter of each site from the db, stores it in '
+            'the cache for workers to load, and reports its size and false '
+            'positive rate.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to build; may be repeated. Defaults to '
+                 'URLOGRAPHER_BLOOM_FILTER_SITES.'),
+        make_option(
+            '--error-rate', dest='error_rate', type='float',
+            help='Target false positive rate. Defaults to '
+                 'URLOGRAPHER_BLOOM_FILTER_ERROR_RATE.'),
+    )
+
+    def handle(self, *args, **options):
+        site_ids = (options.get('sites') or
+                    settings.URLOGRAPHER_BLOOM_FILTER_SITES)
+        for site in Site.objects.filter(pk__in=site_ids).order_by('pk'):
+            bloom = BloomFilter.build(
+                site.id, error_rate=options.get('error_rate'))
+            store(site.id, bloom)
+            stats = bloom.stats()
+            self.stdout.write(
+                '%s: %d hexdigests, %.1f KB, %d hashes, expected false '
+                'positive rate %.4f (target %.4f)' % (
+                    site.domain, stats['count'], stats['bytes'] / 1024.0,
+                    stats['hashes'], stats['expected_error_rate'],
+                    stats['error_rate']))
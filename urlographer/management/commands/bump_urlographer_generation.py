@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from urlographer.caching import bump_generation
+
+
+class Command(BaseCommand):
+    help = ('Invalidates every cached URLMap and sitemap of the given sites '
+            'by starting a new cache generation.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to invalidate; may be repeated. '
+                 'Defaults to all.'),
+    )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.order_by('pk')
+        if options.get('sites'):
+            sites = sites.filter(pk__in=options['sites'])
+        for site in sites:
+            self.stdout.write('%s: generation %s' % (
+                site.domain, bump_generation(site.id)))
@@ -0,0 +1,42 @@
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from urlographer.routefile import compile_route_file
+
+
+class Command(BaseCommand):
+    help = ('Compiles every URLMap of each site into the route file '
+            'configured in URLOGRAPHER_ROUTE_FILES.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to compile; may be repeated. Defaults to the '
+                 'sites in URLOGRAPHER_ROUTE_FILES.'),
+        make_option(
+            '--output', dest='output',
+            help='Path of the route file, for a single site.'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int',
+            help='Number of URLMaps fetched per query.'),
+    )
+
+    def handle(self, *args, **options):
+        site_ids = options.get('sites') or sorted(
+            settings.URLOGRAPHER_ROUTE_FILES)
+        if options.get('output') and len(site_ids) != 1:
+            raise CommandError('--output requires exactly one --site')
+        for site in Site.objects.filter(pk__in=site_ids).order_by('pk'):
+            path = (options.get('output') or
+                    settings.URLOGRAPHER_ROUTE_FILES.get(site.id))
+            if not path:
+                raise CommandError(
+                    'No route file configured for site %s' % site.id)
+            count = compile_route_file(
+                site.id, path, batch_size=options.get('batch_size'))
+            self.stdout.write('%s: %d URLMaps compiled into %s (%d bytes)' % (
+                site.domain, count, path, os.path.getsize(path)))
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from urlographer.routetable import RouteTable
+
+
+class Command(BaseCommand):
+    help = ('Loads the route table of each site and reports its size and '
+            'memory usage.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to report on; may be repeated. Defaults to '
+                 'URLOGRAPHER_ROUTE_TABLE_SITES.'),
+    )
+
+    def handle(self, *args, **options):
+        site_ids = (options.get('sites') or
+                    settings.URLOGRAPHER_ROUTE_TABLE_SITES)
+        for site in Site.objects.filter(pk__in=site_ids).order_by('pk'):
+            stats = RouteTable.load(site.id).stats()
+            self.stdout.write(
+                '%s: %d URLMaps, %d ContentMaps, %.1f MB '
+                '(%d bytes per URLMap), loaded in %.2fs' % (
+                    site.domain, stats['urlmaps'], stats['content_maps'],
+                    stats['bytes'] / 1048576.0,
+                    stats['bytes'] / max(stats['urlmaps'], 1),
+                    stats['load_time']))
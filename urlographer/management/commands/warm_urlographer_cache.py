@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from urlographer.models import URLMap
+
+
+class Command(BaseCommand):
+    help = 'Caches every URLMap, site by site, using set_many in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--site', action='append', dest='sites', type='int',
+            help='Id of a site to warm; may be repeated. Defaults to all.'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int',
+            help='Number of URLMaps per set_many call.'),
+        make_option(
+            '--max-rate', dest='max_rate', type='float',
+            help='Maximum number of URLMaps cached per second.'),
+    )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.order_by('pk')
+        if options.get('sites'):
+            sites = sites.filter(pk__in=options['sites'])
+        for site in sites:
+            def progress(count, elapsed):
+                self.stdout.write('%s: %d URLMaps cached (%.1f/s)' % (
+                    site.domain, count, count / max(elapsed, 0.001)))
+            count = URLMap.objects.warm_cache(
+                site, batch_size=options.get('batch_size'),
+                max_rate=options.get('max_rate'), progress=progress)
+            self.stdout.write('%s: done, %d URLMaps cached' % (
+                site.domain, count))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-17 01:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('urlographer', '0003_rename_relname'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='URLRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('pattern', models.CharField(max_length=255)),
+                ('status_code', models.IntegerField(default=301)),
+                ('redirect_to', models.CharField(blank=True, max_length=2000)),
+                ('carry_suffix', models.BooleanField(default=False)),
+                ('content_map', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='urlographer.ContentMap')),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sites.Site')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='urlrule',
+            unique_together=set([('site', 'pattern')]),
+        ),
+    ]
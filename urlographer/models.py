@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from hashlib import md5
+import time
 
 from django.conf import settings
 from django.contrib.admin.models import LogEntry
@@ -20,12 +20,35 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, router, transaction
+from django.db.models.deletion import Collector
+from django.utils import timezone
 from django.utils.encoding import smart_text
 from django_extensions.db.fields.json import JSONField
 from django_extensions.db.models import TimeStampedModel
 
-from .utils import get_view
+from .caching import (
+    LOCKED_TOMBSTONE_TIMEOUT,
+    TOMBSTONE,
+    acquire_lock,
+    content_map_key,
+    entry_timeout,
+    get_entries,
+    get_entry,
+    local_cache,
+    mark_changed,
+    markers_enabled,
+    release_lock,
+    set_record,
+    urlmap_hexdigest,
+    urlmap_key,
+    wait_for_entry)
+from .records import ContentRecord, URLRecord
+from .bloom import bloom_filters
+from .routefile import route_files
+from .routetable import route_tables
+from .ruletree import mark_rules_changed, rule_trees
+from .utils import canonicalize_path, get_view
 
 # for django memcache backend, 0 means use the default_timeout, but for
 # django-redis-cache backend, 0 means no expiration (*NOT* recommended)
@@ -33,6 +56,131 @@ settings.URLOGRAPHER_CACHE_TIMEOUT = getattr(
     settings, 'URLOGRAPHER_CACHE_TIMEOUT', 0)
 settings.URLOGRAPHER_CACHE_PREFIX = getattr(
     settings, 'URLOGRAPHER_CACHE_PREFIX', 'urlographer:')
+# number of URLMaps fetched and cached per batch by warm_cache
+settings.URLOGRAPHER_WARM_CACHE_BATCH_SIZE = getattr(
+    settings, 'URLOGRAPHER_WARM_CACHE_BATCH_SIZE', 1000)
+# most URLMaps redirecting to a changed or deleted URLMap whose cache entries
+# are dropped while saving or deleting it, rather than by a celery task
+settings.URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD = getattr(
+    settings, 'URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD', 1000)
+
+REDIRECT_STATUS_CODES = (301, 302)
+# maximum number of ids in a single IN clause
+IN_CLAUSE_SIZE = 500
+
+
+def chunks(items, size=IN_CLAUSE_SIZE):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def on_commit(func):
+    """
+    Calls func once the current transaction is committed, or right away on
+    Django versions without transaction.on_commit
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+def mark_changed_on_commit(site_id, added=None):
+    """
+    Calls :func:`~urlographer.caching.mark_changed` once the transaction
+    commits. A process that reads the new marker and then loads a route
+    table or bloom filter from the db would otherwise miss the uncommitted
+    change, yet consider itself up to date.
+    """
+    on_commit(lambda: mark_changed(site_id, added=added))
+
+
+def mark_rules_changed_on_commit(site_id):
+    """
+    Like :func:`mark_changed_on_commit`, for the version of the site's rules
+    (see :func:`~urlographer.ruletree.mark_rules_changed`), also dropping the
+    site's rule tree in this process
+    """
+    def changed():
+        mark_rules_changed(site_id)
+        rule_trees.invalidate(site_id)
+    on_commit(changed)
+
+
+def invalidate_urlmaps(urlmaps):
+    """
+    Drops URLMaps updated in bulk, given as (site id, hexdigest) pairs, from
+    the shared cache with a single delete_many and from the local cache, and
+    advances the change marker of each of their sites once, after the
+    transaction commits. Inside a transaction, the entries are dropped again
+    once it commits, as lookups in between read the rows as they were and
+    cache them again.
+    """
+    if not urlmaps:
+        return
+    cache_keys = [urlmap_key(site_id, hexdigest)
+                  for site_id, hexdigest in urlmaps]
+
+    def drop():
+        cache.delete_many(cache_keys)
+        for cache_key in cache_keys:
+            local_cache.delete(cache_key)
+    drop()
+    if connection.in_atomic_block:
+        on_commit(drop)
+    for site_id in set(site_id for site_id, hexdigest in urlmaps):
+        mark_changed_on_commit(site_id)
+
+
+def invalidate_or_queue(urlmaps):
+    """
+    Like :func:`invalidate_urlmaps`, but above
+    :attr:`~urlographer.models.settings.\
+URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD` URLMaps, leaves it to
+    :class:`~urlographer.tasks.InvalidateRedirectsTask`, queued in batches of
+    that size once the transaction commits
+    """
+    threshold = settings.URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD
+    if len(urlmaps) <= threshold:
+        invalidate_urlmaps(urlmaps)
+        return
+    from .tasks import InvalidateRedirectsTask
+    batches = list(chunks(urlmaps, threshold))
+
+    def queue():
+        for batch in batches:
+            InvalidateRedirectsTask.delay(urlmaps=batch)
+    on_commit(queue)
+
+
+class ContentMapManager(models.Manager):
+    def cached_get_many(self, ids):
+        """
+        Returns a dict mapping the given ContentMap ids to their
+        :class:`~urlographer.records.ContentRecord`, using a single get_many
+        on the cache, and a single db query for the ContentMaps that were not
+        cached, which are then cached with set_many. Ids of ContentMaps that
+        do not exist are left out.
+        """
+        keys = dict((content_map_key(id), id) for id in ids)
+        results = {}
+        if not keys:
+            return results
+        for key, value in cache.get_many(keys.keys()).items():
+            record = ContentRecord.decode(value)
+            if record:
+                results[keys.pop(key)] = record
+        if keys:
+            entries = {}
+            for content_map in self.filter(pk__in=keys.values()):
+                record = ContentRecord.from_content_map(content_map)
+                results[content_map.pk] = record
+                entries[content_map.cache_key()] = record.encode()
+            if entries:
+                cache.set_many(
+                    entries, timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
+        return results
 
 
 class ContentMap(TimeStampedModel):
@@ -50,10 +198,14 @@ class ContentMap(TimeStampedModel):
 
     view = models.CharField(max_length=255)
     options = JSONField(blank=True)
+    objects = ContentMapManager()
 
     def __unicode__(self):
         return '%s(**%r)' % (self.view, self.options)
 
+    def cache_key(self):
+        return content_map_key(self.pk)
+
     def clean(self):
         """
         Ensures that we have a valid view according to
@@ -68,40 +220,365 @@ class ContentMap(TimeStampedModel):
         """
         Runs a full_clean prior to saving to DB to ensure we never save
         an invalid view.
-        After saving to DB, refresh the cache on each
-        :class:`~urlographer.models.URLMap` that refers to this instance.
+        After saving to DB, refresh the cache of this instance. The cache
+        entries of the :class:`~urlographer.models.URLMap`\ s that refer to
+        it only hold its id, so they need no update, however many there are.
         """
 
         self.full_clean()
         super(ContentMap, self).save(*args, **options)
-        for urlmap in self.urlmap_set.all():
-            cache.set(urlmap.cache_key(), None, 5)
+        cache.set(self.cache_key(),
+                  ContentRecord.from_content_map(self).encode(),
+                  timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
+        self.mark_sites_changed()
+
+    def delete(self, *args, **options):
+        """delete from DB and cache"""
+        cache_key = self.cache_key()
+        self.mark_sites_changed()
+        super(ContentMap, self).delete(*args, **options)
+        cache.delete(cache_key)
+
+    def mark_sites_changed(self):
+        """
+        Invalidates the local caches and route tables of the sites with
+        URLMaps referring to this instance once the transaction commits, see
+        :func:`mark_changed_on_commit`
+        """
+        if not markers_enabled():
+            return
+        site_ids = self.urlmap_set.order_by().values_list(
+            'site_id', flat=True).distinct()
+        for site_id in site_ids:
+            mark_changed_on_commit(site_id)
 
 
 class URLMapManager(models.Manager):
-    def cached_get(self, site, path, force_cache_invalidation=False):
+    def for_records(self):
+        """
+        Returns a queryset that fetches everything
+        :meth:`URLRecord.from_urlmap
+        <urlographer.records.URLRecord.from_urlmap>` needs in the same query
+        as the URLMaps themselves
+        """
+        return self.select_related('site', 'content_map', 'redirect__site')
+
+    def set_contents(self, records):
+        """
+        Fills in the *view* and *options* of cached
+        :class:`~urlographer.records.URLRecord`\ s with
+        :meth:`ContentMapManager.cached_get_many`. Returns the records whose
+        ContentMap no longer exists.
+        """
+        contents = ContentMap.objects.cached_get_many(set(
+            record.content_map_id for record in records
+            if record.content_map_id))
+        missing = []
+        for record in records:
+            if record.content_map_id:
+                content = contents.get(record.content_map_id)
+                if content:
+                    record.set_content(content)
+                else:
+                    missing.append(record)
+        return missing
+
+    def route_table(self, site):
+        """
+        Returns the site's :class:`~urlographer.routetable.RouteTable` or
+        else its :class:`~urlographer.routefile.RouteFile`, if it has either
         """
-        Uses the site and path to construct a temporary URL instance, and then
-        gets the cache key and hexdigest for cache and db queries.
-        Sets cache if cache miss. Raises NotFoundError if url not in cache or
-        db.
+        table = route_tables.get(site.id)
+        if table is None:
+            table = route_files.get(site.id)
+        return table
+
+    def cached_get(self, site, path, force_cache_invalidation=False,
+                   hexdigest=None, prefetch=None):
+        """
+        Uses the site and path to compute the hexdigest, unless given, and
+        cache key for cache and db queries, without instantiating a URLMap
+        (see :func:`~urlographer.caching.urlmap_hexdigest`).
+        Returns a :class:`~urlographer.records.URLRecord`, which is what the
+        cache stores, rather than a URLMap instance.
+        Sets cache if cache miss, fetching the URLMap and the related objects
+        its record needs with a single query (see :meth:`for_records`).
+        Raises DoesNotExist if url not in cache or
+        db, caching a tombstone for
+        :attr:`~urlographer.caching.settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT`
+        seconds so repeated lookups of unknown paths skip the db. When that
+        is 0, the tombstone is still cached for
+        :data:`~urlographer.caching.LOCKED_TOMBSTONE_TIMEOUT` seconds by the
+        lookup holding the lock (see below), so that the others don't wait.
+
+        For sites with a route table or route file (see
+        :meth:`route_table`), it answers instead, without any cache or db
+        I/O. For sites with a :class:`~urlographer.bloom.BloomFilter`, paths
+        it does not contain raise DoesNotExist right away.
+
+        When :attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_SIZE`
+        is set, the in-process :data:`~urlographer.caching.local_cache` is
+        checked before the shared cache.
+
+        Only one process at a time refreshes a missing or stale entry, using a
+        short-lived lock key: others serve the stale entry, or wait for the
+        fresh one to show up (see
+        :attr:`~urlographer.caching.settings.URLOGRAPHER_CACHE_LOCK_WAIT`).
+
+        The prefetch path, if any, is read from the shared cache in the same
+        get_many as the path, and when it is not cached, queried from the db
+        and cached along with the path, e.g. so that a redirect to it finds
+        it cached. Its record is not returned.
         """
-        url = self.model(site=site, path=path)
-        url.set_hexdigest()
-        cache_key = url.cache_key()
+        hexdigest = hexdigest or urlmap_hexdigest(site.id, path)
+        prefetch_key = None
+        if prefetch is not None and not force_cache_invalidation:
+            prefetch_hexdigest = urlmap_hexdigest(
+                site.id, canonicalize_path(prefetch))
+            prefetch_key = urlmap_key(site.id, prefetch_hexdigest)
         if not force_cache_invalidation:
-            cached = cache.get(cache_key)
-            if cached:
+            table = self.route_table(site)
+            if table is not None:
+                record = table.get(hexdigest)
+                if record is None:
+                    raise self.model.DoesNotExist(
+                        'URLMap matching query does not exist.')
+                return record
+            bloom = bloom_filters.get(site.id)
+            if bloom is not None and not bloom.check(hexdigest):
+                raise self.model.DoesNotExist(
+                    'URLMap matching query does not exist.')
+        else:
+            bloom = None
+        cache_key = urlmap_key(site.id, hexdigest)
+        locked = False
+        if not force_cache_invalidation:
+            cached = local_cache.get(cache_key, site.id)
+            if not cached:
+                if prefetch_key:
+                    entries = get_entries([cache_key, prefetch_key])
+                    cached = entries.get(cache_key)
+                    if prefetch_key in entries:
+                        prefetch_key = None
+                else:
+                    cached = get_entry(cache_key)
+                stale = False
+                if not cached:
+                    locked = acquire_lock(cache_key)
+                    if not locked:
+                        cached = wait_for_entry(cache_key)
+                elif cached != TOMBSTONE and cached.is_stale(time.time()):
+                    locked = acquire_lock(cache_key)
+                    if locked:
+                        cached = None
+                    else:
+                        stale = True
+                if cached and cached != TOMBSTONE and (
+                        self.set_contents([cached])):
+                    # the ContentMap is gone, so the URLMap most likely is too
+                    cached = None
+                elif cached and not stale:
+                    local_cache.set(cache_key, site.id, cached)
+            if cached == TOMBSTONE:
+                if bloom is not None:
+                    bloom.false_positives += 1
+                raise self.model.DoesNotExist(
+                    'URLMap matching query does not exist.')
+            elif cached:
                 return cached
 
-        url = self.get(hexdigest=url.hexdigest)
-        # accessing foreignkeys caches instances with the object
-        url.site
-        url.content_map
-        url.redirect
-        cache.set(cache_key, url, timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
+        try:
+            try:
+                if prefetch_key:
+                    url = self._get_with_prefetch(
+                        hexdigest, prefetch_hexdigest, prefetch_key)
+                else:
+                    url = self.for_records().get(hexdigest=hexdigest)
+            except self.model.DoesNotExist:
+                if bloom is not None:
+                    bloom.false_positives += 1
+                timeout = settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT
+                if timeout:
+                    cache.set(cache_key, TOMBSTONE, timeout=timeout)
+                    local_cache.set(cache_key, site.id, TOMBSTONE, timeout)
+                elif locked:
+                    # for the lookups waiting for the lock
+                    cache.set(cache_key, TOMBSTONE,
+                              timeout=LOCKED_TOMBSTONE_TIMEOUT)
+                raise
+            record = URLRecord.from_urlmap(url)
+            set_record(cache_key, record)
+            local_cache.set(cache_key, site.id, record)
+            return record
+        finally:
+            if locked:
+                release_lock(cache_key)
+
+    def _get_with_prefetch(self, hexdigest, prefetch_hexdigest,
+                           prefetch_key):
+        """
+        Fetches the URLMaps with either hexdigest in a single query, caches
+        the prefetched one under prefetch_key, or a tombstone if it does not
+        exist, and returns the other or raises DoesNotExist
+        """
+        urls = dict((url.hexdigest, url) for url in self.for_records().filter(
+            hexdigest__in=[hexdigest, prefetch_hexdigest]))
+        prefetched = urls.get(prefetch_hexdigest)
+        if prefetched is not None:
+            set_record(prefetch_key, URLRecord.from_urlmap(prefetched))
+        elif settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT:
+            cache.set(prefetch_key, TOMBSTONE,
+                      timeout=settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT)
+        url = urls.get(hexdigest)
+        if url is None:
+            raise self.model.DoesNotExist(
+                'URLMap matching query does not exist.')
         return url
 
+    def cached_get_many(self, site, paths):
+        """
+        Batch version of :meth:`cached_get`, for callers that need many paths
+        at once. Canonicalizes each path with
+        :func:`~urlographer.utils.canonicalize_path`, skips those ruled out
+        by the site's bloom filter, then gets whatever it
+        can from the local cache and a single get_many on the shared cache
+        (plus one for their ContentMaps), and the rest with a single db query.
+        Found URLMaps and not-found tombstones are cached with set_many. Stale
+        entries are served as they are, and left to :meth:`cached_get` to
+        refresh under its lock.
+
+        Returns a dict mapping each of the given paths to its
+        :class:`~urlographer.records.URLRecord`, or to None if it has no
+        URLMap.
+        """
+        table = self.route_table(site)
+        if table is not None:
+            results = {}
+            for path in paths:
+                results[path] = table.get(
+                    urlmap_hexdigest(site.id, canonicalize_path(path)))
+            return results
+
+        bloom = bloom_filters.get(site.id)
+        results = {}
+        pending = {}
+        hexdigests = {}
+        for path in paths:
+            hexdigest = urlmap_hexdigest(site.id, canonicalize_path(path))
+            if bloom is not None and not bloom.check(hexdigest):
+                results[path] = None
+                continue
+            cache_key = urlmap_key(site.id, hexdigest)
+            cached = local_cache.get(cache_key, site.id)
+            if cached:
+                results[path] = None if cached == TOMBSTONE else cached
+            else:
+                pending.setdefault(cache_key, []).append(path)
+                hexdigests[cache_key] = hexdigest
+
+        if pending:
+            hits = {}
+            for cache_key, value in cache.get_many(pending.keys()).items():
+                cached = value if value == TOMBSTONE else (
+                    URLRecord.decode(value))
+                if cached:
+                    hits[cache_key] = cached
+            missing = set(id(record) for record in self.set_contents(
+                [cached for cached in hits.values() if cached != TOMBSTONE]))
+            for cache_key, cached in hits.items():
+                if id(cached) in missing:
+                    continue
+                local_cache.set(cache_key, site.id, cached)
+                for path in pending.pop(cache_key):
+                    results[path] = None if cached == TOMBSTONE else cached
+
+        if pending:
+            found = {}
+            stale_at, timeout = entry_timeout(
+                settings.URLOGRAPHER_CACHE_TIMEOUT)
+            queryset = self.for_records().filter(
+                hexdigest__in=[hexdigests[key] for key in pending])
+            for url in queryset:
+                record = URLRecord.from_urlmap(url)
+                record.stale_at = stale_at
+                cache_key = urlmap_key(site.id, url.hexdigest)
+                found[cache_key] = record
+                local_cache.set(cache_key, site.id, record)
+            if found:
+                cache.set_many(
+                    dict((key, record.encode())
+                         for key, record in found.items()),
+                    timeout=timeout)
+            missing = [key for key in pending if key not in found]
+            not_found_timeout = settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT
+            if missing and not_found_timeout:
+                cache.set_many(dict.fromkeys(missing, TOMBSTONE),
+                               timeout=not_found_timeout)
+                for key in missing:
+                    local_cache.set(
+                        key, site.id, TOMBSTONE, not_found_timeout)
+            for cache_key, cache_paths in pending.items():
+                for path in cache_paths:
+                    results[path] = found.get(cache_key)
+
+        return results
+
+    def warm_cache(self, site, batch_size=None, max_rate=None,
+                   progress=None):
+        """
+        Caches every URLMap of the site with :meth:`cache_records`, e.g. after
+        the cache was flushed or the
+        :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_PREFIX` changed.
+        """
+        return self.cache_records(
+            batch_size=batch_size, max_rate=max_rate, progress=progress,
+            site=site)
+
+    def cache_records(self, batch_size=None, max_rate=None, progress=None,
+                      **filters):
+        """
+        Caches every URLMap matching the filters under its
+        :meth:`~urlographer.models.URLMap.cache_key`.
+
+        URLMaps are fetched by ascending id, batch_size (defaults to
+        :attr:`~urlographer.models.settings.URLOGRAPHER_WARM_CACHE_BATCH_SIZE`)
+        at a time, together with everything their records need, and each
+        batch is cached with a single set_many. When max_rate is given, sleeps
+        as needed to cache no more than max_rate URLMaps per second. After
+        each batch, progress, if given, is called with the number of URLMaps
+        cached so far and the elapsed seconds.
+
+        Returns the number of URLMaps cached.
+        """
+        batch_size = batch_size or settings.URLOGRAPHER_WARM_CACHE_BATCH_SIZE
+        queryset = self.for_records().filter(**filters).order_by('pk')
+        started = time.time()
+        count = last_id = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            stale_at, timeout = entry_timeout(
+                settings.URLOGRAPHER_CACHE_TIMEOUT)
+            entries = {}
+            for url in batch:
+                record = URLRecord.from_urlmap(url)
+                record.stale_at = stale_at
+                entries[url.cache_key()] = record.encode()
+                if url.content_map_id:
+                    entries[url.content_map.cache_key()] = (
+                        ContentRecord.from_content_map(
+                            url.content_map).encode())
+            cache.set_many(entries, timeout=timeout)
+            count += len(batch)
+            elapsed = time.time() - started
+            if progress:
+                progress(count, elapsed)
+            if max_rate and float(count) / max_rate > elapsed:
+                time.sleep(float(count) / max_rate - elapsed)
+        return count
+
 
 class URLMap(TimeStampedModel):
     """
@@ -133,6 +610,15 @@ class URLMap(TimeStampedModel):
     on_sitemap = models.BooleanField(default=True, db_index=True)
     objects = URLMapManager()
 
+    def __init__(self, *args, **kwargs):
+        super(URLMap, self).__init__(*args, **kwargs)
+        self._loaded_url = self._url_fields()
+
+    def _url_fields(self):
+        # deferred fields are missing from __dict__, so they count as changed
+        return tuple(self.__dict__.get(name) for name in (
+            'site_id', 'path', 'force_secure', 'hexdigest'))
+
     def protocol(self):
         """returns http or https, based on *force_secure* field"""
         if self.force_secure:
@@ -156,26 +642,136 @@ class URLMap(TimeStampedModel):
     def cache_key(self):
         """
         Must be called after the *hexdigest* has been set or an
-        AssertionError will be raised
+        AssertionError will be raised. Includes the current generation of
+        the *site*, see :func:`~urlographer.caching.bump_generation`.
         """
         if not self.hexdigest:
             raise ValueError('URLMap has unset hexdigest')
-        return settings.URLOGRAPHER_CACHE_PREFIX + self.hexdigest
+        return urlmap_key(self.site_id, self.hexdigest)
 
     def set_hexdigest(self):
-        """MD5 hash the site and path and save to the *hexdigest* field"""
-        self.hexdigest = md5(str(self.site.id) + self.path).hexdigest()
+        """
+        MD5 hash the site and path and save to the *hexdigest* field, see
+        :func:`~urlographer.caching.urlmap_hexdigest`
+        """
+        self.hexdigest = urlmap_hexdigest(self.site_id, self.path)
 
-    def delete(self, *args, **options):
-        """delete from DB and cache"""
-        super(URLMap, self).delete(*args, **options)
-        cache.delete(self.cache_key())
+    def delete(self, using=None):
+        """
+        delete from DB and cache, along with the URLMaps deleted with it,
+        i.e. redirecting to it or having it as *canonical*, directly or not
+        (see :func:`invalidate_or_queue`)
+        """
+        using = using or router.db_for_write(URLMap, instance=self)
+        collector = Collector(using=using)
+        collector.collect([self])
+        deleted = set()
+        for model, instances in collector.data.items():
+            if issubclass(model, URLMap):
+                deleted.update((urlmap.site_id, urlmap.hexdigest)
+                               for urlmap in instances)
+        for queryset in collector.fast_deletes:
+            if issubclass(queryset.model, URLMap):
+                deleted.update(queryset.values_list('site_id', 'hexdigest'))
+        deleted.discard((self.site_id, self.hexdigest))
+        collector.delete()
+        invalidate_urlmaps([(self.site_id, self.hexdigest)])
+        invalidate_or_queue(sorted(deleted))
+
+    def final_redirect_id(self):
+        """
+        Follows the redirect chain starting at *redirect*, with a query per
+        hop, and returns the id of the URLMap it ends at. Raises
+        ValidationError if the chain leads back to self or into a loop.
+        """
+        seen = set([self.pk])
+        target_id = self.redirect_id
+        while True:
+            if target_id in seen:
+                raise ValidationError(
+                    {'redirect': ['This redirect would create a loop']})
+            seen.add(target_id)
+            row = URLMap.objects.filter(pk=target_id).values_list(
+                'status_code', 'redirect_id').first()
+            if row is None or row[0] not in REDIRECT_STATUS_CODES or (
+                    not row[1]):
+                return target_id
+            target_id = row[1]
+
+    def redirect_source_ids(self, status_codes=REDIRECT_STATUS_CODES):
+        """
+        Returns the ids of the URLMaps with one of *status_codes*, or any
+        status code if None, redirecting to this one, directly or through
+        each other, with a query per level of the redirect chains
+        """
+        source_ids = set()
+        level = [self.id]
+        while level:
+            queryset = URLMap.objects.order_by()
+            if status_codes:
+                queryset = queryset.filter(status_code__in=status_codes)
+            next_level = set()
+            for ids in chunks(level):
+                next_level.update(queryset.filter(
+                    redirect_id__in=ids).values_list('id', flat=True))
+            level = next_level - source_ids
+            source_ids.update(level)
+        source_ids.discard(self.id)
+        return source_ids
+
+    def invalidate_redirects(self):
+        """
+        Drops the cache entries of the URLMaps redirecting to this one, which
+        embed its URL, in bulk. Above
+        :attr:`~urlographer.models.settings.\
+URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD` URLMaps, this is left to
+        :class:`~urlographer.tasks.InvalidateRedirectsTask`, queued once the
+        transaction commits.
+        """
+        threshold = settings.URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD
+        sources = list(self.redirects.order_by().values_list(
+            'site_id', 'hexdigest')[:threshold + 1])
+        if len(sources) > threshold:
+            from .tasks import InvalidateRedirectsTask
+            redirect_id = self.id
+            on_commit(
+                lambda: InvalidateRedirectsTask.delay(redirect_id=redirect_id))
+        else:
+            invalidate_urlmaps(sources)
+
+    def repoint_redirects(self):
+        """
+        Repoints every 301 or 302 URLMap redirecting to this one, directly or
+        through other redirects, to the final destination: the end of this
+        URLMap's own redirect chain if it is a redirect, or else this URLMap.
+        Does nothing for a 200. The URLMaps are found with a query per level
+        of the chain, updated with one UPDATE per :data:`IN_CLAUSE_SIZE`
+        URLMaps, and dropped from the cache with delete_many. Returns the
+        number of URLMaps repointed.
+        """
+        if self.status_code == 200:
+            return 0
+        target_id = self.id
+        if self.status_code in REDIRECT_STATUS_CODES:
+            target_id = self.redirect_id
+        source_ids = self.redirect_source_ids()
+        rows = []
+        for ids in chunks(source_ids):
+            rows.extend(URLMap.objects.filter(id__in=ids).exclude(
+                redirect_id=target_id).values_list(
+                    'id', 'site_id', 'hexdigest'))
+        now = timezone.now()
+        for chunk in chunks(rows):
+            URLMap.objects.filter(id__in=[row[0] for row in chunk]).update(
+                redirect=target_id, modified=now)
+        invalidate_urlmaps([row[1:] for row in rows])
+        return len(rows)
 
     def clean_fields(self, *args, **kwargs):
         """
         In addition to the standard validations, we also ensure:
 
-        #. No redirect loops
+        #. No redirect loops, including through other redirects
         #. No 301 or 302 *status_code* with a null *redirect*
         #. No 200 *status_code* with a null *content_map*
         """
@@ -199,27 +795,51 @@ class URLMap(TimeStampedModel):
             raise ValidationError(errors)
 
     def clean(self):
+        """
+        Sets the *hexdigest*, and points a redirect straight at the end of the
+        redirect chain it leads to, refusing loops (see
+        :meth:`final_redirect_id`)
+        """
         self.set_hexdigest()
+        if self.status_code in REDIRECT_STATUS_CODES and self.redirect_id and (
+                self.redirect_id != self.pk):
+            target_id = self.final_redirect_id()
+            if target_id != self.redirect_id:
+                self.redirect = URLMap.objects.select_related('site').get(
+                    pk=target_id)
 
     def save(self, *args, **options):
         """
-        Run a full_clean before saving to the DB, then cache self including the
-        *site*, *content_map*, and *redirect*, with a timeout of
-        :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_TIMEOUT`. If the
+        Run a full_clean before saving to the DB, then cache a
+        :class:`~urlographer.records.URLRecord` built from self, its *site*,
+        *content_map*, and *redirect*, with a timeout of
+        :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_TIMEOUT`,
+        replacing any not-found tombstone cached for the path. If the
         path ends with
         :attr:`~urlographer.models.settings.URLOGRAPHER_INDEX_ALIAS`, also
         refresh the cache for the corresponding path with the index alias
         removed.
+
+        Redirects to self are repointed if needed (see
+        :meth:`repoint_redirects`), and if the URL of self changed, their
+        cache entries, which embed it, are dropped (see
+        :meth:`invalidate_redirects`) along with the entry of the previous
+        path.
         """
         self.full_clean()
         super(URLMap, self).save(*args, **options)
-        # accessing foreignkeys before caching allows us to cache instances of
-        # the models being referred to together with the object we're caching
-        self.site
-        self.content_map
-        self.redirect
-        cache.set(
-            self.cache_key(), self, timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
+        set_record(self.cache_key(), URLRecord.from_urlmap(self))
+        local_cache.delete(self.cache_key())
+        bloom_filters.add(self.site_id, self.hexdigest)
+        mark_changed_on_commit(self.site_id, added=self.hexdigest)
+        self.repoint_redirects()
+        if self.id and self._url_fields() != self._loaded_url:
+            site_id, path, force_secure, hexdigest = self._loaded_url
+            if site_id and hexdigest and hexdigest != self.hexdigest:
+                # the entry of the previous path
+                invalidate_urlmaps([(site_id, hexdigest)])
+            self.invalidate_redirects()
+        self._loaded_url = self._url_fields()
 
     def get_amp_equivalent(self):
         """Return AMP equivalent URLMap. For path `/path/` the AMP equivalent
@@ -249,3 +869,81 @@ class URLMap(TimeStampedModel):
                 'code "{1}".'.format(main_urlmap.path, main_urlmap.status_code)
             )
         })
+
+
+class URLRule(TimeStampedModel):
+    """
+    A rule mapping every path of a site matching its *pattern*, which may
+    contain ``*`` segments (see :mod:`urlographer.ruletree`), to one of the
+    following, like a :class:`~urlographer.models.URLMap` would:
+
+    #. A view, using the *content_map* relation to
+       :class:`~urlographer.models.ContentMap` together with a *status_code*
+       of 200. When *carry_suffix* is set, the part of the path matched by a
+       final ``*`` is passed to the view as the *path_suffix* keyword
+       argument.
+    #. A permanent or temporary redirect to the *redirect_to* path or URL,
+       with a *status_code* of 301 or 302, respectively. When *carry_suffix*
+       is set, the part of the path matched by a final ``*`` is appended to
+       it.
+    #. An arbitrary status code, for example 410 for a whole retired
+       section.
+
+    Rules only apply to paths without a URLMap.
+    """
+    site = models.ForeignKey(Site)
+    pattern = models.CharField(max_length=255)
+    status_code = models.IntegerField(default=301)
+    redirect_to = models.CharField(max_length=2000, blank=True)
+    content_map = models.ForeignKey(ContentMap, blank=True, null=True)
+    carry_suffix = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('site', 'pattern')
+
+    def __unicode__(self):
+        return self.site.domain + self.pattern
+
+    def clean(self):
+        """
+        Canonicalizes the *pattern* with
+        :func:`~urlographer.utils.canonicalize_path`, and ensures that:
+
+        #. The pattern is a path whose ``*`` are whole segments
+        #. *carry_suffix* is only set for patterns ending with ``/*``
+        #. No 301 or 302 *status_code* without a *redirect_to*
+        #. No 200 *status_code* without a *content_map*
+        """
+        errors = {}
+        self.pattern = canonicalize_path(self.pattern)
+        if not self.pattern.startswith('/'):
+            errors['pattern'] = ['The pattern must start with /']
+        elif any('*' in segment and segment != '*'
+                 for segment in self.pattern.split('/')):
+            errors['pattern'] = ['* must be a whole path segment']
+        elif self.carry_suffix and not self.pattern.endswith('/*'):
+            errors['carry_suffix'] = [
+                'Only patterns ending with /* have a suffix to carry']
+
+        if self.status_code in REDIRECT_STATUS_CODES and not self.redirect_to:
+            errors['redirect_to'] = ['Status code requires a redirect']
+        elif self.status_code == 200 and not self.content_map_id:
+            errors['content_map'] = ['Status code requires a content map']
+
+        if errors:
+            raise ValidationError(errors)
+
+    def save(self, *args, **options):
+        """
+        Run a full_clean before saving to the DB, then have every process
+        reload the site's :class:`~urlographer.ruletree.RuleTree` once the
+        transaction commits, see :func:`mark_rules_changed_on_commit`
+        """
+        self.full_clean()
+        super(URLRule, self).save(*args, **options)
+        mark_rules_changed_on_commit(self.site_id)
+
+    def delete(self, *args, **options):
+        site_id = self.site_id
+        super(URLRule, self).delete(*args, **options)
+        mark_rules_changed_on_commit(site_id)
@@ -0,0 +1,166 @@
+"""
+Compact cache entries for :class:`~urlographer.models.URLMap` and
+:class:`~urlographer.models.ContentMap`.
+
+Instead of pickled model instances, the cache holds plain tuples tagged with
+:data:`RECORD_VERSION`. They are small, quick to unpickle, independent of
+the Django version, and carry everything
+:func:`~urlographer.views.route` needs to answer a request.
+
+URLMap entries refer to their ContentMap by id, so that a change to a
+ContentMap only needs to update the ContentMap's own entry.
+"""
+import calendar
+
+# bump whenever the layout of URLRecord.encode or ContentRecord.encode
+# changes; entries written with another version are ignored and refreshed
+# from the db
+RECORD_VERSION = 4
+
+
+def _is_current(value):
+    return type(value) is tuple and value and value[0] == RECORD_VERSION
+
+
+def timestamp(value):
+    """Returns a datetime as seconds since the epoch, or None"""
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class URLRecord(object):
+    """
+    A slim view of a :class:`~urlographer.models.URLMap`:
+
+    * *url*: the absolute URL of the URLMap itself
+    * *redirect_url*: the absolute URL of the redirect target, if any
+    * *content_map_id*: the id of the
+      :class:`~urlographer.models.ContentMap`, if any
+    * *view*, *options* and *content_modified*: taken from the ContentMap.
+      They are not part of the cached tuple, and are filled in from the
+      ContentMap's :class:`ContentRecord`.
+    * *stale_at*: the timestamp after which the cache entry should be
+      refreshed, if any. It is not taken into account when comparing records.
+    """
+    __slots__ = ('id', 'status_code', 'force_secure', 'url', 'redirect_url',
+                 'content_map_id', 'view', 'options', 'stale_at',
+                 'content_modified')
+
+    def __init__(self, id, status_code, force_secure, url, redirect_url=None,
+                 content_map_id=None, view=None, options=None,
+                 stale_at=None, content_modified=None):
+        self.id = id
+        self.status_code = status_code
+        self.force_secure = force_secure
+        self.url = url
+        self.redirect_url = redirect_url
+        self.content_map_id = content_map_id
+        self.view = view
+        self.options = options
+        self.stale_at = stale_at
+        self.content_modified = content_modified
+
+    @classmethod
+    def from_urlmap(cls, urlmap):
+        """
+        Builds a record from a URLMap, accessing its *site*, *redirect* and
+        *content_map*
+        """
+        redirect_url = None
+        if urlmap.redirect_id:
+            redirect_url = unicode(urlmap.redirect)
+        record = cls(urlmap.id, urlmap.status_code, urlmap.force_secure,
+                     unicode(urlmap), redirect_url, urlmap.content_map_id)
+        if urlmap.content_map_id:
+            record.set_content(
+                ContentRecord.from_content_map(urlmap.content_map))
+        return record
+
+    def set_content(self, content):
+        """
+        Fills in *view*, *options* and *content_modified* from a
+        :class:`ContentRecord`
+        """
+        self.view = content.view
+        self.options = content.options
+        self.content_modified = content.modified
+
+    def encode(self):
+        """Returns the tuple stored in the cache"""
+        return (RECORD_VERSION, self.id, self.status_code, self.force_secure,
+                self.url, self.redirect_url, self.content_map_id,
+                self.stale_at)
+
+    @classmethod
+    def decode(cls, value):
+        """
+        Returns a record built from a cached tuple, or None if value is not a
+        tuple of the current :data:`RECORD_VERSION`. Its *view* and *options*
+        are not set.
+        """
+        if not _is_current(value):
+            return None
+        (version, id, status_code, force_secure, url, redirect_url,
+         content_map_id, stale_at) = value
+        return cls(id, status_code, force_secure, url, redirect_url,
+                   content_map_id, stale_at=stale_at)
+
+    def is_stale(self, now):
+        return self.stale_at is not None and now >= self.stale_at
+
+    def __unicode__(self):
+        return self.url
+
+    def __repr__(self):
+        return '<URLRecord: %s %s>' % (self.status_code, self.url)
+
+    def __eq__(self, other):
+        return isinstance(other, URLRecord) and (
+            self.encode()[:-1] == other.encode()[:-1] and
+            self.view == other.view and self.options == other.options)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class ContentRecord(object):
+    """
+    The *view* and *options* of a :class:`~urlographer.models.ContentMap`,
+    and when it was last *modified* (see :func:`timestamp`)
+    """
+    __slots__ = ('view', 'options', 'modified')
+
+    def __init__(self, view, options, modified=None):
+        self.view = view
+        self.options = options
+        self.modified = modified
+
+    @classmethod
+    def from_content_map(cls, content_map):
+        return cls(content_map.view, content_map.options,
+                   timestamp(content_map.modified))
+
+    def encode(self):
+        """Returns the tuple stored in the cache"""
+        return (RECORD_VERSION, self.view, self.options, self.modified)
+
+    @classmethod
+    def decode(cls, value):
+        """
+        Returns a record built from a cached tuple, or None if value is not a
+        tuple of the current :data:`RECORD_VERSION`
+        """
+        if not _is_current(value):
+            return None
+        return cls(*value[1:])
+
+    def __repr__(self):
+        return '<ContentRecord: %s>' % self.view
+
+    def __eq__(self, other):
+        return isinstance(other, ContentRecord) and (
+            self.encode() == other.encode())
+
+    def __ne__(self, other):
+        return not self == other
@@ -0,0 +1,200 @@
+"""
+Analysis of the redirect graph: redirect loops, chain lengths, redirects
+ending at URLMaps that are not a 200, and the URLMaps most redirected to.
+
+A :class:`RedirectGraph` is loaded in a single pass over the id, redirect,
+status code and site of every URLMap, in batches, and kept in typed arrays
+of about 40 bytes per URLMap rather than in Python objects, so tens of
+millions of URLMaps fit in memory. As a URLMap redirects to at most one
+other, the strongly connected components of more than one URLMap are
+exactly the redirect loops, and all of the analysis is done in time linear
+in the number of URLMaps. See also the ``analyze_urlographer_redirects``
+management command.
+"""
+import heapq
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+
+# where a redirect chain ends, when not at a URLMap
+IN_LOOP = -1
+INTO_LOOP = -2
+UNRESOLVED = -3
+UNVISITED = -4
+VISITING = -5
+
+
+class RedirectGraph(object):
+    """
+    The redirects between a set of URLMaps, which must be added in order of
+    id. A 301 or 302 is followed to the URLMap it redirects to; any other
+    URLMap ends a chain.
+    """
+
+    def __init__(self):
+        self.ids = array('l')
+        self.status_codes = array('H')
+        self.site_ids = array('i')
+        # the redirect id of each redirect, until resolve() turns it into
+        # the index of the redirect's target, or UNRESOLVED if not loaded,
+        # and -1 for URLMaps that do not redirect
+        self.targets = array('l')
+        self.redirects = 0
+        self._resolved = False
+
+    @classmethod
+    def load(cls, queryset=None, batch_size=None):
+        """
+        Loads the URLMaps of queryset, by default all of them, in batches of
+        *batch_size* (by default :attr:`~urlographer.models.settings.\
+URLOGRAPHER_WARM_CACHE_BATCH_SIZE`)
+        """
+        from .models import URLMap
+        if queryset is None:
+            queryset = URLMap.objects.all()
+        batch_size = batch_size or settings.URLOGRAPHER_WARM_CACHE_BATCH_SIZE
+        queryset = queryset.order_by('pk').values_list(
+            'id', 'redirect_id', 'status_code', 'site_id')
+        graph = cls()
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not rows:
+                break
+            for row in rows:
+                graph.add(*row)
+            last_pk = rows[-1][0]
+        graph.resolve()
+        return graph
+
+    def add(self, id, redirect_id, status_code, site_id):
+        """Adds a URLMap, with a higher id than the ones added before"""
+        self.ids.append(id)
+        self.status_codes.append(status_code)
+        self.site_ids.append(site_id)
+        if redirect_id and status_code in (301, 302):
+            self.targets.append(redirect_id)
+            self.redirects += 1
+        else:
+            self.targets.append(-1)
+        self._resolved = False
+
+    def index(self, id):
+        """Returns the index of the URLMap with id, or None if not loaded"""
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return i
+        return None
+
+    def resolve(self):
+        """Turns the redirect ids into indexes, once all URLMaps are added"""
+        if self._resolved:
+            return
+        targets = self.targets
+        for i in xrange(len(targets)):
+            if targets[i] >= 0:
+                target = self.index(targets[i])
+                targets[i] = UNRESOLVED if target is None else target
+        self._resolved = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _entry(self, i, **kwargs):
+        return dict(kwargs, id=self.ids[i], site_id=self.site_ids[i],
+                    status_code=self.status_codes[i])
+
+    def analyze(self, top=10):
+        """
+        Returns a dict with the numbers of URLMaps and redirects, a histogram
+        of the number of hops it takes redirects to reach the end of their
+        chain (*chain_lengths*), the redirect loops (up to *top* of them, as
+        lists of ids, with *loop_count*), the numbers of redirects leading
+        into a loop, ending at a URLMap that is not a 200 (*dangling*) or at
+        one that was not loaded (*unresolved*), and the *top* URLMaps with
+        the most redirect chains ending at them while not a 200
+        (*dangling_targets*) and with the most redirects to them (*fan_in*)
+        """
+        self.resolve()
+        targets = self.targets
+        count = len(targets)
+        # the index each URLMap's chain ends at, or where else it ends
+        ends = array('l', [UNVISITED]) * count
+        lengths = array('i', [0]) * count
+        fan_in = array('I', [0]) * count
+        for i in xrange(count):
+            if targets[i] >= 0:
+                fan_in[targets[i]] += 1
+            elif targets[i] == -1:
+                ends[i] = i
+
+        loops = []
+        loop_count = 0
+        for i in xrange(count):
+            if ends[i] != UNVISITED:
+                continue
+            chain = []
+            j = i
+            while ends[j] == UNVISITED:
+                if targets[j] == UNRESOLVED:
+                    ends[j] = UNRESOLVED
+                    break
+                ends[j] = VISITING
+                chain.append(j)
+                j = targets[j]
+            end, length = ends[j], lengths[j]
+            if end == VISITING:
+                loop = chain[chain.index(j):]
+                del chain[-len(loop):]
+                loop_count += 1
+                if len(loops) < top:
+                    loops.append([self.ids[k] for k in loop])
+                for k in loop:
+                    ends[k] = IN_LOOP
+                end = INTO_LOOP
+            elif end == IN_LOOP:
+                end = INTO_LOOP
+            for k in reversed(chain):
+                ends[k] = end
+                if end >= 0:
+                    length += 1
+                    lengths[k] = length
+
+        chain_lengths = {}
+        into_loops = dangling = unresolved = 0
+        dangling_ends = {}
+        for i in xrange(count):
+            end = ends[i]
+            if targets[i] == -1 or end == IN_LOOP:
+                continue
+            if end == INTO_LOOP:
+                into_loops += 1
+            elif end == UNRESOLVED:
+                unresolved += 1
+            else:
+                chain_lengths[lengths[i]] = chain_lengths.get(
+                    lengths[i], 0) + 1
+                if self.status_codes[end] != 200:
+                    dangling += 1
+                    dangling_ends[end] = dangling_ends.get(end, 0) + 1
+
+        return {
+            'urlmaps': count,
+            'redirects': self.redirects,
+            'chain_lengths': chain_lengths,
+            'loop_count': loop_count,
+            'loops': loops,
+            'into_loops': into_loops,
+            'dangling': dangling,
+            'unresolved': unresolved,
+            'dangling_targets': [
+                self._entry(i, redirects=dangling_ends[i])
+                for i in heapq.nlargest(top, dangling_ends,
+                                        key=dangling_ends.__getitem__)],
+            'fan_in': [
+                self._entry(i, redirects=fan_in[i])
+                for i in heapq.nlargest(top, xrange(count),
+                                        key=fan_in.__getitem__)
+                if fan_in[i]],
+        }
@@ -0,0 +1,238 @@
+"""
+Compiled route files: all the URLMaps of a site in a read-only binary file
+that every worker process memory-maps, so that the operating system's page
+cache holds a single copy however many workers there are.
+
+A route file is compiled with :func:`compile_route_file` or the
+``compile_urlographer_routes`` management command, and enabled by adding its
+path to :attr:`~urlographer.caching.settings.URLOGRAPHER_ROUTE_FILES`.
+:meth:`~urlographer.models.URLMapManager.cached_get` then answers from it
+without any cache or db I/O. The file is written next to its final path and
+renamed over it, so compiling never disturbs the workers reading the
+previous one.
+
+A route file is a snapshot: it records the site's change marker (see
+:func:`~urlographer.caching.mark_changed`) as it was when compiling started,
+and is ignored, falling back to the cache, as soon as the marker advances.
+Recompile regularly, e.g. from cron, to keep using it.
+
+Layout, all little-endian:
+
+* header: :data:`MAGIC`, site id, number of entries, ContentMaps and
+  strings, and the change marker (-1 if the site had none)
+* entries, sorted by hexdigest: the 16 bytes of the hexdigest, id, status
+  code, force_secure, and the string indexes of the URL and redirect URL
+  plus the index of the ContentMap
+* ContentMaps: id, the string indexes of the view and the JSON encoded
+  options, and the timestamp of the last modification (-1 if unknown)
+* string table: the offsets of the strings followed by their utf-8 bytes
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import change_marker_key
+from .records import ContentRecord, URLRecord
+from .routetable import RouteTable
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'URLOGRF2'
+HEADER = struct.Struct('<8sIIIIq')
+ENTRY = struct.Struct('<16sQHBxIII')
+CONTENT = struct.Struct('<QIId')
+OFFSET = struct.Struct('<I')
+# stands for None in string and ContentMap indexes
+NONE = 0xffffffff
+
+
+def compile_route_file(site_id, path, batch_size=None):
+    """
+    Writes every URLMap of the site to a route file at path, replacing any
+    previous one atomically. Returns the number of URLMaps written.
+    """
+    return write_route_file(
+        RouteTable.load(site_id, batch_size=batch_size), path)
+
+
+def write_route_file(table, path):
+    """
+    Writes the records of a :class:`~urlographer.routetable.RouteTable` to a
+    route file at path, replacing any previous one atomically
+    """
+    strings = {}
+
+    def index(value):
+        if value is None:
+            return NONE
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    contents = {}
+    entries = []
+    for hexdigest, record in table.items():
+        content_index = NONE
+        if record.content_map_id:
+            if record.content_map_id not in contents:
+                contents[record.content_map_id] = (
+                    len(contents), CONTENT.pack(
+                        record.content_map_id, index(record.view),
+                        index(json.dumps(record.options)),
+                        -1 if record.content_modified is None
+                        else record.content_modified))
+            content_index = contents[record.content_map_id][0]
+        entries.append(ENTRY.pack(
+            hexdigest.decode('hex'), record.id, record.status_code,
+            record.force_secure, index(record.url),
+            index(record.redirect_url), content_index))
+    entries.sort()
+
+    data = [value.encode('utf-8') if isinstance(value, unicode) else value
+            for value, i in sorted(strings.items(), key=lambda item: item[1])]
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, table.site_id, len(entries), len(contents), len(data),
+            -1 if table.version is None else table.version))
+        f.writelines(entries)
+        f.writelines(content for i, content in sorted(contents.values()))
+        offset = 0
+        for value in data:
+            f.write(OFFSET.pack(offset))
+            offset += len(value)
+        f.write(OFFSET.pack(offset))
+        f.writelines(data)
+    os.rename(tmp_path, path)
+    return len(entries)
+
+
+class RouteFile(object):
+    """
+    Reads a compiled route file through a read-only memory map. Lookups are
+    binary searches over the sorted entries; only the ContentMaps that were
+    looked up are decoded and kept in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stamp = (stat.st_ino, stat.st_mtime)
+        (magic, self.site_id, self._count, content_count, string_count,
+         version) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a compiled route file' % path)
+        self._contents_at = HEADER.size + self._count * ENTRY.size
+        self._offsets_at = self._contents_at + content_count * CONTENT.size
+        self._strings_at = self._offsets_at + (string_count + 1) * OFFSET.size
+        self._contents = {}
+        self.version = None if version == -1 else version
+
+    def _string(self, index):
+        if index == NONE:
+            return None
+        start, end = struct.unpack_from(
+            '<II', self._map, self._offsets_at + index * OFFSET.size)
+        return self._map[
+            self._strings_at + start:self._strings_at + end].decode('utf-8')
+
+    def _content(self, index):
+        """Returns the id and ContentRecord of a ContentMap"""
+        content = self._contents.get(index)
+        if content is None:
+            content_map_id, view, options, modified = CONTENT.unpack_from(
+                self._map, self._contents_at + index * CONTENT.size)
+            content = self._contents[index] = (content_map_id, ContentRecord(
+                self._string(view), json.loads(self._string(options)),
+                None if modified < 0 else modified))
+        return content
+
+    def get(self, hexdigest):
+        """Returns the record of the URLMap with hexdigest, or None"""
+        digest = hexdigest.decode('hex')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * ENTRY.size
+            key = self._map[offset:offset + 16]
+            if key < digest:
+                low = middle + 1
+            elif key > digest:
+                high = middle
+            else:
+                return self._record(offset)
+        return None
+
+    def _record(self, offset):
+        (digest, id, status_code, force_secure, url, redirect_url,
+         content_index) = ENTRY.unpack_from(self._map, offset)
+        record = URLRecord(id, status_code, bool(force_secure),
+                           self._string(url), self._string(redirect_url))
+        if content_index != NONE:
+            record.content_map_id, content = self._content(content_index)
+            record.set_content(content)
+        return record
+
+    def __len__(self):
+        return self._count
+
+
+class RouteFiles(object):
+    """
+    Holds the current :class:`RouteFile` of each site in
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_ROUTE_FILES`. At most
+    once every
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL`
+    seconds, the file is checked for having been replaced, and the site's
+    change marker for having advanced since it was compiled.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._checked = {}
+
+    def get(self, site_id):
+        """
+        Returns the site's route file, or None if it has none or it is
+        missing, unreadable or outdated
+        """
+        path = settings.URLOGRAPHER_ROUTE_FILES.get(site_id)
+        if not path:
+            return None
+        now = time.time()
+        if site_id not in self._files or (
+                now - self._checked.get(site_id, 0) >=
+                settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL):
+            self._checked[site_id] = now
+            self._files[site_id] = self._check(site_id, path)
+        return self._files[site_id]
+
+    def _check(self, site_id, path):
+        route_file = self._files.get(site_id)
+        try:
+            stat = os.stat(path)
+            if route_file is None or route_file.path != path or (
+                    route_file.stamp != (stat.st_ino, stat.st_mtime)):
+                # the previous file stays mapped until no thread uses it
+                route_file = RouteFile(path)
+        except (EnvironmentError, ValueError) as e:
+            logger.warning('Unable to use route file %s: %s', path, e)
+            return None
+        if cache.get(change_marker_key(site_id)) != route_file.version:
+            return None
+        return route_file
+
+    def clear(self):
+        self._files.clear()
+        self._checked.clear()
+
+
+route_files = RouteFiles()
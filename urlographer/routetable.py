@@ -0,0 +1,200 @@
+"""
+In-memory route tables: immutable snapshots of all the URLMaps of a site.
+
+For the sites listed in
+:attr:`~urlographer.caching.settings.URLOGRAPHER_ROUTE_TABLE_SITES`, each
+process loads every :class:`~urlographer.models.URLMap` of the site into a
+:class:`RouteTable`, and
+:meth:`~urlographer.models.URLMapManager.cached_get` answers from it without
+any cache or db I/O. A missing hexdigest means the path has no URLMap.
+
+Tables are never modified. Saving or deleting a URLMap or ContentMap advances
+the site's change marker once the transaction commits (see
+:func:`~urlographer.models.mark_changed_on_commit`), as tables are loaded
+from the db after reading the marker. Every process checks the marker at
+most once every
+:attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL`
+seconds. When it has advanced, a new table is loaded and swapped in, while
+other threads keep using the previous one.
+
+Each URLMap costs a few hundred bytes; :meth:`RouteTable.stats` and the
+``urlographer_route_tables`` management command report the actual usage.
+"""
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import change_marker_key
+from .records import ContentRecord, URLRecord
+
+
+class RouteTable(object):
+    """
+    The :class:`~urlographer.records.URLRecord`\ s of all the URLMaps of a
+    site, keyed by hexdigest. Records with the same ContentMap share its
+    *view* and *options*.
+
+    *version* is the site's change marker as it was read before loading the
+    table, so changes made while loading are picked up by the next check.
+    """
+    __slots__ = ('site_id', 'version', 'loaded_at', 'load_time', '_records',
+                 '_content_count')
+
+    def __init__(self, site_id, version, records, content_count=0,
+                 load_time=0):
+        self.site_id = site_id
+        self.version = version
+        self.loaded_at = time.time()
+        self.load_time = load_time
+        self._records = records
+        self._content_count = content_count
+
+    @classmethod
+    def load(cls, site_id, batch_size=None):
+        """
+        Loads every URLMap of the site, in batches of *batch_size* (by
+        default :attr:`~urlographer.models.settings.\
+URLOGRAPHER_WARM_CACHE_BATCH_SIZE`) so memory use is bounded by the table
+        itself
+        """
+        from .models import URLMap
+        started = time.time()
+        batch_size = batch_size or settings.URLOGRAPHER_WARM_CACHE_BATCH_SIZE
+        version = cache.get(change_marker_key(site_id))
+        queryset = URLMap.objects.for_records().filter(
+            site_id=site_id).order_by('pk')
+        records = {}
+        contents = {}
+        last_pk = 0
+        while True:
+            urlmaps = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not urlmaps:
+                break
+            for urlmap in urlmaps:
+                record = URLRecord.from_urlmap(urlmap)
+                if record.content_map_id:
+                    content = contents.get(record.content_map_id)
+                    if content is None:
+                        content = contents[record.content_map_id] = (
+                            ContentRecord(record.view, record.options,
+                                          record.content_modified))
+                    record.set_content(content)
+                records[urlmap.hexdigest] = record
+            last_pk = urlmaps[-1].pk
+        return cls(site_id, version, records, len(contents),
+                   time.time() - started)
+
+    def get(self, hexdigest):
+        """Returns the record of the URLMap with hexdigest, or None"""
+        return self._records.get(hexdigest)
+
+    def items(self):
+        """Iterates over the (hexdigest, record) pairs of the table"""
+        return self._records.iteritems()
+
+    def __len__(self):
+        return len(self._records)
+
+    def memory_usage(self):
+        """
+        Returns the approximate number of bytes used by the table, counting
+        shared objects once and the *options* dicts but not their contents
+        """
+        seen = set()
+        total = sys.getsizeof(self._records)
+        for hexdigest, record in self._records.iteritems():
+            for obj in (hexdigest, record, record.url, record.redirect_url,
+                        record.view, record.options):
+                if obj is not None and id(obj) not in seen:
+                    seen.add(id(obj))
+                    total += sys.getsizeof(obj)
+        return total
+
+    def stats(self):
+        """
+        Returns a dict with the size and memory usage of the table, see
+        :meth:`memory_usage`
+        """
+        return {
+            'site_id': self.site_id,
+            'version': self.version,
+            'urlmaps': len(self._records),
+            'content_maps': self._content_count,
+            'bytes': self.memory_usage(),
+            'load_time': self.load_time,
+        }
+
+
+class RouteTables(object):
+    """
+    Holds the current :class:`RouteTable` of each site in
+    :attr:`~urlographer.caching.settings.URLOGRAPHER_ROUTE_TABLE_SITES`
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._checked = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, site_id):
+        """
+        Returns the site's current table, loading it on first use or when the
+        site's change marker has advanced. Returns None for sites without a
+        route table.
+        """
+        if site_id not in settings.URLOGRAPHER_ROUTE_TABLE_SITES:
+            return None
+        table = self._tables.get(site_id)
+        now = time.time()
+        if table is not None and (
+                now - self._checked.get(site_id, 0) <
+                settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL):
+            return table
+        self._checked[site_id] = now
+        if table is not None and (
+                cache.get(change_marker_key(site_id)) == table.version):
+            return table
+        return self.refresh(site_id)
+
+    def refresh(self, site_id):
+        """
+        Loads a new table for the site and swaps it in. If another thread is
+        already loading one, returns the current table instead of waiting,
+        unless there is none yet.
+        """
+        table = self._tables.get(site_id)
+        with self._lock:
+            loading = self._loading.setdefault(site_id, threading.Lock())
+        if not loading.acquire(table is None):
+            return table
+        try:
+            current = self._tables.get(site_id)
+            if current is not table:
+                # swapped in by another thread while this one waited
+                return current
+            table = RouteTable.load(site_id)
+            self.set(table)
+            return table
+        finally:
+            loading.release()
+
+    def set(self, table):
+        """Swaps in a table for its site"""
+        self._tables[table.site_id] = table
+        self._checked[table.site_id] = time.time()
+
+    def clear(self):
+        self._tables.clear()
+        self._checked.clear()
+
+    def stats(self):
+        """Returns the :meth:`RouteTable.stats` of each loaded table"""
+        return [table.stats() for site_id, table in
+                sorted(self._tables.items())]
+
+
+route_tables = RouteTables()
@@ -0,0 +1,273 @@
+"""
+Prefix and wildcard rules: :class:`~urlographer.models.URLRule`\ s, which
+:func:`~urlographer.views.route` falls back to for paths without a URLMap,
+so that e.g. a whole retired section takes a single row instead of one
+URLMap per URL.
+
+The pattern of a rule is a path whose segments may be ``*``. At the end of
+the pattern, ``*`` matches the rest of the path, however many segments it
+has, and anywhere else it matches any one non-empty segment. For example,
+``/reviews/old-brand/*`` matches every path under ``/reviews/old-brand/``,
+and ``/reviews/*/specs/`` the ``specs/`` page of every review.
+
+The rules of a site are compiled into a :class:`RuleTree`, a radix tree
+whose edges are path segments. Each process loads it on first use, and
+reloads it when the site's rules are saved or deleted, which it checks at
+most once every
+:attr:`~urlographer.caching.settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL`
+seconds. Matching walks the tree one segment at a time, so its cost is
+proportional to the length of the path rather than to the number of rules.
+The only alternatives followed are ``*`` edges next to literal ones.
+
+When several rules match, the one with a literal segment where the others
+have a ``*`` first wins, like ``/reviews/old-brand/*`` over
+``/reviews/*/specs/``, then the one matching the most segments, so that a
+rule matching the whole path wins over a prefix of it.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def rule_version_key(site_id):
+    """Shared cache key holding the version of the rules of a site"""
+    return '%srules:%s' % (settings.URLOGRAPHER_CACHE_PREFIX, site_id)
+
+
+def mark_rules_changed(site_id):
+    """
+    Advances the version of the site's rules in the shared cache, so that
+    every process reloads its :class:`RuleTree`. Returns the new version.
+    """
+    key = rule_version_key(site_id)
+    try:
+        return cache.incr(key)
+    except (TypeError, ValueError):
+        # missing, or not a counter yet
+        version = int(time.time() * 1000)
+        cache.set(key, version, None)
+        return version
+
+
+class RuleRecord(object):
+    """A slim view of a :class:`~urlographer.models.URLRule`"""
+    __slots__ = ('id', 'pattern', 'status_code', 'redirect_to',
+                 'content_map_id', 'carry_suffix')
+
+    # the URLRule fields a record is built from, in order
+    fields = __slots__
+
+    def __init__(self, id, pattern, status_code, redirect_to=u'',
+                 content_map_id=None, carry_suffix=False):
+        self.id = id
+        self.pattern = pattern
+        self.status_code = status_code
+        self.redirect_to = redirect_to
+        self.content_map_id = content_map_id
+        self.carry_suffix = carry_suffix
+
+    def redirect_url(self, suffix):
+        """
+        Returns the URL to redirect to, followed by the suffix of the path
+        matched by a final ``*`` if *carry_suffix* is set
+        """
+        if self.carry_suffix:
+            return self.redirect_to + suffix
+        return self.redirect_to
+
+    def view_kwargs(self, suffix):
+        """
+        Returns the keyword arguments to pass to the view on top of the
+        ContentMap's options: the suffix, as *path_suffix*, if *carry_suffix*
+        is set
+        """
+        if self.carry_suffix:
+            return {'path_suffix': suffix}
+        return {}
+
+    def __repr__(self):
+        return '<RuleRecord: %s>' % self.pattern
+
+
+class RuleNode(object):
+    """
+    A node of a :class:`RuleTree`: the *children* reached by literal
+    segments (None until there are any), the node reached by a ``*``
+    segment, the *rule* whose pattern ends here, and the rule whose pattern
+    ends here with a final ``*`` matching the *rest* of the path
+    """
+    __slots__ = ('children', 'wildcard', 'rule', 'rest')
+
+    def __init__(self):
+        self.children = None
+        self.wildcard = None
+        self.rule = None
+        self.rest = None
+
+
+class RuleTree(object):
+    """The :class:`RuleRecord`\ s of a site, by pattern"""
+
+    def __init__(self, site_id=None, version=None):
+        self.site_id = site_id
+        self.version = version
+        self.root = RuleNode()
+        self.count = 0
+        self.load_time = None
+
+    @classmethod
+    def load(cls, site_id):
+        """Loads every URLRule of the site"""
+        from .models import URLRule
+        started = time.time()
+        tree = cls(site_id, cache.get(rule_version_key(site_id)))
+        for row in URLRule.objects.filter(site_id=site_id).order_by(
+                ).values_list(*RuleRecord.fields).iterator():
+            tree.add(RuleRecord(*row))
+        tree.load_time = time.time() - started
+        return tree
+
+    def add(self, record):
+        """Adds a rule, replacing any with the same pattern"""
+        segments = record.pattern[1:].split('/')
+        rest = segments[-1] == '*'
+        if rest:
+            segments.pop()
+        node = self.root
+        for segment in segments:
+            if segment == '*':
+                if node.wildcard is None:
+                    node.wildcard = RuleNode()
+                node = node.wildcard
+                continue
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = RuleNode()
+            node = child
+        if rest:
+            replaced, node.rest = node.rest, record
+        else:
+            replaced, node.rule = node.rule, record
+        if replaced is None:
+            self.count += 1
+
+    def match(self, path):
+        """
+        Returns the (record, suffix) pair of the rule best matching a
+        canonical path, where suffix is the part of the path matched by a
+        final ``*``, or None if no rule matches
+        """
+        segments = path[1:].split('/')
+        best = None
+        best_score = None
+        # the nodes reached so far, each with a score telling for every
+        # segment followed to reach it whether it was literal (1) or * (0),
+        # so that comparing scores ranks the matches
+        states = [(self.root, ())]
+        for depth, segment in enumerate(segments):
+            reached = []
+            for node, score in states:
+                if node.rest is not None and (
+                        best is None or score > best_score):
+                    best = node.rest, '/'.join(segments[depth:])
+                    best_score = score
+                if node.children is not None:
+                    child = node.children.get(segment)
+                    if child is not None:
+                        reached.append((child, score + (1,)))
+                if node.wildcard is not None and segment:
+                    reached.append((node.wildcard, score + (0,)))
+            states = reached
+            if not states:
+                return best
+        for node, score in states:
+            if node.rule is not None and (best is None or score > best_score):
+                best = node.rule, u''
+                best_score = score
+        return best
+
+    def __len__(self):
+        return self.count
+
+    def stats(self):
+        """Returns a dict with the site, version and number of rules"""
+        return {
+            'site_id': self.site_id,
+            'version': self.version,
+            'rules': self.count,
+            'load_time': self.load_time,
+        }
+
+
+class RuleTrees(object):
+    """Holds the current :class:`RuleTree` of each site"""
+
+    def __init__(self):
+        self._trees = {}
+        self._checked = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, site_id):
+        """
+        Returns the site's current tree, loading it on first use or when the
+        version of the site's rules has changed
+        """
+        tree = self._trees.get(site_id)
+        now = time.time()
+        if tree is not None and (
+                now - self._checked.get(site_id, 0) <
+                settings.URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL):
+            return tree
+        self._checked[site_id] = now
+        if tree is not None and (
+                cache.get(rule_version_key(site_id)) == tree.version):
+            return tree
+        return self.refresh(site_id)
+
+    def refresh(self, site_id):
+        """
+        Loads a new tree for the site and swaps it in. If another thread is
+        already loading one, returns the current tree instead of waiting,
+        unless there is none yet.
+        """
+        tree = self._trees.get(site_id)
+        with self._lock:
+            loading = self._loading.setdefault(site_id, threading.Lock())
+        if not loading.acquire(tree is None):
+            return tree
+        try:
+            current = self._trees.get(site_id)
+            if current is not tree:
+                # swapped in by another thread while this one waited
+                return current
+            tree = RuleTree.load(site_id)
+            self._trees[site_id] = tree
+            self._checked[site_id] = time.time()
+            return tree
+        finally:
+            loading.release()
+
+    def match(self, site_id, path):
+        """Returns :meth:`RuleTree.match` for the site's current tree"""
+        return self.get(site_id).match(path)
+
+    def invalidate(self, site_id):
+        """Drops the site's tree, so that the next lookup reloads it"""
+        self._trees.pop(site_id, None)
+        self._checked.pop(site_id, None)
+
+    def clear(self):
+        self._trees.clear()
+        self._checked.clear()
+
+    def stats(self):
+        """Returns the :meth:`RuleTree.stats` of each loaded tree"""
+        return [tree.stats() for site_id, tree in sorted(self._trees.items())]
+
+
+rule_trees = RuleTrees()
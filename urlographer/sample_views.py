@@ -6,6 +6,10 @@ def sample_view(request, **kwargs):
     return HttpResponse('test value=' + kwargs['test_val'])
 
 
+def sample_suffix_view(request, path_suffix):
+    return HttpResponse('path suffix=' + path_suffix)
+
+
 class SampleClassView(View):
     test_val = 'not set'
 
@@ -1,20 +1,109 @@
+"""
+Celery tasks. Redirect maintenance tasks can also run as parallel shards over
+id ranges with :func:`run_sharded`, each shard recording its progress in a
+checkpoint so that an interrupted run can resume where it stopped.
+"""
+from uuid import uuid4
 
+from celery import chord
 from celery.task import Task
+from celery.utils.log import get_task_logger
 
+from django.conf import settings
 from django.contrib.admin.models import (
     CHANGE,
     LogEntry
 )
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.encoding import smart_text
+
+from urlographer.models import (
+    IN_CLAUSE_SIZE,
+    REDIRECT_STATUS_CODES,
+    URLMap,
+    chunks,
+    invalidate_urlmaps
+)
+
+logger = get_task_logger(__name__)
+
+# number of shards run_sharded splits a job into by default
+settings.URLOGRAPHER_JOB_SHARDS = getattr(
+    settings, 'URLOGRAPHER_JOB_SHARDS', 8)
+# seconds the plan and checkpoints of a sharded job are kept in the cache,
+# i.e. how long an interrupted job can be resumed
+settings.URLOGRAPHER_JOB_CHECKPOINT_TIMEOUT = getattr(
+    settings, 'URLOGRAPHER_JOB_CHECKPOINT_TIMEOUT', 7 * 24 * 3600)
+
+
+def job_key(job_id, name):
+    return '%sjob:%s:%s' % (settings.URLOGRAPHER_CACHE_PREFIX, job_id, name)
+
+
+def get_checkpoint(job_id, start):
+    """Returns the checkpoint of the shard of a job starting at start"""
+    return cache.get(job_key(job_id, 'shard-%s' % start))
+
+
+def set_checkpoint(job_id, start, checkpoint):
+    cache.set(job_key(job_id, 'shard-%s' % start), checkpoint,
+              settings.URLOGRAPHER_JOB_CHECKPOINT_TIMEOUT)
+
+
+def plan_shards(queryset, shards):
+    """
+    Splits the id range of queryset into at most *shards* (start, end)
+    ranges of equal length, start included and end excluded
+    """
+    bounds = queryset.aggregate(low=Min('id'), high=Max('id'))
+    if bounds['low'] is None:
+        return []
+    size = (bounds['high'] - bounds['low']) // shards + 1
+    return [(start, min(start + size, bounds['high'] + 1))
+            for start in xrange(bounds['low'], bounds['high'] + 1, size)]
 
-from urlographer.models import URLMap
+
+def run_sharded(task, queryset, job_id=None, shards=None, **kwargs):
+    """
+    Runs task in parallel over the id range of queryset, split into *shards*
+    (by default :attr:`~urlographer.tasks.settings.URLOGRAPHER_JOB_SHARDS`),
+    as a celery chord whose callback is :class:`SummarizeJobTask`. The task
+    is called with *start*, *end* and *job_id* in addition to kwargs.
+
+    Passing the *job_id* of an interrupted job resumes it: the shards planned
+    when it was first run are reused, and each shard skips what its
+    checkpoint records as done. Returns the AsyncResult of the summary.
+    """
+    job_id = job_id or uuid4().hex
+    plan = cache.get(job_key(job_id, 'plan'))
+    if plan is None:
+        plan = plan_shards(queryset, shards or settings.URLOGRAPHER_JOB_SHARDS)
+        cache.set(job_key(job_id, 'plan'), plan,
+                  settings.URLOGRAPHER_JOB_CHECKPOINT_TIMEOUT)
+    summary = SummarizeJobTask.subtask(kwargs={'job_id': job_id})
+    if not plan:
+        return summary.delay([])
+    return chord(
+        task.subtask(kwargs=dict(kwargs, start=start, end=end, job_id=job_id))
+        for start, end in plan)(summary)
+
+
+def redirect_urlmaps():
+    """Returns the URLMaps that redirect to another URLMap"""
+    return URLMap.objects.filter(
+        status_code__in=REDIRECT_STATUS_CODES,
+        redirect__isnull=False).order_by()
 
 
 class FixRedirectLoopsTask(Task):
     """
-    Task to automatically fix redirect loops.
+    Task to automatically fix redirect chains, of any length.
 
     Example scenario:
 
@@ -23,12 +112,21 @@ class FixRedirectLoopsTask(Task):
     B
     C -> A
     D -> C -> A
+    E -> D -> C -> A
 
     After:
     A
     B
     C -> A
     D -> A
+    E -> A
+
+    The redirects are loaded once and followed in memory. Redirects leading
+    into a loop are left alone, and the loops are logged and returned.
+
+    Run it over all the redirects with
+    ``run_sharded(FixRedirectLoopsTask, redirect_urlmaps())`` to split the
+    work across workers (see :func:`run_sharded`).
     """
 
     user_username = 'fix_redirect_loops_task'
@@ -40,28 +138,218 @@ class FixRedirectLoopsTask(Task):
             return User.objects.create_user(
                 self.user_username, 'dev@consumeraffairs.com')
 
-    def get_urlmaps_2_hops(self):
-        qs_filters = {
-            'redirect__status_code__range': (300, 399),
-            'redirect__redirect__status_code__in': (200, 410)}
-        return URLMap.objects.filter(**qs_filters)
+    def get_redirects(self, start=None, end=None):
+        """
+        Returns a dict mapping the id of every redirecting URLMap with an id
+        from start up to end, by default all of them, to the id of the URLMap
+        it redirects to. With a range, the redirects these lead to outside of
+        it are included too, loaded with a query per hop.
+        """
+        queryset = redirect_urlmaps()
+        if start is None and end is None:
+            return dict(queryset.values_list('id', 'redirect_id').iterator())
+        if start is not None:
+            queryset = queryset.filter(id__gte=start)
+        if end is not None:
+            queryset = queryset.filter(id__lt=end)
+        redirects = dict(queryset.values_list('id', 'redirect_id').iterator())
+        known = set(redirects)
+        missing = set(redirects.itervalues()) - known
+        while missing:
+            known.update(missing)
+            found = {}
+            for ids in chunks(missing):
+                found.update(redirect_urlmaps().filter(
+                    id__in=ids).values_list('id', 'redirect_id'))
+            redirects.update(found)
+            missing = set(found.itervalues()) - known
+        return redirects
 
-    def run(self):
-        for urlmap in self.get_urlmaps_2_hops():
-            content_type_id = ContentType.objects.get_for_model(urlmap).pk
+    def get_targets(self, redirects):
+        """
+        Follows every chain of redirects (see :meth:`get_redirects`), each
+        URLMap once. Returns a dict mapping the ids of the redirects that are
+        not pointed at the end of their chain to the id of that end, and a
+        list of the loops found, each as a list of ids.
+        """
+        ends = {}
+        loops = []
+        for start in redirects:
+            chain = []
+            positions = {}
+            id = start
+            while id in redirects and id not in ends:
+                if id in positions:
+                    loop = chain[positions[id]:]
+                    loops.append(loop)
+                    for loop_id in loop:
+                        ends[loop_id] = None
+                    break
+                positions[id] = len(chain)
+                chain.append(id)
+                id = redirects[id]
+            end = ends.get(id, id)
+            for id in chain:
+                ends.setdefault(id, end)
+        targets = dict((id, end) for id, end in ends.iteritems()
+                       if end is not None and end != redirects[id])
+        return targets, loops
+
+    def fix_redirects(self, targets, batch_size=IN_CLAUSE_SIZE,
+                      progress=None):
+        """
+        Points each redirect at its target, given as a dict as returned by
+        :meth:`get_targets`, in order of id, *batch_size* redirects at a time,
+        with an UPDATE per target in the batch, and a LogEntry bulk_create and
+        a cache delete_many per batch. After
+        each batch, progress, if given, is called with the last id fixed and
+        the number of redirects fixed in the batch.
+        """
+        user_id = self.get_or_create_task_user().id
+        content_type_id = ContentType.objects.get_for_model(URLMap).pk
+        for ids in chunks(sorted(targets), batch_size):
+            urlmaps = list(URLMap.objects.filter(
+                id__in=ids).order_by().select_related('site').only(
+                    'site', 'site__domain', 'path', 'force_secure',
+                    'hexdigest'))
+            paths = dict(URLMap.objects.filter(
+                id__in=set(targets[id] for id in ids)).order_by().values_list(
+                    'id', 'path'))
+            by_target = {}
+            for id in ids:
+                by_target.setdefault(targets[id], []).append(id)
+            now = timezone.now()
             with transaction.atomic():
-                urlmap.redirect = urlmap.redirect.redirect
-                urlmap.on_sitemap = False
-                urlmap.save()
-                change_message = (
-                    'Updated to redirect directly to "{0}" by '
-                    'FixRedirectLoopsTask'.format(urlmap.redirect.path)
-                )
-                LogEntry.objects.log_action(
-                    user_id=self.get_or_create_task_user().id,
+                for target_id, target_ids in sorted(by_target.items()):
+                    URLMap.objects.filter(id__in=target_ids).update(
+                        redirect=target_id, on_sitemap=False, modified=now)
+                LogEntry.objects.bulk_create([LogEntry(
+                    action_time=now,
+                    user_id=user_id,
                     content_type_id=content_type_id,
-                    object_id=urlmap.id,
-                    object_repr=str(urlmap),
+                    object_id=smart_text(urlmap.id),
+                    object_repr=str(urlmap)[:200],
                     action_flag=CHANGE,
-                    change_message=change_message
-                )
+                    change_message=(
+                        'Updated to redirect directly to "{0}" by '
+                        'FixRedirectLoopsTask'.format(
+                            paths[targets[urlmap.id]]))
+                ) for urlmap in urlmaps])
+            invalidate_urlmaps(
+                [(urlmap.site_id, urlmap.hexdigest) for urlmap in urlmaps])
+            if progress:
+                progress(ids[-1], len(ids))
+
+    def run(self, batch_size=IN_CLAUSE_SIZE, start=None, end=None,
+            job_id=None):
+        """
+        Fixes the redirects with an id from start up to end, by default all
+        of them, and returns the number fixed and the loops found. With a
+        *job_id*, progress is checkpointed after each batch, and a run of the
+        same shard of the same job resumes from the checkpoint.
+        """
+        checkpoint = {'last_id': None, 'fixed': 0, 'loops': None}
+        if job_id:
+            checkpoint = get_checkpoint(job_id, start) or checkpoint
+            if checkpoint['loops'] is not None:
+                return {'fixed': checkpoint['fixed'],
+                        'loops': checkpoint['loops']}
+
+        def in_range(id):
+            return (start is None or id >= start) and (end is None or id < end)
+
+        targets, loops = self.get_targets(self.get_redirects(start, end))
+        # every loop is reported by the shard its lowest id belongs to
+        loops = [loop for loop in loops if in_range(min(loop))]
+        for loop in loops:
+            logger.warning('Redirect loop between URLMaps %s',
+                           ', '.join(str(id) for id in loop))
+        last_id = checkpoint['last_id']
+        targets = dict(
+            (id, target) for id, target in targets.iteritems()
+            if in_range(id) and (last_id is None or id > last_id))
+
+        def progress(id, count):
+            checkpoint['last_id'] = id
+            checkpoint['fixed'] += count
+            if job_id:
+                set_checkpoint(job_id, start, checkpoint)
+
+        self.fix_redirects(targets, batch_size, progress)
+        checkpoint['loops'] = loops
+        if job_id:
+            set_checkpoint(job_id, start, checkpoint)
+        return {'fixed': checkpoint['fixed'], 'loops': loops}
+
+
+class SummarizeJobTask(Task):
+    """
+    Callback of the chord run by :func:`run_sharded`: combines the dicts
+    returned by the shards, adding up their counts and concatenating their
+    lists, and keeps the summary in the cache with the job
+    """
+
+    def run(self, results, job_id=None):
+        summary = {'shards': len(results)}
+        for result in results:
+            for key, value in result.iteritems():
+                if key in summary:
+                    value = summary[key] + value
+                summary[key] = value
+        logger.info('Job %s done: %r', job_id, summary)
+        if job_id:
+            cache.set(job_key(job_id, 'summary'), summary,
+                      settings.URLOGRAPHER_JOB_CHECKPOINT_TIMEOUT)
+        return summary
+
+
+class InvalidateRedirectsTask(Task):
+    """
+    Drops the cache entries of the URLMaps redirecting to the URLMap with
+    *redirect_id*, in batches of *batch_size*, or of the URLMaps given as
+    (site id, hexdigest) pairs in *urlmaps*. Queued by
+    :meth:`~urlographer.models.URLMap.save` and
+    :meth:`~urlographer.models.URLMap.delete` for URLMaps with many
+    redirects to them. Returns the number of entries dropped.
+    """
+
+    def run(self, redirect_id=None, urlmaps=None, batch_size=IN_CLAUSE_SIZE):
+        count = 0
+        for batch in chunks(urlmaps or [], batch_size):
+            invalidate_urlmaps(batch)
+            count += len(batch)
+        if redirect_id:
+            queryset = URLMap.objects.filter(
+                redirect_id=redirect_id).order_by('pk').values_list(
+                    'id', 'site_id', 'hexdigest')
+            last_pk = 0
+            while True:
+                rows = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+                if not rows:
+                    break
+                invalidate_urlmaps([row[1:] for row in rows])
+                count += len(rows)
+                last_pk = rows[-1][0]
+        return count
+
+
+class WarmCacheTask(Task):
+    """
+    Task equivalent of the warm_urlographer_cache management command: caches
+    every URLMap of the given sites (all sites by default) with
+    :meth:`~urlographer.models.URLMapManager.warm_cache`.
+    """
+
+    def run(self, site_ids=None, batch_size=None, max_rate=None):
+        sites = Site.objects.order_by('pk')
+        if site_ids:
+            sites = sites.filter(pk__in=site_ids)
+        counts = {}
+        for site in sites:
+            def progress(count, elapsed):
+                logger.info('%s: %d URLMaps cached (%.1f/s)', site.domain,
+                            count, count / max(elapsed, 0.001))
+            counts[site.id] = URLMap.objects.warm_cache(
+                site, batch_size=batch_size, max_rate=max_rate,
+                progress=progress)
+        return counts
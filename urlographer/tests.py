@@ -13,12 +13,24 @@
 # limitations under the License.
 
 
+import json
 import mox
+import os
+import random
+import shutil
+import tempfile
+import timeit
 
 from collections import OrderedDict
+from functools import partial
+from hashlib import md5
+from StringIO import StringIO
+from unittest import skipUnless
 
+from celery import current_app
 from model_mommy import mommy, recipe
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.admin import site as admin_site
 from django.contrib.admin.models import (
@@ -28,7 +40,11 @@ from django.contrib.admin.models import (
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.core.checks import run_checks
+from django.core.checks.registry import registry
 from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import resolve
 from django.http import Http404
 from django.test.client import RequestFactory
 from django.test.utils import override_settings
@@ -38,7 +54,17 @@ from django.test import TestCase
 
 from urlographer import (
     admin,
+    apps as urlographer_apps,
+    bloom,
+    caching,
+    checks,
+    dispatch,
     models,
+    records,
+    redirectgraph,
+    routefile,
+    routetable,
+    ruletree,
     sample_views,
     tasks,
     utils,
@@ -51,6 +77,11 @@ except ImportError:
     from django.contrib.sites.models import get_current_site
 
 
+def run_on_commit(mock):
+    """Runs on_commit callbacks right away, as if each save was committed"""
+    mock.stubs.Set(models, 'on_commit', lambda func: func())
+
+
 class ContentMapTest(TestCase):
     def test_save_existing_view(self):
         content_map = models.ContentMap(view='urlographer.views.route')
@@ -61,20 +92,24 @@ class ContentMapTest(TestCase):
         self.assertRaisesMessage(
             ValidationError, 'Please enter a valid view.', content_map.clean)
 
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
     def test_save(self):
         content_map = models.ContentMap.objects.create(
             view='urlographer.views.route')
         models.URLMap.objects.create(
             site=Site.objects.get(id=1), path='/test_path',
             content_map=content_map)
-        # infinite recursion FTW
+        content_map.options = {'article_id': 3}
         mock = mox.Mox()
         mock.StubOutWithMock(models.ContentMap, 'full_clean')
-        mock.StubOutWithMock(models.URLMap, 'cache_key')
         mock.StubOutWithMock(models.cache, 'set')
         models.ContentMap.full_clean()
-        models.URLMap.cache_key().AndReturn('urlmap_key')
-        models.cache.set('urlmap_key', None, 5)
+        # only the ContentMap's own entry is updated
+        models.cache.set(
+            caching.content_map_key(content_map.id),
+            (records.RECORD_VERSION, 'urlographer.views.route',
+             {'article_id': 3}, mox.IsA(float)),
+            timeout=60)
 
         mock.ReplayAll()
         content_map.save()
@@ -82,6 +117,56 @@ class ContentMapTest(TestCase):
         mock.UnsetStubs()
         self.assertEqual(content_map.id, 1)
 
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_save_updates_cached_urlmaps(self):
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.views.route')
+        site = Site.objects.get(id=1)
+        models.URLMap.objects.create(
+            site=site, path='/test_path', content_map=content_map)
+        content_map.options = {'article_id': 3}
+        content_map.save()
+        with self.assertNumQueries(0):
+            url = models.URLMap.objects.cached_get(site, '/test_path')
+        self.assertEqual(url.options, {'article_id': 3})
+        models.cache.clear()
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_delete(self):
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.views.route')
+        content_map_id = content_map.id
+        site = Site.objects.get(id=1)
+        models.URLMap.objects.create(
+            site=site, path='/test_path', content_map=content_map)
+        content_map.delete()
+        self.assertIsNone(
+            models.cache.get(caching.content_map_key(content_map_id)))
+        # the URLMap entry left behind by the cascade is not served
+        self.assertRaises(
+            models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+            site, '/test_path')
+        models.cache.clear()
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_cached_get_many(self):
+        content_maps = [
+            models.ContentMap.objects.create(
+                view='urlographer.views.route', options={'article_id': i})
+            for i in range(2)]
+        models.cache.delete(content_maps[1].cache_key())
+        with self.assertNumQueries(1):
+            results = models.ContentMap.objects.cached_get_many(
+                [content_maps[0].id, content_maps[1].id, 1234])
+        self.assertEqual(results, {
+            content_maps[0].id: records.ContentRecord.from_content_map(
+                content_maps[0]),
+            content_maps[1].id: records.ContentRecord.from_content_map(
+                content_maps[1])})
+        with self.assertNumQueries(0):
+            models.ContentMap.objects.cached_get_many([content_maps[1].id])
+        models.cache.clear()
+
     def test_unicode(self):
         content_map = models.ContentMap(
             view='urlographer.views.route', options={'article_id': 3})
@@ -96,7 +181,7 @@ class URLMapTest(TestCase):
         self.url = models.URLMap(site=self.site, path='/test_path',
                                  force_secure=False)
         self.hexdigest = 'a6dd1406d4e5aadaafed9c2d285d36bd'
-        self.cache_key = settings.URLOGRAPHER_CACHE_PREFIX + self.hexdigest
+        self.cache_key = caching.key_prefix(self.site.id) + self.hexdigest
         self.mock = mox.Mox()
         self.mock.StubOutWithMock(models.URLMapManager, 'cached_get')
 
@@ -131,6 +216,12 @@ class URLMapTest(TestCase):
         self.assertEqual(
             self.url.hexdigest, self.hexdigest)
 
+    def test_set_hexdigest_without_site(self):
+        url = models.URLMap(site_id=self.site.id, path='/test_path')
+        with self.assertNumQueries(0):
+            url.set_hexdigest()
+        self.assertEqual(url.hexdigest, self.hexdigest)
+
     def test_cache_key(self):
         self.url.hexdigest = 'a6dd1406d4e5aadaafed9c2d285d36bd'
         self.assertEqual(self.url.cache_key(), self.cache_key)
@@ -149,7 +240,9 @@ class URLMapTest(TestCase):
         self.assertFalse(self.url.hexdigest)
         self.mock.StubOutWithMock(models.cache, 'set')
         models.cache.set(
-            self.cache_key, self.url,
+            self.cache_key,
+            (records.RECORD_VERSION, 1, 204, False,
+             'http://example.com/test_path', None, None, None),
             timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
         self.mock.ReplayAll()
         self.url.save()
@@ -205,8 +298,8 @@ class URLMapTest(TestCase):
         self.url.site = self.site
         self.url.status_code = 204
         self.url.save()
-        self.mock.StubOutWithMock(models.cache, 'delete')
-        models.cache.delete(self.url.cache_key())
+        self.mock.StubOutWithMock(models.cache, 'delete_many')
+        models.cache.delete_many([self.url.cache_key()])
         self.mock.ReplayAll()
         self.url.delete()
         self.mock.VerifyAll()
@@ -285,25 +378,340 @@ class URLMapTest(TestCase):
             'code "410".')
 
 
+class RedirectFlatteningTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.target = mommy.make(
+            'urlographer.URLMap', site=self.site, path='/target/',
+            status_code=200,
+            content_map__view='django.views.generic.base.View')
+
+    def redirect(self, path, redirect, status_code=301):
+        return mommy.make('urlographer.URLMap', site=self.site, path=path,
+                          redirect=redirect, status_code=status_code)
+
+    def reload(self, urlmap):
+        return models.URLMap.objects.get(pk=urlmap.pk)
+
+    def test_save_points_redirect_at_end_of_chain(self):
+        first = self.redirect('/first/', self.target)
+        second = self.redirect('/second/', first, 302)
+        self.assertEqual(second.redirect, self.target)
+        self.assertEqual(self.reload(second).redirect_id, self.target.id)
+
+    def test_save_redirect_repoints_transitive_sources(self):
+        first = self.redirect('/first/', self.target)
+        second = self.redirect('/second/', first)
+        third = self.redirect('/third/', second)
+        # chains from before flattening
+        models.URLMap.objects.filter(pk=second.pk).update(redirect=first)
+        models.URLMap.objects.filter(pk=third.pk).update(redirect=second)
+        new_target = mommy.make(
+            'urlographer.URLMap', site=self.site, path='/new/',
+            status_code=200, content_map=self.target.content_map)
+
+        first.redirect = new_target
+        first.save()
+        for urlmap in (first, second, third):
+            self.assertEqual(self.reload(urlmap).redirect_id, new_target.id)
+
+    def test_repoint_redirects_queries(self):
+        middle = self.redirect('/middle/', self.target)
+        for i in range(10):
+            self.redirect('/source-%d/' % i, middle)
+        models.URLMap.objects.filter(path__startswith='/source-').update(
+            redirect=middle)
+        self.target.status_code = 410
+        # 3 levels to follow, 1 query to collect the sources, 1 UPDATE
+        with self.assertNumQueries(5):
+            self.assertEqual(self.target.repoint_redirects(), 10)
+        self.assertEqual(
+            models.URLMap.objects.filter(redirect=self.target).count(), 11)
+
+    def test_save_gone_points_sources_at_it(self):
+        first = self.redirect('/first/', self.target)
+        second = self.redirect('/second/', first)
+        models.URLMap.objects.filter(pk=second.pk).update(redirect=first)
+        self.target.status_code = 410
+        self.target.save()
+        self.assertEqual(self.reload(second).redirect_id, self.target.id)
+
+    def test_save_200_leaves_sources(self):
+        first = self.redirect('/first/', self.target)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.target.repoint_redirects(), 0)
+        self.assertEqual(self.reload(first).redirect_id, self.target.id)
+
+    def test_save_loop_raises(self):
+        first = self.redirect('/first/', self.target)
+        self.target.status_code = 301
+        self.target.redirect = first
+        self.assertRaisesMessage(
+            ValidationError, 'This redirect would create a loop',
+            self.target.save)
+        self.assertEqual(self.reload(self.target).status_code, 200)
+
+    def test_save_loop_through_chain_raises(self):
+        first = self.redirect('/first/', self.target)
+        second = self.redirect('/second/', first)
+        models.URLMap.objects.filter(pk=second.pk).update(redirect=first)
+        models.URLMap.objects.filter(pk=first.pk).update(redirect=second)
+        third = models.URLMap(site=self.site, path='/third/',
+                              status_code=301, redirect=first)
+        self.assertRaisesMessage(
+            ValidationError, 'This redirect would create a loop', third.save)
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_save_invalidates_sources(self):
+        first = self.redirect('/first/', self.target)
+        second = self.redirect('/second/', first)
+        models.URLMap.objects.filter(pk=second.pk).update(redirect=first)
+        caching.set_record(second.cache_key(),
+                           records.URLRecord.from_urlmap(second))
+        self.target.status_code = 410
+        self.target.save()
+        self.assertEqual(caching.get_entry(second.cache_key()), None)
+
+
+@override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+class RedirectInvalidationTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.target = mommy.make(
+            'urlographer.URLMap', site=self.site, path='/target/',
+            status_code=200, force_secure=False,
+            content_map__view='django.views.generic.base.View')
+        self.sources = [
+            mommy.make('urlographer.URLMap', site=self.site,
+                       path='/source-%d/' % i, status_code=301,
+                       redirect=self.target)
+            for i in range(3)]
+        self.mock = mox.Mox()
+        self.always_eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        current_app.conf.CELERY_ALWAYS_EAGER = self.always_eager
+
+    def cache_sources(self):
+        for source in self.sources:
+            caching.set_record(source.cache_key(),
+                               records.URLRecord.from_urlmap(source))
+
+    def cached_redirect_urls(self):
+        return [getattr(caching.get_entry(source.cache_key()),
+                        'redirect_url', None)
+                for source in self.sources]
+
+    def test_save_path_change_invalidates_sources(self):
+        self.cache_sources()
+        old_cache_key = self.target.cache_key()
+        self.target.path = '/new-target/'
+        self.target.save()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+        self.assertEqual(caching.get_entry(old_cache_key), None)
+        self.assertEqual(
+            caching.get_entry(self.target.cache_key()).url,
+            'http://example.com/new-target/')
+
+    def test_save_invalidates_sources_again_on_commit(self):
+        callbacks = []
+        self.mock.stubs.Set(models, 'on_commit', callbacks.append)
+        old_records = [records.URLRecord.from_urlmap(source)
+                       for source in self.sources]
+        self.target.path = '/new-target/'
+        self.target.save()
+        # a lookup before the commit still reads the old rows
+        for source, record in zip(self.sources, old_records):
+            caching.set_record(source.cache_key(), record)
+        self.assertEqual(self.cached_redirect_urls(),
+                         ['http://example.com/target/'] * 3)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    def test_save_force_secure_change_invalidates_sources(self):
+        self.cache_sources()
+        self.target.force_secure = True
+        self.target.save()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    def test_save_unchanged_url_keeps_sources(self):
+        self.cache_sources()
+        self.target.on_sitemap = False
+        self.target.save()
+        self.assertEqual(self.cached_redirect_urls(),
+                         ['http://example.com/target/'] * 3)
+
+    def test_save_loaded_urlmap(self):
+        self.cache_sources()
+        target = models.URLMap.objects.get(pk=self.target.pk)
+        target.save()
+        self.assertEqual(self.cached_redirect_urls(),
+                         ['http://example.com/target/'] * 3)
+        target.path = '/new-target/'
+        target.save()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    def test_save_deferred_url_invalidates_sources(self):
+        self.cache_sources()
+        target = models.URLMap.objects.only('id', 'site', 'hexdigest').get(
+            pk=self.target.pk)
+        target.save()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    @override_settings(URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD=2)
+    def test_save_many_sources_queues_task(self):
+        self.cache_sources()
+        run_on_commit(self.mock)
+        self.mock.ReplayAll()
+        self.target.path = '/new-target/'
+        self.target.save()
+        self.mock.VerifyAll()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    @skipUnless(hasattr(models.transaction, 'on_commit'),
+                'Django < 1.9 does not defer to the commit')
+    @override_settings(URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD=2)
+    def test_save_many_sources_waits_for_commit(self):
+        self.cache_sources()
+        self.target.path = '/new-target/'
+        self.target.save()
+        # TestCase never commits
+        self.assertEqual(self.cached_redirect_urls(),
+                         ['http://example.com/target/'] * 3)
+
+    @override_settings(URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD=2)
+    def test_save_many_sources_without_on_commit(self):
+        # Django < 1.9 has no transaction.on_commit
+        self.cache_sources()
+        self.mock.stubs.Set(models, 'transaction', object())
+        self.target.path = '/new-target/'
+        self.target.save()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    def test_delete_invalidates_sources(self):
+        legacy = mommy.make('urlographer.URLMap', site=self.site,
+                            path='/legacy/', status_code=301,
+                            redirect=self.target)
+        models.URLMap.objects.filter(pk=legacy.pk).update(
+            redirect=self.sources[0])
+        self.sources.append(legacy)
+        self.cache_sources()
+        self.target.delete()
+        self.assertEqual(self.cached_redirect_urls(), [None] * 4)
+        self.assertFalse(models.URLMap.objects.filter(
+            path__startswith='/source-').exists())
+
+    def test_delete_invalidates_canonical_cascade(self):
+        duplicate = mommy.make(
+            'urlographer.URLMap', site=self.site, path='/dup/',
+            status_code=204, canonical=self.target, force_secure=False)
+        self.sources.append(mommy.make(
+            'urlographer.URLMap', site=self.site, path='/dup-source/',
+            status_code=301, redirect=duplicate))
+        self.cache_sources()
+        caching.set_record(duplicate.cache_key(),
+                           records.URLRecord.from_urlmap(duplicate))
+        self.target.delete()
+        self.assertIsNone(caching.get_entry(duplicate.cache_key()))
+        self.assertEqual(self.cached_redirect_urls(), [None] * 4)
+        self.assertRaises(
+            models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+            self.site, '/dup/')
+
+    @override_settings(URLOGRAPHER_REDIRECT_INVALIDATION_THRESHOLD=2)
+    def test_delete_many_sources_queues_tasks(self):
+        self.cache_sources()
+        run_on_commit(self.mock)
+        self.mock.StubOutWithMock(tasks.InvalidateRedirectsTask, 'delay')
+        tasks.InvalidateRedirectsTask.delay(urlmaps=mox.Func(
+            lambda urlmaps: len(urlmaps) == 2))
+        tasks.InvalidateRedirectsTask.delay(urlmaps=mox.Func(
+            lambda urlmaps: len(urlmaps) == 1))
+        self.mock.ReplayAll()
+        self.target.delete()
+        self.mock.VerifyAll()
+
+    def test_task(self):
+        self.cache_sources()
+        self.assertEqual(
+            tasks.InvalidateRedirectsTask().run(
+                redirect_id=self.target.id, batch_size=2), 3)
+        self.assertEqual(self.cached_redirect_urls(), [None] * 3)
+
+    def test_task_urlmaps(self):
+        self.cache_sources()
+        self.assertEqual(
+            tasks.InvalidateRedirectsTask().run(urlmaps=[
+                [source.site_id, source.hexdigest]
+                for source in self.sources[:2]]), 2)
+        self.assertEqual(self.cached_redirect_urls(),
+                         [None, None, 'http://example.com/target/'])
+
+
 class URLMapManagerTest(TestCase):
     def setUp(self):
         self.site = Site.objects.get(id=1)
         self.url = models.URLMap(site=self.site, path='/test_path',
                                  force_secure=False)
         self.hexdigest = 'a6dd1406d4e5aadaafed9c2d285d36bd'
-        self.cache_key = settings.URLOGRAPHER_CACHE_PREFIX + self.hexdigest
+        self.cache_key = caching.key_prefix(self.site.id) + self.hexdigest
+        self.record = records.URLRecord(
+            1, 204, False, 'http://example.com/test_path')
         self.mock = mox.Mox()
 
     def tearDown(self):
         self.mock.UnsetStubs()
 
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_cached_get_prefetch(self):
+        models.cache.clear()
+        self.url.status_code = 204
+        self.url.save()
+        models.cache.clear()
+        slashed_key = caching.urlmap_key(
+            self.site.id,
+            caching.urlmap_hexdigest(self.site.id, '/test_path/'))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                models.URLMap.objects.cached_get(
+                    self.site, self.url.path, prefetch='/test_path/'),
+                records.URLRecord.from_urlmap(self.url))
+        self.assertEqual(caching.get_entry(slashed_key), caching.TOMBSTONE)
+        # already cached, so neither fetched again
+        models.cache.delete(self.cache_key)
+        self.mock.StubOutWithMock(models.URLMapManager, '_get_with_prefetch')
+        self.mock.ReplayAll()
+        with self.assertNumQueries(1):
+            models.URLMap.objects.cached_get(
+                self.site, self.url.path, prefetch='/test_path/')
+        self.mock.VerifyAll()
+        models.cache.clear()
+
     def test_cached_get_cache_hit(self):
         self.mock.StubOutWithMock(models.cache, 'get')
+        models.cache.get(self.cache_key).AndReturn(self.record.encode())
+        self.mock.ReplayAll()
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.mock.VerifyAll()
+        self.assertEqual(url, self.record)
+
+    def test_cached_get_cache_hit_other_version(self):
+        self.url.status_code = 204
+        self.url.save()
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(models.cache, 'set')
+        # e.g. a pickled URLMap cached by an older release
         models.cache.get(self.cache_key).AndReturn(self.url)
+        models.cache.set(
+            self.cache_key, self.record.encode(),
+            timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
         self.mock.ReplayAll()
         url = models.URLMap.objects.cached_get(self.site, self.url.path)
         self.mock.VerifyAll()
-        self.assertEqual(url, self.url)
+        self.assertEqual(url, self.record)
 
     def test_cached_get_cache_miss(self):
         self.site.save()
@@ -314,22 +722,80 @@ class URLMapManagerTest(TestCase):
         self.mock.StubOutWithMock(models.cache, 'set')
         models.cache.get(self.cache_key)
         models.cache.set(
-            self.cache_key, self.url,
+            self.cache_key, self.record.encode(),
             timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
         self.mock.ReplayAll()
         url = models.URLMap.objects.cached_get(self.site, self.url.path)
         self.mock.VerifyAll()
-        self.assertEqual(url, self.url)
+        self.assertEqual(url, self.record)
 
     def test_cached_get_does_not_exist(self):
         self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(models.cache, 'set')
         models.cache.get(self.cache_key)
+        models.cache.set(
+            self.cache_key, caching.TOMBSTONE,
+            timeout=settings.URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT)
         self.mock.ReplayAll()
         self.assertRaises(
             models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
             self.site, self.url.path)
         self.mock.VerifyAll()
 
+    @override_settings(URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT=0)
+    def test_cached_get_does_not_exist_negative_caching_disabled(self):
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(models.cache, 'set')
+        models.cache.get(self.cache_key)
+        # only long enough for the lookups waiting for the lock
+        models.cache.set(self.cache_key, caching.TOMBSTONE,
+                         timeout=caching.LOCKED_TOMBSTONE_TIMEOUT)
+        self.mock.ReplayAll()
+        self.assertRaises(
+            models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+            self.site, self.url.path)
+        self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_NOT_FOUND_CACHE_TIMEOUT=0)
+    def test_cached_get_negative_caching_disabled_no_wait(self):
+        caching.acquire_lock(self.cache_key)
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(caching.time, 'sleep')
+        models.cache.get(self.cache_key)
+        caching.time.sleep(caching.LOCK_POLL_INTERVAL)
+        # cached by the lookup holding the lock
+        models.cache.get(self.cache_key).AndReturn(caching.TOMBSTONE)
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            self.assertRaises(
+                models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+                self.site, self.url.path)
+        self.mock.VerifyAll()
+        caching.release_lock(self.cache_key)
+
+    def test_cached_get_tombstone(self):
+        self.mock.StubOutWithMock(models.cache, 'get')
+        models.cache.get(self.cache_key).AndReturn(caching.TOMBSTONE)
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            self.assertRaises(
+                models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+                self.site, self.url.path)
+        self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_save_clears_tombstone(self):
+        models.cache.clear()
+        self.assertRaises(
+            models.URLMap.DoesNotExist, models.URLMap.objects.cached_get,
+            self.site, self.url.path)
+        self.assertEqual(models.cache.get(self.cache_key), caching.TOMBSTONE)
+        self.url.status_code = 204
+        self.url.save()
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.assertEqual(url, self.record)
+        models.cache.clear()
+
     def test_cached_get_force_cache_invalidation(self):
         self.site.save()
         self.url.site = self.site
@@ -338,13 +804,1326 @@ class URLMapManagerTest(TestCase):
         self.mock.StubOutWithMock(models.cache, 'get')
         self.mock.StubOutWithMock(models.cache, 'set')
         models.cache.set(
-            self.cache_key, self.url,
+            self.cache_key, self.record.encode(),
             timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
         self.mock.ReplayAll()
         url = models.URLMap.objects.cached_get(
             self.site, self.url.path, force_cache_invalidation=True)
         self.mock.VerifyAll()
-        self.assertEqual(url, self.url)
+        self.assertEqual(url, self.record)
+
+    def test_cached_get_stale_refreshed(self):
+        self.url.status_code = 204
+        self.url.save()
+        self.record.stale_at = 1
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(models.cache, 'set')
+        models.cache.get(self.cache_key).AndReturn(self.record.encode())
+        models.cache.set(
+            self.cache_key, self.record.encode()[:-1] + (None,),
+            timeout=settings.URLOGRAPHER_CACHE_TIMEOUT)
+        self.mock.ReplayAll()
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.mock.VerifyAll()
+        self.assertEqual(url, self.record)
+        self.assertIsNone(url.stale_at)
+        # the lock was released
+        self.assertTrue(caching.acquire_lock(self.cache_key))
+        caching.release_lock(self.cache_key)
+
+    def test_cached_get_stale_served_while_locked(self):
+        self.record.stale_at = 1
+        caching.acquire_lock(self.cache_key)
+        self.mock.StubOutWithMock(models.cache, 'get')
+        models.cache.get(self.cache_key).AndReturn(self.record.encode())
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.mock.VerifyAll()
+        self.assertEqual(url, self.record)
+        self.assertEqual(url.stale_at, 1)
+        caching.release_lock(self.cache_key)
+
+    def test_cached_get_miss_waits_while_locked(self):
+        caching.acquire_lock(self.cache_key)
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(caching.time, 'sleep')
+        models.cache.get(self.cache_key)
+        caching.time.sleep(caching.LOCK_POLL_INTERVAL)
+        models.cache.get(self.cache_key)
+        caching.time.sleep(caching.LOCK_POLL_INTERVAL)
+        models.cache.get(self.cache_key).AndReturn(self.record.encode())
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.mock.VerifyAll()
+        self.assertEqual(url, self.record)
+        caching.release_lock(self.cache_key)
+
+    @override_settings(URLOGRAPHER_CACHE_LOCK_WAIT=0)
+    def test_cached_get_miss_wait_timeout(self):
+        self.url.status_code = 204
+        self.url.save()
+        caching.acquire_lock(self.cache_key)
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.assertEqual(url, self.record)
+        # the lock held by the other process is left alone
+        self.assertFalse(caching.acquire_lock(self.cache_key))
+        caching.release_lock(self.cache_key)
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=10)
+    def test_cached_get_local_cache_hit(self):
+        caching.local_cache.clear()
+        self.mock.StubOutWithMock(models.cache, 'get')
+        models.cache.get(caching.change_marker_key(self.site.id))
+        models.cache.get(self.cache_key).AndReturn(self.record.encode())
+        self.mock.ReplayAll()
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        # served from the local cache without touching the shared cache
+        url2 = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.mock.VerifyAll()
+        self.assertEqual(url, self.record)
+        self.assertIs(url2, url)
+        self.assertEqual(caching.local_cache.stats()['hits'], 1)
+        caching.local_cache.clear()
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=10)
+    def test_save_invalidates_local_cache(self):
+        caching.local_cache.clear()
+        self.url.status_code = 204
+        self.url.save()
+        models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.url.status_code = 410
+        self.url.save()
+        url = models.URLMap.objects.cached_get(self.site, self.url.path)
+        self.assertEqual(url.status_code, 410)
+        caching.local_cache.clear()
+
+
+@override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+class CachedGetManyTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.gone = models.URLMap.objects.create(
+            site=self.site, path='/gone', status_code=410, force_secure=False)
+        self.redirect = models.URLMap.objects.create(
+            site=self.site, path='/redirect', status_code=301,
+            redirect=self.gone)
+        models.cache.clear()
+        # cache one of them ahead
+        self.gone.save()
+
+    def tearDown(self):
+        models.cache.clear()
+
+    def test_cached_get_many(self):
+        paths = ['/gone', '/REDIRECT', '/redirect', '/missing']
+        with self.assertNumQueries(1):
+            results = models.URLMap.objects.cached_get_many(self.site, paths)
+        self.assertEqual(results, {
+            '/gone': records.URLRecord.from_urlmap(self.gone),
+            '/REDIRECT': records.URLRecord.from_urlmap(self.redirect),
+            '/redirect': records.URLRecord.from_urlmap(self.redirect),
+            '/missing': None})
+        self.assertEqual(results['/redirect'].redirect_url,
+                         'http://example.com/gone')
+        self.assertEqual(
+            caching.get_entry(self.redirect.cache_key()),
+            records.URLRecord.from_urlmap(self.redirect))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                models.URLMap.objects.cached_get_many(self.site, paths),
+                results)
+
+    def test_cached_get_many_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                models.URLMap.objects.cached_get_many(self.site, []), {})
+
+    def test_cached_get_many_serves_stale(self):
+        record = records.URLRecord.from_urlmap(self.gone)
+        record.stale_at = 1
+        models.cache.set(self.gone.cache_key(), record.encode())
+        with self.assertNumQueries(0):
+            results = models.URLMap.objects.cached_get_many(
+                self.site, ['/gone'])
+        self.assertEqual(results['/gone'].stale_at, 1)
+
+
+@override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+class WarmCacheTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.other_site = mommy.make('sites.Site', domain='other.com')
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'testing 1 2 3'})
+        self.target = models.URLMap.objects.create(
+            site=self.site, path='/target', content_map=content_map)
+        self.urlmaps = [self.target] + [
+            models.URLMap.objects.create(
+                site=self.site, path='/source%d' % i, status_code=301,
+                redirect=self.target)
+            for i in range(4)]
+        self.other = models.URLMap.objects.create(
+            site=self.other_site, path='/target', status_code=410)
+        models.cache.clear()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        models.cache.clear()
+
+    def test_warm_cache(self):
+        progress = []
+        # 1 query per batch, plus the one that finds no more URLMaps
+        with self.assertNumQueries(4):
+            count = models.URLMap.objects.warm_cache(
+                self.site, batch_size=2,
+                progress=lambda *args: progress.append(args[0]))
+        self.assertEqual(count, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        with self.assertNumQueries(0):
+            for urlmap in self.urlmaps:
+                self.assertEqual(
+                    models.URLMap.objects.cached_get(self.site, urlmap.path),
+                    records.URLRecord.from_urlmap(urlmap))
+        self.assertIsNone(caching.get_entry(self.other.cache_key()))
+
+    def test_warm_cache_max_rate(self):
+        self.mock.StubOutWithMock(models, 'time')
+        models.time.time().AndReturn(100)
+        models.time.time().AndReturn(100.5)
+        models.time.sleep(0.5)
+        models.time.time().AndReturn(101.5)
+        models.time.sleep(0.5)
+        models.time.time().AndReturn(102.5)
+        self.mock.ReplayAll()
+        models.URLMap.objects.warm_cache(self.site, batch_size=2, max_rate=2)
+        self.mock.VerifyAll()
+
+    def test_command(self):
+        out = StringIO()
+        call_command('warm_urlographer_cache', stdout=out)
+        self.assertIn('example.com: done, 5 URLMaps cached', out.getvalue())
+        self.assertIn('other.com: done, 1 URLMaps cached', out.getvalue())
+        self.assertTrue(caching.get_entry(self.other.cache_key()))
+
+    def test_command_site(self):
+        out = StringIO()
+        call_command('warm_urlographer_cache', sites=[self.other_site.id],
+                     stdout=out)
+        self.assertNotIn('example.com', out.getvalue())
+        self.assertTrue(caching.get_entry(self.other.cache_key()))
+        self.assertIsNone(caching.get_entry(self.target.cache_key()))
+
+    def test_task(self):
+        self.assertEqual(
+            tasks.WarmCacheTask().run(site_ids=[self.site.id], batch_size=3),
+            {self.site.id: 5})
+        self.assertTrue(caching.get_entry(self.target.cache_key()))
+
+
+class URLRecordTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'testing 1 2 3'})
+        self.target = models.URLMap.objects.create(
+            site=self.site, path='/target', content_map=self.content_map)
+
+    def test_from_urlmap_content_map(self):
+        record = records.URLRecord.from_urlmap(self.target)
+        self.assertEqual(record.id, self.target.id)
+        self.assertEqual(record.status_code, 200)
+        self.assertTrue(record.force_secure)
+        self.assertEqual(unicode(record), 'https://example.com/target')
+        self.assertIsNone(record.redirect_url)
+        self.assertEqual(record.view, 'urlographer.sample_views.sample_view')
+        self.assertEqual(record.options, {'test_val': 'testing 1 2 3'})
+
+    def test_from_urlmap_redirect(self):
+        source = models.URLMap.objects.create(
+            site=self.site, path='/source', status_code=301,
+            redirect=self.target, force_secure=False)
+        record = records.URLRecord.from_urlmap(source)
+        self.assertEqual(record.url, 'http://example.com/source')
+        self.assertEqual(record.redirect_url, 'https://example.com/target')
+        self.assertIsNone(record.view)
+        self.assertIsNone(record.options)
+
+    def test_encode_decode(self):
+        record = records.URLRecord.from_urlmap(self.target)
+        encoded = record.encode()
+        self.assertEqual(encoded[0], records.RECORD_VERSION)
+        decoded = records.URLRecord.decode(encoded)
+        self.assertEqual(decoded.content_map_id, self.content_map.id)
+        self.assertIsNone(decoded.view)
+        content = records.ContentRecord.decode(
+            records.ContentRecord.from_content_map(self.content_map).encode())
+        decoded.set_content(content)
+        self.assertEqual(decoded, record)
+
+    def test_decode_invalid(self):
+        encoded = records.URLRecord.from_urlmap(self.target).encode()
+        for value in [None, (), self.target, list(encoded),
+                      (records.RECORD_VERSION + 1,) + encoded[1:]]:
+            self.assertIsNone(records.URLRecord.decode(value))
+
+
+class EntryTimeoutTest(TestCase):
+    def setUp(self):
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def test_no_timeout(self):
+        self.assertEqual(caching.entry_timeout(0), (None, 0))
+        self.assertEqual(caching.entry_timeout(None), (None, None))
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT_JITTER=0.1,
+                       URLOGRAPHER_CACHE_STALE_TIMEOUT=60)
+    def test_jitter(self):
+        self.mock.StubOutWithMock(caching.random, 'uniform')
+        self.mock.StubOutWithMock(caching, 'time')
+        caching.random.uniform(0, 360.0).AndReturn(123.4)
+        caching.time.time().AndReturn(1000)
+        self.mock.ReplayAll()
+        self.assertEqual(caching.entry_timeout(3600), (4723, 3783))
+        self.mock.VerifyAll()
+
+
+class URLMapKeyTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.url = models.URLMap(site=self.site, path='/test_path')
+        self.url.set_hexdigest()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        caching.cache.clear()
+
+    def test_urlmap_hexdigest(self):
+        self.assertEqual(
+            caching.urlmap_hexdigest(self.site.id, '/test_path'),
+            'a6dd1406d4e5aadaafed9c2d285d36bd')
+        self.assertEqual(
+            caching.urlmap_hexdigest(self.site.id, '/test_path'),
+            self.url.hexdigest)
+
+    def test_urlmap_key(self):
+        self.assertEqual(
+            caching.urlmap_key(self.site.id, self.url.hexdigest),
+            self.url.cache_key())
+
+    def test_cached_get_without_instances(self):
+        models.URLMap.objects.create(
+            site=self.site, path='/test_path', status_code=204)
+        self.mock.StubOutWithMock(models.URLMap, 'set_hexdigest')
+        self.mock.ReplayAll()
+        models.URLMap.objects.cached_get(self.site, '/test_path')
+        models.URLMap.objects.cached_get_many(self.site, ['/test_path'])
+        self.mock.VerifyAll()
+
+    def test_faster_than_instances(self):
+        def with_instance():
+            models.URLMap(site=self.site, path='/test_path').set_hexdigest()
+
+        def without_instance():
+            caching.urlmap_hexdigest(self.site.id, '/test_path')
+
+        with_instance_time = min(
+            timeit.repeat(with_instance, number=1000, repeat=3))
+        without_instance_time = min(
+            timeit.repeat(without_instance, number=1000, repeat=3))
+        # about 40 times faster when measured
+        self.assertLess(without_instance_time * 5, with_instance_time)
+
+
+class DispatchTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.site = Site.objects.get(id=1)
+        dispatch.compiled_views.clear()
+
+    def tearDown(self):
+        dispatch.compiled_views.clear()
+
+    def test_compiled_view_function(self):
+        view = dispatch.CompiledView(
+            'urlographer.sample_views.sample_view', {'test_val': 'a'})
+        self.assertIs(view.func, sample_views.sample_view)
+        self.assertEqual(view.kwargs, {'test_val': 'a'})
+        self.assertEqual(view.name, 'urlographer.sample_views:sample_view')
+        self.assertEqual(view(self.factory.get('/')).content, 'test value=a')
+
+    def test_compiled_view_class(self):
+        options = {'initkwargs': {'test_val': 'b'}}
+        view = dispatch.CompiledView(sample_views.SampleClassView, options)
+        self.assertEqual(options, {'initkwargs': {'test_val': 'b'}})
+        self.assertEqual(view.kwargs, {})
+        self.assertEqual(view.transaction_name('POST'),
+                         'urlographer.sample_views:SampleClassView.post')
+        self.assertIs(view.transaction_name('PUT'),
+                      view.transaction_name('PUT'))
+        self.assertEqual(view(self.factory.get('/')).content, 'test value=b')
+
+    def test_compiled_views_memoized_by_version(self):
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'a'})
+        urlmap = models.URLMap.objects.create(
+            site=self.site, path='/test', content_map=content_map)
+        record = records.URLRecord.from_urlmap(urlmap)
+        view = dispatch.compiled_views.get(record)
+        self.assertIs(dispatch.compiled_views.get(
+            records.URLRecord.from_urlmap(urlmap)), view)
+
+        content_map.options = {'test_val': 'b'}
+        content_map.save()
+        record = records.URLRecord.from_urlmap(
+            models.URLMap.objects.get(pk=urlmap.pk))
+        self.assertEqual(dispatch.compiled_views.get(record).kwargs,
+                         {'test_val': 'b'})
+        self.assertEqual(dispatch.compiled_views.stats(), {
+            'hits': 1, 'misses': 2, 'size': 2, 'maxsize': 10000})
+
+    @override_settings(URLOGRAPHER_COMPILED_VIEWS_SIZE=2)
+    def test_compiled_views_bounded(self):
+        for i in range(5):
+            dispatch.compiled_views.get(records.URLRecord(
+                i, 200, False, 'http://example.com/', content_map_id=i,
+                view='urlographer.sample_views.sample_view', options={},
+                content_modified=1.0))
+        self.assertEqual(dispatch.compiled_views.stats()['size'], 2)
+
+    def test_compiled_views_without_version(self):
+        record = records.URLRecord(
+            1, 200, False, 'http://example.com/', content_map_id=1,
+            view='urlographer.sample_views.sample_view', options={})
+        self.assertIsNot(dispatch.compiled_views.get(record),
+                         dispatch.compiled_views.get(record))
+        self.assertEqual(dispatch.compiled_views.stats()['size'], 0)
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60,
+                       URLOGRAPHER_LOCAL_CACHE_SIZE=10)
+    def test_route_leaves_options_alone(self):
+        caching.local_cache.clear()
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.SampleClassView',
+            options={'initkwargs': {'test_val': 'c'}})
+        models.URLMap.objects.create(
+            site=self.site, path='/test', content_map=content_map,
+            force_secure=False)
+        for i in range(2):
+            request = self.factory.get('/test')
+            self.assertEqual(views.route(request).content, 'test value=c')
+        self.assertEqual(
+            models.URLMap.objects.cached_get(self.site, '/test').options,
+            {'initkwargs': {'test_val': 'c'}})
+        self.assertEqual(dispatch.compiled_views.stats()['hits'], 1)
+        caching.local_cache.clear()
+        models.cache.clear()
+
+    def test_compile_handler(self):
+        for handler in ['urlographer.sample_views.sample_handler',
+                        sample_views.SampleClassHandler]:
+            compiled = dispatch.compile_handler(handler)
+            self.assertIs(dispatch.compile_handler(handler), compiled)
+
+    def test_compile_handler_invalid(self):
+        for handler in [{'test': 'this'}, 3]:
+            self.assertRaises(ImproperlyConfigured,
+                              dispatch.compile_handler, handler)
+
+
+class HandlersTest(TestCase):
+    def tearDown(self):
+        dispatch.handlers.compile()
+
+    def test_compiled_at_startup(self):
+        self.assertIsInstance(apps.get_app_config('urlographer'),
+                              urlographer_apps.UrlographerConfig)
+        self.assertIn(checks.check_handlers, registry.registered_checks)
+
+    @override_settings(URLOGRAPHER_HANDLERS={
+        403: 'urlographer.sample_views.sample_handler',
+        402: sample_views.SampleClassHandler})
+    def test_get(self):
+        handler = dispatch.handlers.get(403)
+        self.assertIs(handler.view, sample_views.sample_handler)
+        self.assertIs(dispatch.handlers.get(403), handler)
+        self.assertIs(dispatch.handlers.get(402).view,
+                      sample_views.SampleClassHandler)
+        self.assertIsNone(dispatch.handlers.get(404))
+
+    @override_settings(URLOGRAPHER_HANDLERS={
+        403: 'urlographer.sample_views.sample_handler'})
+    def test_compiled_once(self):
+        dispatch.handlers.get(403)
+        mock = mox.Mox()
+        mock.StubOutWithMock(dispatch, 'compile_handler')
+        mock.ReplayAll()
+        dispatch.handlers.get(403)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+    @override_settings(URLOGRAPHER_HANDLERS={
+        403: 'urlographer.sample_views.missing_handler',
+        404: {'test': 'this'},
+        410: 'urlographer.sample_views.sample_handler'})
+    def test_errors(self):
+        self.assertRaisesMessage(
+            ImproperlyConfigured,
+            "Could not import URLOGRAPHER_HANDLERS value "
+            "'urlographer.sample_views.missing_handler'",
+            dispatch.handlers.get, 403)
+        self.assertRaisesMessage(
+            ImproperlyConfigured,
+            'URLOGRAPHER_HANDLERS values must be views or import strings',
+            dispatch.handlers.get, 404)
+        self.assertIsNotNone(dispatch.handlers.get(410))
+
+        errors = checks.check_handlers(None)
+        self.assertEqual([error.id for error in errors],
+                         ['urlographer.E001', 'urlographer.E001'])
+        self.assertEqual([error.obj for error in errors],
+                         ['URLOGRAPHER_HANDLERS[403]',
+                          'URLOGRAPHER_HANDLERS[404]'])
+        self.assertEqual([error for error in run_checks()
+                          if error.id.startswith('urlographer.')], errors)
+
+    def test_no_errors(self):
+        self.assertEqual(checks.check_handlers(None), [])
+
+    def test_nameless_handlers(self):
+        class Handler(object):
+            def __call__(self, request, response):
+                return response
+
+        handler = dispatch.compile_handler(
+            partial(sample_views.sample_handler))
+        self.assertEqual(handler.transaction_name('GET'),
+                         'functools:partial.get')
+        handler = dispatch.compile_handler(Handler())
+        self.assertEqual(handler.transaction_name('GET'),
+                         'urlographer.tests:Handler.get')
+
+
+class PathMemoTest(TestCase):
+    def setUp(self):
+        self.memo = caching.PathMemo()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def expected(self, site_id, path):
+        canonical = utils.canonicalize_path(path)
+        return canonical, caching.urlmap_hexdigest(site_id, canonical)
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=0)
+    def test_disabled(self):
+        for i in range(3):
+            self.assertEqual(self.memo.get(1, '/A//b'),
+                             self.expected(1, '/A//b'))
+        self.assertEqual(self.memo.stats(), {
+            'hits': 0, 'misses': 0, 'hit_ratio': None, 'size': 0,
+            'maxsize': 0})
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=2)
+    def test_admitted_on_second_sighting(self):
+        self.mock.StubOutWithMock(caching, 'canonicalize_path')
+        caching.canonicalize_path('/A').AndReturn('/a')
+        caching.canonicalize_path('/A').AndReturn('/a')
+        self.mock.ReplayAll()
+        for i in range(4):
+            self.assertEqual(self.memo.get(1, '/A'), self.expected(1, '/a'))
+        self.mock.VerifyAll()
+        self.assertEqual(self.memo.stats(), {
+            'hits': 2, 'misses': 2, 'hit_ratio': 0.5, 'size': 1,
+            'maxsize': 2})
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=2)
+    def test_keyed_by_site(self):
+        self.memo.get(1, '/a')
+        self.memo.get(1, '/a')
+        self.assertEqual(self.memo.get(2, '/a'), self.expected(2, '/a'))
+        self.assertEqual(self.memo.stats()['hits'], 0)
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=2)
+    def test_lru_eviction(self):
+        for path in ('/a', '/b', '/a', '/b', '/a', '/c', '/c'):
+            self.memo.get(1, path)
+        self.assertEqual(self.memo.stats()['size'], 2)
+        self.assertEqual(self.memo.stats()['hits'], 1)
+        self.memo.get(1, '/a')
+        self.assertEqual(self.memo.stats()['hits'], 2)
+        self.memo.get(1, '/b')
+        self.assertEqual(self.memo.stats()['hits'], 2)
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=10)
+    def test_unique_paths_stay_bounded(self):
+        self.memo.get(1, '/popular')
+        self.memo.get(1, '/popular')
+        for i in range(1000):
+            self.memo.get(1, '/scan/%d' % i)
+        self.assertEqual(len(self.memo._seen) + len(self.memo._old_seen), 10)
+        self.assertEqual(self.memo.stats()['size'], 1)
+        self.memo.get(1, '/popular')
+        self.assertEqual(self.memo.stats()['hits'], 1)
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=10)
+    def test_clear(self):
+        self.memo.get(1, '/a')
+        self.memo.get(1, '/a')
+        self.memo.clear()
+        self.assertEqual(self.memo.stats()['size'], 0)
+        self.assertEqual(self.memo.stats()['misses'], 0)
+
+    @override_settings(URLOGRAPHER_PATH_MEMO_SIZE=10)
+    def test_route(self):
+        caching.path_memo.clear()
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'testing 1 2 3'})
+        models.URLMap.objects.create(
+            site=Site.objects.get(id=1), path='/test_path/', status_code=200,
+            force_secure=False, content_map=content_map)
+        for i in range(3):
+            self.assertEqual(self.client.get('/test_path/').status_code, 200)
+        self.assertEqual(caching.path_memo.stats()['hits'], 1)
+        caching.path_memo.clear()
+
+
+class LocalCacheTest(TestCase):
+    def setUp(self):
+        self.local_cache = caching.LocalCache()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        caching.cache.clear()
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=0)
+    def test_disabled(self):
+        self.local_cache.set('key', 1, 'value')
+        self.assertIsNone(self.local_cache.get('key', 1))
+        self.assertEqual(self.local_cache.stats()['size'], 0)
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=2)
+    def test_lru_eviction(self):
+        self.local_cache.set('a', 1, 'A')
+        self.local_cache.set('b', 1, 'B')
+        self.assertEqual(self.local_cache.get('a', 1), 'A')
+        self.local_cache.set('c', 1, 'C')
+        self.assertEqual(self.local_cache.get('a', 1), 'A')
+        self.assertIsNone(self.local_cache.get('b', 1))
+        self.assertEqual(self.local_cache.get('c', 1), 'C')
+        self.assertEqual(
+            self.local_cache.stats(),
+            {'hits': 3, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=2,
+                       URLOGRAPHER_LOCAL_CACHE_TIMEOUT=30)
+    def test_timeout(self):
+        self.mock.StubOutWithMock(caching, 'time')
+        caching.time.time().AndReturn(100)
+        caching.time.time().AndReturn(129)
+        caching.time.time().AndReturn(130)
+        self.mock.ReplayAll()
+        self.local_cache.set('a', 1, 'A')
+        self.assertEqual(self.local_cache.get('a', 1), 'A')
+        self.assertIsNone(self.local_cache.get('a', 1))
+        self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=2,
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_change_marker_from_other_process(self):
+        self.local_cache.set('a', 1, 'A')
+        self.local_cache.set('b', 2, 'B')
+        caching.cache.set(caching.change_marker_key(1), 'other', None)
+        self.assertIsNone(self.local_cache.get('a', 1))
+        self.assertEqual(self.local_cache.get('b', 2), 'B')
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=2)
+    def test_change_marker_check_interval(self):
+        self.local_cache.set('a', 1, 'A')
+        caching.cache.set(caching.change_marker_key(1), 'other', None)
+        # the marker is not checked again until the interval has passed
+        self.assertEqual(self.local_cache.get('a', 1), 'A')
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=2)
+    def test_mark_changed(self):
+        caching.local_cache.clear()
+        caching.local_cache.set('a', 1, 'A')
+        caching.mark_changed(1)
+        self.assertIsNone(caching.local_cache.get('a', 1))
+        self.assertTrue(caching.cache.get(caching.change_marker_key(1)))
+        caching.local_cache.clear()
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=0)
+    def test_mark_changed_disabled(self):
+        caching.mark_changed(1)
+        self.assertIsNone(caching.cache.get(caching.change_marker_key(1)))
+
+
+class GenerationTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.other_site = mommy.make('sites.Site', domain='other.com')
+        self.urlmap = models.URLMap.objects.create(
+            site=self.site, path='/test_path', status_code=204)
+        self.other = models.URLMap.objects.create(
+            site=self.other_site, path='/test_path', status_code=204)
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        caching.cache.clear()
+        caching._generations.clear()
+
+    def test_key_prefix(self):
+        self.assertEqual(
+            caching.key_prefix(self.site.id), '%s%s:' % (
+                settings.URLOGRAPHER_CACHE_PREFIX,
+                caching.get_generation(self.site.id)))
+        self.assertTrue(self.urlmap.cache_key().startswith(
+            caching.key_prefix(self.site.id)))
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_bump_generation(self):
+        generation = caching.get_generation(self.site.id)
+        key = self.urlmap.cache_key()
+        other_key = self.other.cache_key()
+        models.URLMap.objects.cached_get(self.site, '/test_path')
+        models.URLMap.objects.cached_get(self.other_site, '/test_path')
+        self.assertNotEqual(caching.bump_generation(self.site.id), generation)
+        self.assertNotEqual(self.urlmap.cache_key(), key)
+        self.assertEqual(self.other.cache_key(), other_key)
+        with self.assertNumQueries(1):
+            models.URLMap.objects.cached_get(self.site, '/test_path')
+        with self.assertNumQueries(0):
+            models.URLMap.objects.cached_get(self.other_site, '/test_path')
+
+    @override_settings(URLOGRAPHER_GENERATION_CHECK_INTERVAL=0)
+    def test_generation_from_other_process(self):
+        caching.cache.set(caching.generation_key(self.site.id), 42, None)
+        self.assertEqual(caching.get_generation(self.site.id), 42)
+
+    def test_generation_check_interval(self):
+        generation = caching.get_generation(self.site.id)
+        caching.cache.set(caching.generation_key(self.site.id), 42, None)
+        # the generation is not read again until the interval has passed
+        self.assertEqual(caching.get_generation(self.site.id), generation)
+
+    @override_settings(URLOGRAPHER_GENERATION_CHECK_INTERVAL=0)
+    def test_evicted_generation(self):
+        caching.cache.delete(caching.generation_key(self.site.id))
+        self.mock.StubOutWithMock(caching, 'time')
+        caching.time.time().AndReturn(2000000000)
+        self.mock.ReplayAll()
+        self.assertEqual(
+            caching.get_generation(self.site.id), 2000000000000)
+        self.mock.VerifyAll()
+        self.assertEqual(
+            caching.cache.get(caching.generation_key(self.site.id)),
+            2000000000000)
+
+    def test_bump_generation_increments(self):
+        generation = caching.bump_generation(self.site.id)
+        self.assertEqual(
+            caching.bump_generation(self.site.id), generation + 1)
+
+    def test_command(self):
+        generation = caching.get_generation(self.other_site.id)
+        out = StringIO()
+        call_command('bump_urlographer_generation',
+                     sites=[self.other_site.id], stdout=out)
+        self.assertNotEqual(
+            caching.get_generation(self.other_site.id), generation)
+        self.assertEqual(out.getvalue().strip(), 'other.com: generation %s' % (
+            caching.get_generation(self.other_site.id)))
+
+    def test_admin_action(self):
+        generation = caching.get_generation(self.site.id)
+        other_generation = caching.get_generation(self.other_site.id)
+        admin_instance = admin.URLMapAdmin(models.URLMap, admin_site)
+        self.mock.StubOutWithMock(admin_instance, 'message_user')
+        request = RequestFactory().get('')
+        admin_instance.message_user(
+            request, 'Invalidated the cache of 1 site(s).')
+        self.mock.ReplayAll()
+        admin_instance.invalidate_site_caches(
+            request, models.URLMap.objects.filter(pk=self.urlmap.pk))
+        self.mock.VerifyAll()
+        self.assertNotEqual(caching.get_generation(self.site.id), generation)
+        self.assertEqual(
+            caching.get_generation(self.other_site.id), other_generation)
+
+
+class RouteTableTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.other_site = mommy.make('sites.Site', domain='other.com')
+        self.content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'testing 1 2 3'})
+        self.target = models.URLMap.objects.create(
+            site=self.site, path='/target', content_map=self.content_map)
+        self.source = models.URLMap.objects.create(
+            site=self.site, path='/source', status_code=301,
+            redirect=self.target)
+        self.other = models.URLMap.objects.create(
+            site=self.other_site, path='/target', status_code=410)
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        routetable.route_tables.clear()
+        caching.cache.clear()
+
+    def test_load(self):
+        table = routetable.RouteTable.load(self.site.id, batch_size=1)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get(self.target.hexdigest),
+                         records.URLRecord.from_urlmap(self.target))
+        self.assertEqual(table.get(self.source.hexdigest),
+                         records.URLRecord.from_urlmap(self.source))
+        self.assertIsNone(table.get(self.other.hexdigest))
+
+    def test_load_shares_content(self):
+        second = models.URLMap.objects.create(
+            site=self.site, path='/second', content_map=self.content_map)
+        table = routetable.RouteTable.load(self.site.id)
+        self.assertIs(table.get(second.hexdigest).options,
+                      table.get(self.target.hexdigest).options)
+        self.assertEqual(table.stats()['content_maps'], 1)
+
+    def test_stats(self):
+        stats = routetable.RouteTable.load(self.site.id).stats()
+        self.assertEqual(stats['site_id'], self.site.id)
+        self.assertEqual(stats['urlmaps'], 2)
+        self.assertEqual(stats['content_maps'], 1)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_disabled(self):
+        self.assertIsNone(routetable.route_tables.get(self.site.id))
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1])
+    def test_cached_get_without_io(self):
+        routetable.route_tables.get(self.site.id)
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.StubOutWithMock(models.cache, 'get_many')
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                models.URLMap.objects.cached_get(self.site, '/target'),
+                records.URLRecord.from_urlmap(self.target))
+            self.assertRaises(
+                models.URLMap.DoesNotExist,
+                models.URLMap.objects.cached_get, self.site, '/missing')
+            self.assertEqual(
+                models.URLMap.objects.cached_get_many(
+                    self.site, ['/source', '/missing']),
+                {'/source': records.URLRecord.from_urlmap(self.source),
+                 '/missing': None})
+        self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1])
+    def test_other_site(self):
+        with self.assertNumQueries(1):
+            models.URLMap.objects.cached_get(self.other_site, '/target')
+        self.assertIsNone(routetable.route_tables.get(self.other_site.id))
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_swap_on_urlmap_save_and_delete(self):
+        run_on_commit(self.mock)
+        table = routetable.route_tables.get(self.site.id)
+        self.target.status_code = 410
+        self.target.save()
+        self.assertEqual(models.URLMap.objects.cached_get(
+            self.site, '/target').status_code, 410)
+        self.assertIsNot(routetable.route_tables.get(self.site.id), table)
+        self.source.delete()
+        self.assertRaises(
+            models.URLMap.DoesNotExist,
+            models.URLMap.objects.cached_get, self.site, '/source')
+
+    @skipUnless(hasattr(models.transaction, 'on_commit'),
+                'Django < 1.9 does not defer to the commit')
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_marker_waits_for_commit(self):
+        marker = caching.get_marker(self.site.id)
+        self.target.status_code = 410
+        self.target.save()
+        self.content_map.save()
+        self.source.delete()
+        # TestCase never commits
+        self.assertEqual(caching.get_marker(self.site.id), marker)
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_swap_on_content_map_save(self):
+        run_on_commit(self.mock)
+        routetable.route_tables.get(self.site.id)
+        self.content_map.options = {'test_val': 'changed'}
+        self.content_map.save()
+        self.assertEqual(models.URLMap.objects.cached_get(
+            self.site, '/target').options, {'test_val': 'changed'})
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_swap_on_bump_generation(self):
+        table = routetable.route_tables.get(self.site.id)
+        caching.bump_generation(self.site.id)
+        self.assertIsNot(routetable.route_tables.get(self.site.id), table)
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1])
+    def test_check_interval(self):
+        table = routetable.route_tables.get(self.site.id)
+        caching.cache.set(caching.change_marker_key(self.site.id), 'other')
+        # the marker is not checked again until the interval has passed
+        self.assertIs(routetable.route_tables.get(self.site.id), table)
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_serves_current_table_while_loading(self):
+        table = routetable.route_tables.get(self.site.id)
+        caching.mark_changed(self.site.id)
+        loading = routetable.route_tables._loading[self.site.id]
+        loading.acquire()
+        try:
+            self.assertIs(routetable.route_tables.get(self.site.id), table)
+        finally:
+            loading.release()
+        self.assertIsNot(routetable.route_tables.get(self.site.id), table)
+
+    @override_settings(URLOGRAPHER_ROUTE_TABLE_SITES=[1])
+    def test_command(self):
+        out = StringIO()
+        call_command('urlographer_route_tables', stdout=out)
+        self.assertIn('example.com: 2 URLMaps, 1 ContentMaps', out.getvalue())
+        self.assertNotIn('other.com', out.getvalue())
+
+
+class RouteFileTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': u'testing 1 2 3 \xe9'})
+        self.target = models.URLMap.objects.create(
+            site=self.site, path='/target', content_map=self.content_map,
+            force_secure=True)
+        self.source = models.URLMap.objects.create(
+            site=self.site, path='/source', status_code=301,
+            redirect=self.target)
+        self.other = models.URLMap.objects.create(
+            site=mommy.make('sites.Site', domain='other.com'), path='/other',
+            status_code=410)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'example.routes')
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        routefile.route_files.clear()
+        caching.cache.clear()
+        shutil.rmtree(self.directory)
+
+    def test_compile_and_read(self):
+        self.assertEqual(
+            routefile.compile_route_file(self.site.id, self.path), 2)
+        route_file = routefile.RouteFile(self.path)
+        self.assertEqual(len(route_file), 2)
+        self.assertEqual(route_file.site_id, self.site.id)
+        self.assertEqual(route_file.get(self.target.hexdigest),
+                         records.URLRecord.from_urlmap(self.target))
+        self.assertEqual(route_file.get(self.source.hexdigest),
+                         records.URLRecord.from_urlmap(self.source))
+        self.assertEqual(
+            route_file.get(self.target.hexdigest).content_modified,
+            records.timestamp(self.content_map.modified))
+        self.assertIsNone(route_file.get(self.other.hexdigest))
+        self.assertEqual(os.listdir(self.directory), ['example.routes'])
+
+    def test_empty_site(self):
+        models.URLMap.objects.filter(site=self.site).delete()
+        routefile.compile_route_file(self.site.id, self.path)
+        route_file = routefile.RouteFile(self.path)
+        self.assertEqual(len(route_file), 0)
+        self.assertIsNone(route_file.get(self.target.hexdigest))
+
+    def test_not_a_route_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 100)
+        self.assertRaises(ValueError, routefile.RouteFile, self.path)
+
+    def test_cached_get_without_io(self):
+        routefile.compile_route_file(self.site.id, self.path)
+        with override_settings(URLOGRAPHER_ROUTE_FILES={1: self.path}):
+            routefile.route_files.get(self.site.id)
+            self.mock.StubOutWithMock(models.cache, 'get')
+            self.mock.ReplayAll()
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    models.URLMap.objects.cached_get(self.site, '/target'),
+                    records.URLRecord.from_urlmap(self.target))
+                self.assertRaises(
+                    models.URLMap.DoesNotExist,
+                    models.URLMap.objects.cached_get, self.site, '/missing')
+            self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_swap_on_recompile(self):
+        run_on_commit(self.mock)
+        routefile.compile_route_file(self.site.id, self.path)
+        with override_settings(URLOGRAPHER_ROUTE_FILES={1: self.path}):
+            route_file = routefile.route_files.get(self.site.id)
+            self.target.status_code = 410
+            self.target.save()
+            # the marker advanced, so the outdated file is not used
+            self.assertIsNone(routefile.route_files.get(self.site.id))
+            self.assertEqual(models.URLMap.objects.cached_get(
+                self.site, '/target').status_code, 410)
+            routefile.compile_route_file(self.site.id, self.path)
+            self.assertIsNot(
+                routefile.route_files.get(self.site.id), route_file)
+            self.assertEqual(routefile.route_files.get(self.site.id).get(
+                self.target.hexdigest).status_code, 410)
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_missing_file(self):
+        with override_settings(URLOGRAPHER_ROUTE_FILES={1: self.path}):
+            self.assertIsNone(routefile.route_files.get(self.site.id))
+            with self.assertNumQueries(1):
+                models.URLMap.objects.cached_get(self.site, '/source')
+
+    def test_command(self):
+        out = StringIO()
+        with override_settings(URLOGRAPHER_ROUTE_FILES={1: self.path}):
+            call_command('compile_urlographer_routes', stdout=out)
+        self.assertIn('example.com: 2 URLMaps compiled into %s' % self.path,
+                      out.getvalue())
+        self.assertEqual(len(routefile.RouteFile(self.path)), 2)
+
+    def test_command_output(self):
+        path = os.path.join(self.directory, 'other.routes')
+        call_command('compile_urlographer_routes', sites=[1], output=path,
+                     stdout=StringIO())
+        self.assertEqual(len(routefile.RouteFile(path)), 2)
+
+
+class BloomFilterTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.urlmap = models.URLMap.objects.create(
+            site=self.site, path='/test_path', status_code=204)
+        self.missing = models.URLMap(site=self.site, path='/missing')
+        self.missing.set_hexdigest()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        bloom.bloom_filters.clear()
+        caching.cache.clear()
+
+    def hexdigests(self, prefix, count):
+        return [md5('%s%d' % (prefix, i)).hexdigest() for i in range(count)]
+
+    def test_add_and_contains(self):
+        bloom_filter = bloom.BloomFilter(1000, 0.01)
+        added = self.hexdigests('added', 1000)
+        for hexdigest in added:
+            bloom_filter.add(hexdigest)
+        # hexdigests whose bits were all set already are not counted
+        self.assertGreater(bloom_filter.count, 990)
+        self.assertTrue(all(hexdigest in bloom_filter for hexdigest in added))
+        false_positives = sum(
+            hexdigest in bloom_filter
+            for hexdigest in self.hexdigests('other', 10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(
+            bloom_filter.expected_error_rate(), 0.01, places=2)
+
+    def test_dumps_and_loads(self):
+        bloom_filter = bloom.BloomFilter(100, 0.05)
+        bloom_filter.add(self.urlmap.hexdigest)
+        loaded = bloom.BloomFilter.loads(bloom_filter.dumps())
+        self.assertIn(self.urlmap.hexdigest, loaded)
+        self.assertNotIn(self.missing.hexdigest, loaded)
+        self.assertEqual(
+            (loaded.capacity, loaded.size, loaded.hashes, loaded.count,
+             loaded.error_rate),
+            (100, bloom_filter.size, bloom_filter.hashes, 1, 0.05))
+        self.assertRaises(ValueError, bloom.BloomFilter.loads, 'x' * 100)
+
+    def test_build(self):
+        with self.assertNumQueries(2):
+            bloom_filter = bloom.BloomFilter.build(self.site.id)
+        self.assertIn(self.urlmap.hexdigest, bloom_filter)
+        self.assertNotIn(self.missing.hexdigest, bloom_filter)
+        self.assertEqual(bloom_filter.version, caching.get_marker(1))
+        self.assertEqual(bloom_filter.error_rate, 0.01)
+
+    def test_disabled(self):
+        self.assertIsNone(bloom.bloom_filters.get(self.site.id))
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_cached_get_rejects_without_io(self):
+        bloom.bloom_filters.get(self.site.id)
+        self.mock.StubOutWithMock(models.cache, 'get')
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            self.assertRaises(
+                models.URLMap.DoesNotExist,
+                models.URLMap.objects.cached_get, self.site, '/missing')
+            self.assertEqual(
+                models.URLMap.objects.cached_get_many(
+                    self.site, ['/missing']), {'/missing': None})
+        self.mock.VerifyAll()
+        stats = bloom.bloom_filters.stats()[0]
+        self.assertEqual(stats['site_id'], self.site.id)
+        self.assertEqual((stats['checks'], stats['rejections']), (2, 2))
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_cached_get_counts_false_positives(self):
+        bloom.bloom_filters.get(self.site.id)
+        bloom.bloom_filters.add(self.site.id, self.missing.hexdigest)
+        for i in range(2):
+            self.assertRaises(
+                models.URLMap.DoesNotExist,
+                models.URLMap.objects.cached_get, self.site, '/missing')
+        self.assertEqual(
+            models.URLMap.objects.cached_get(self.site, '/test_path').id,
+            self.urlmap.id)
+        stats = bloom.bloom_filters.stats()[0]
+        self.assertEqual(stats['false_positives'], 2)
+        self.assertEqual(stats['observed_error_rate'], 1.0)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_save_adds_to_filter(self):
+        bloom.bloom_filters.get(self.site.id)
+        urlmap = models.URLMap.objects.create(
+            site=self.site, path='/new', status_code=204)
+        self.assertEqual(
+            models.URLMap.objects.cached_get(self.site, '/new').id, urlmap.id)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_catch_up_with_other_process(self):
+        bloom_filter = bloom.bloom_filters.get(self.site.id)
+        # as saved by another process
+        urlmap = models.URLMap(site=self.site, path='/new', status_code=204)
+        urlmap.set_hexdigest()
+        models.URLMap.objects.bulk_create([urlmap])
+        caching.mark_changed(self.site.id, added=urlmap.hexdigest)
+        caching.mark_changed(self.site.id)
+        with self.assertNumQueries(0):
+            self.assertIs(bloom.bloom_filters.get(self.site.id), bloom_filter)
+        self.assertIn(urlmap.hexdigest, bloom_filter)
+        self.assertEqual(bloom_filter.version, caching.get_marker(1))
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_rebuild_when_change_log_is_missing(self):
+        run_on_commit(self.mock)
+        bloom_filter = bloom.bloom_filters.get(self.site.id)
+        urlmap = models.URLMap.objects.create(
+            site=self.site, path='/new', status_code=204)
+        caching.cache.delete(
+            caching.change_log_key(self.site.id, caching.get_marker(1)))
+        rebuilt = bloom.bloom_filters.get(self.site.id)
+        self.assertIsNot(rebuilt, bloom_filter)
+        self.assertIn(urlmap.hexdigest, rebuilt)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1],
+                       URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_rebuild_after_bulk_import(self):
+        bloom_filter = bloom.bloom_filters.get(self.site.id)
+        urlmap = models.URLMap(site=self.site, path='/new', status_code=204)
+        urlmap.set_hexdigest()
+        models.URLMap.objects.bulk_create([urlmap])
+        caching.bump_generation(self.site.id)
+        rebuilt = bloom.bloom_filters.get(self.site.id)
+        self.assertIsNot(rebuilt, bloom_filter)
+        self.assertIn(urlmap.hexdigest, rebuilt)
+        self.assertEqual(
+            models.URLMap.objects.cached_get(self.site, '/new').id,
+            models.URLMap.objects.get(hexdigest=urlmap.hexdigest).id)
+        # other processes don't load the outdated stored filter either
+        bloom.bloom_filters.clear()
+        caching.bump_generation(self.site.id)
+        self.assertIsNot(bloom.bloom_filters.get(self.site.id), rebuilt)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1],
+                       URLOGRAPHER_BLOOM_FILTER_TIMEOUT=120)
+    def test_store_expires(self):
+        bloom_filter = bloom.bloom_filters.get(self.site.id)
+        self.mock.StubOutWithMock(bloom.cache, 'set')
+        bloom.cache.set(bloom.bloom_filter_key(self.site.id),
+                        (bloom_filter.version, bloom_filter.dumps()), 120)
+        self.mock.ReplayAll()
+        bloom.store(self.site.id, bloom_filter)
+        self.mock.VerifyAll()
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_filter_built_before_commit_catches_up(self):
+        callbacks = []
+        self.mock.stubs.Set(models, 'on_commit', callbacks.append)
+        # built by another process, which can't see the uncommitted URLMap
+        bloom_filter = bloom.BloomFilter.build(self.site.id)
+        urlmap = models.URLMap.objects.create(
+            site=self.site, path='/new', status_code=204)
+        self.assertEqual(caching.get_marker(1), bloom_filter.version)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(bloom.catch_up(
+            bloom_filter, self.site.id, caching.get_marker(1)))
+        self.assertIn(urlmap.hexdigest, bloom_filter)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_load_from_shared_cache(self):
+        out = StringIO()
+        call_command('build_urlographer_bloom_filters', stdout=out)
+        self.assertIn(
+            'example.com: 1 hexdigests, 1.2 KB, 7 hashes, expected false '
+            'positive rate 0.0000 (target 0.0100)', out.getvalue())
+        with self.assertNumQueries(0):
+            bloom_filter = bloom.bloom_filters.get(self.site.id)
+        self.assertIn(self.urlmap.hexdigest, bloom_filter)
+
+    @override_settings(URLOGRAPHER_BLOOM_FILTER_SITES=[1])
+    def test_serves_no_filter_while_loading(self):
+        bloom.bloom_filters.get(self.site.id)
+        bloom.bloom_filters.clear()
+        loading = bloom.bloom_filters._loading[self.site.id]
+        loading.acquire()
+        try:
+            self.assertIsNone(bloom.bloom_filters.get(self.site.id))
+        finally:
+            loading.release()
+
+
+class RedirectGraphTest(TestCase):
+    def setUp(self):
+        self.graph = redirectgraph.RedirectGraph()
+        for row in (
+                (1, None, 200, 1),
+                (2, None, 410, 1),
+                (3, 1, 301, 1),
+                (4, 3, 301, 1),
+                (5, 2, 302, 1),
+                (6, 4, 301, 1),
+                # a loop, and a redirect into it
+                (7, 8, 301, 1),
+                (8, 9, 301, 1),
+                (9, 7, 302, 1),
+                (10, 9, 301, 2),
+                # a redirect to a URLMap not loaded
+                (11, 99, 301, 2),
+                # not a redirect, despite having a redirect set
+                (12, 1, 404, 2),
+                (14, 2, 301, 2)):
+            self.graph.add(*row)
+
+    def test_analyze(self):
+        report = self.graph.analyze()
+        self.assertEqual(report['urlmaps'], 13)
+        self.assertEqual(report['redirects'], 10)
+        self.assertEqual(report['chain_lengths'], {1: 3, 2: 1, 3: 1})
+        self.assertEqual(report['loop_count'], 1)
+        self.assertEqual(report['loops'], [[7, 8, 9]])
+        self.assertEqual(report['into_loops'], 1)
+        self.assertEqual(report['dangling'], 2)
+        self.assertEqual(report['unresolved'], 1)
+        self.assertEqual(report['dangling_targets'], [
+            {'id': 2, 'site_id': 1, 'status_code': 410, 'redirects': 2}])
+        self.assertEqual(
+            set(entry['id'] for entry in report['fan_in'][:2]), set([2, 9]))
+        self.assertEqual(
+            sorted((entry['id'], entry['redirects'])
+                   for entry in report['fan_in']),
+            [(1, 1), (2, 2), (3, 1), (4, 1), (7, 1), (8, 1), (9, 2)])
+
+    def test_analyze_top(self):
+        for row in ((20, 21, 301, 1), (21, 20, 301, 1), (22, 22, 301, 1)):
+            self.graph.add(*row)
+        report = self.graph.analyze(top=2)
+        self.assertEqual(report['loop_count'], 3)
+        self.assertEqual(report['loops'], [[7, 8, 9], [20, 21]])
+        self.assertEqual(len(report['fan_in']), 2)
+
+    def test_analyze_long_chain(self):
+        graph = redirectgraph.RedirectGraph()
+        graph.add(1, None, 200, 1)
+        for id in xrange(2, 100001):
+            graph.add(id, id - 1, 301, 1)
+        report = graph.analyze()
+        self.assertEqual(len(report['chain_lengths']), 99999)
+        self.assertEqual(report['chain_lengths'][99999], 1)
+        self.assertEqual(report['dangling'], 0)
+
+    def test_index(self):
+        self.assertEqual(self.graph.index(1), 0)
+        self.assertEqual(self.graph.index(14), 12)
+        self.assertEqual(self.graph.index(13), None)
+        self.assertEqual(self.graph.index(99), None)
+
+    def make_urlmaps(self):
+        site = Site.objects.get(id=1)
+        target = mommy.make(
+            'urlographer.URLMap', site=site, path='/target/', status_code=200,
+            content_map__view='django.views.generic.base.View')
+        gone = mommy.make('urlographer.URLMap', site=site, path='/gone/',
+                          status_code=410)
+        first = mommy.make('urlographer.URLMap', site=site, path='/first/',
+                           status_code=301, redirect=target)
+        second = mommy.make('urlographer.URLMap', site=site, path='/second/',
+                            status_code=301, redirect=gone)
+        models.URLMap.objects.filter(pk=first.pk).update(redirect=second)
+        models.URLMap.objects.filter(pk=second.pk).update(redirect=first)
+        return target, gone, first, second
+
+    def test_load(self):
+        target, gone, first, second = self.make_urlmaps()
+        with self.assertNumQueries(3):
+            graph = redirectgraph.RedirectGraph.load(batch_size=2)
+        report = graph.analyze()
+        self.assertEqual(report['urlmaps'], 4)
+        self.assertEqual(report['loops'], [[first.id, second.id]])
+
+    def test_command(self):
+        target, gone, first, second = self.make_urlmaps()
+        out = StringIO()
+        call_command('analyze_urlographer_redirects', stdout=out)
+        self.assertIn('4 URLMaps, 2 redirects', out.getvalue())
+        self.assertIn('1 redirect loop(s), 0 redirect(s) leading into them',
+                      out.getvalue())
+        self.assertIn('/first/ (%d) -> /second/ (%d) -> /first/ (%d)' % (
+            first.id, second.id, first.id), out.getvalue())
+        self.assertIn('/first/ (%d, site 1, 301): 1 redirect(s)' % first.id,
+                      out.getvalue())
+
+    def test_command_json(self):
+        target, gone, first, second = self.make_urlmaps()
+        out = StringIO()
+        call_command('analyze_urlographer_redirects', json=True, top=1,
+                     sites=[1], stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['loop_count'], 1)
+        self.assertEqual(report['loops'], [[
+            {'id': first.id, 'path': '/first/'},
+            {'id': second.id, 'path': '/second/'}]])
+        self.assertEqual(len(report['fan_in']), 1)
+        self.assertEqual(report['fan_in'][0]['path'], '/first/')
 
 
 class RouteTest(TestCase):
@@ -360,6 +2139,7 @@ class RouteTest(TestCase):
         request = self.factory.get('/404/', follow=True)
         self.assertEqual(request.path, '/404/')
         self.assertRaises(Http404, views.route, request)
+        self.assertEqual(request.urlrecord.status_code, 404)
 
     def test_route_gone(self):
         models.URLMap.objects.create(
@@ -412,6 +2192,36 @@ class RouteTest(TestCase):
         self.assertEqual(response._headers['location'][1],
                          'http://example.com/target')
 
+    def test_route_content_map_num_queries(self):
+        content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'testing 1 2 3'})
+        models.URLMap.objects.create(
+            site=self.site, path='/test', content_map=content_map,
+            force_secure=False)
+        request = self.factory.get('/test')
+        get_current_site(request)
+        with self.assertNumQueries(1):
+            response = views.route(request)
+        self.assertEqual(response.content, 'test value=testing 1 2 3')
+
+    def test_route_redirects_num_queries(self):
+        other_site = mommy.make('sites.Site', domain='other.com')
+        target = models.URLMap.objects.create(
+            site=other_site, path='/target', status_code=204,
+            force_secure=False)
+        for status_code in (301, 302):
+            path = '/source%d' % status_code
+            models.URLMap.objects.create(
+                site=self.site, path=path, redirect=target,
+                status_code=status_code, force_secure=False)
+            request = self.factory.get(path)
+            get_current_site(request)
+            with self.assertNumQueries(1):
+                response = views.route(request)
+            self.assertEqual(response.status_code, status_code)
+            self.assertEqual(response['Location'], 'http://other.com/target')
+
     def test_content_map_class_based_view(self):
         content_map = models.ContentMap(
             view='urlographer.sample_views.SampleClassView')
@@ -425,6 +2235,47 @@ class RouteTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content, 'test value=testing 1 2 3')
 
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_SIZE=10)
+    def test_content_map_class_based_view_local_cache(self):
+        caching.local_cache.clear()
+        content_map = models.ContentMap(
+            view='urlographer.sample_views.SampleClassView')
+        content_map.options['initkwargs'] = {
+            'test_val': 'testing 1 2 3'}
+        content_map.save()
+        models.URLMap.objects.create(
+            site=self.site, path='/test', content_map=content_map,
+            force_secure=False)
+        for i in range(2):
+            response = views.route(self.factory.get('/test'))
+            self.assertEqual(response.content, 'test value=testing 1 2 3')
+        self.assertEqual(caching.local_cache.stats()['hits'], 1)
+        caching.local_cache.clear()
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_route_from_cached_record(self):
+        models.cache.clear()
+        target = models.URLMap.objects.create(
+            site=self.site, path='/target', status_code=204,
+            force_secure=False)
+        models.URLMap.objects.create(
+            site=self.site, path='/source', redirect=target, status_code=301,
+            force_secure=False)
+        request = self.factory.get('/source')
+        get_current_site(request)
+        with self.assertNumQueries(0):
+            response = views.route(request)
+        self.assertEqual(response['Location'], 'http://example.com/target')
+        with self.assertNumQueries(0):
+            self.assertEqual(request.urlrecord.redirect_url,
+                             'http://example.com/target')
+        # the URLMap is only fetched when used, along with its relations
+        with self.assertNumQueries(1):
+            self.assertEqual(request.urlmap.redirect_id, target.id)
+            self.assertEqual(request.urlmap.redirect.site, self.site)
+            self.assertEqual(request.urlmap.site, self.site)
+        models.cache.clear()
+
     def test_content_map_view_function(self):
         content_map = models.ContentMap(
             view='urlographer.sample_views.sample_view')
@@ -533,14 +2384,14 @@ class RouteTest(TestCase):
         path = '/test'
         request = self.factory.get(path)
         site = get_current_site(request)
-        url_map = models.URLMap(site=site, path=path, status_code=204,
-                                force_secure=False)
+        url_map = records.URLRecord(1, 204, False, 'http://example.com/test')
         self.mock.StubOutWithMock(views, 'force_cache_invalidation')
         self.mock.StubOutWithMock(models.URLMapManager, 'cached_get')
         views.force_cache_invalidation(request).AndReturn(True)
         models.URLMapManager.cached_get(
-            site, path, force_cache_invalidation=True).AndReturn(
-                url_map)
+            site, path, force_cache_invalidation=True,
+            hexdigest=caching.urlmap_hexdigest(site.id, path),
+            prefetch='/test/').AndReturn(url_map)
         self.mock.ReplayAll()
         response = views.route(request)
         self.assertEqual(response.status_code, 204)
@@ -560,6 +2411,52 @@ class RouteTest(TestCase):
         self.assertRedirects(response, '/fake_page/', status_code=301,
                              fetch_redirect_response=False)
 
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_append_slash_prefetches_slashed(self):
+        models.cache.clear()
+        models.URLMap.objects.create(
+            site=self.site, path='/page/', status_code=204,
+            force_secure=False)
+        models.cache.clear()
+        request = self.factory.get('/page')
+        get_current_site(request)
+        with self.assertNumQueries(1):
+            response = views.route(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'], '/page/')
+        with self.assertNumQueries(0):
+            response = views.route(self.factory.get('/page/'))
+        self.assertEqual(response.status_code, 204)
+        models.cache.clear()
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_append_slash_prefetches_path_info(self):
+        urlmap = models.URLMap.objects.create(
+            site=self.site, path='/page/', status_code=204,
+            force_secure=False)
+        models.cache.clear()
+        request = self.factory.get('/page', SCRIPT_NAME='/prefix')
+        response = views.route(request)
+        self.assertEqual(response['Location'], '/page/')
+        self.assertEqual(caching.get_entry(urlmap.cache_key()),
+                         records.URLRecord.from_urlmap(urlmap))
+        models.cache.clear()
+
+    def test_append_slash_single_cache_round_trip(self):
+        record = records.URLRecord(1, 204, False, 'http://example.com/page')
+        key = caching.urlmap_key(
+            self.site.id, caching.urlmap_hexdigest(self.site.id, '/page'))
+        slashed_key = caching.urlmap_key(
+            self.site.id, caching.urlmap_hexdigest(self.site.id, '/page/'))
+        self.mock.StubOutWithMock(models.cache, 'get_many')
+        models.cache.get_many([key, slashed_key]).AndReturn(
+            {key: record.encode()})
+        self.mock.ReplayAll()
+        with self.assertNumQueries(0):
+            response = views.route(self.factory.get('/page'))
+        self.mock.VerifyAll()
+        self.assertEqual(response.status_code, 204)
+
     @override_settings(
         URLOGRAPHER_HANDLERS={
             403: 'urlographer.sample_views.sample_handler'})
@@ -669,6 +2566,206 @@ class RouteTest(TestCase):
         self.assertEqual(request.urlmap, urlmap)
 
 
+class RuleTreeTest(TestCase):
+    def setUp(self):
+        self.tree = ruletree.RuleTree()
+        self.rules = {}
+        for id, pattern in enumerate([
+                '/reviews/old-brand/*', '/reviews/old-brand/keep/',
+                '/reviews/*/specs/', '/reviews/*/specs/*', '/reviews/a/*',
+                '/*']):
+            self.rules[pattern] = ruletree.RuleRecord(id, pattern, 301)
+            self.tree.add(self.rules[pattern])
+
+    def assertMatch(self, path, pattern, suffix):
+        self.assertEqual(self.tree.match(path),
+                         (self.rules[pattern], suffix))
+
+    def test_prefix(self):
+        self.assertMatch('/reviews/old-brand/', '/reviews/old-brand/*', '')
+        self.assertMatch('/reviews/old-brand/x/y/', '/reviews/old-brand/*',
+                         'x/y/')
+        self.assertMatch('/reviews/old-brand/keep', '/reviews/old-brand/*',
+                         'keep')
+
+    def test_exact_wins_over_prefix(self):
+        self.assertMatch('/reviews/old-brand/keep/',
+                         '/reviews/old-brand/keep/', '')
+
+    def test_wildcard_segment(self):
+        self.assertMatch('/reviews/b/specs/', '/reviews/*/specs/', '')
+        self.assertMatch('/reviews/b/specs/x', '/reviews/*/specs/*', 'x')
+
+    def test_first_literal_segment_wins(self):
+        self.assertMatch('/reviews/a/specs/', '/reviews/a/*', 'specs/')
+        self.assertMatch('/reviews/b/specs/', '/reviews/*/specs/', '')
+        self.assertMatch('/reviews/old-brand/specs/',
+                         '/reviews/old-brand/*', 'specs/')
+
+    def test_fallback(self):
+        self.assertMatch('/', '/*', '')
+        self.assertMatch('/reviews', '/*', 'reviews')
+        self.assertMatch('/reviews//specs/', '/*', 'reviews//specs/')
+        self.assertMatch('/reviews/old-brand', '/*', 'reviews/old-brand')
+
+    def test_no_match(self):
+        tree = ruletree.RuleTree()
+        self.assertIsNone(tree.match('/reviews/'))
+        tree.add(ruletree.RuleRecord(1, '/reviews/*/specs/', 410))
+        self.assertIsNone(tree.match('/reviews/'))
+        self.assertIsNone(tree.match('/reviews/a/specs'))
+        self.assertIsNone(tree.match('/reviews/a/specs/x'))
+
+    def test_replace(self):
+        self.assertEqual(len(self.tree), 6)
+        record = ruletree.RuleRecord(10, '/reviews/a/*', 410)
+        self.tree.add(record)
+        self.assertEqual(len(self.tree), 6)
+        self.assertEqual(self.tree.match('/reviews/a/b'), (record, 'b'))
+
+    def test_record(self):
+        record = ruletree.RuleRecord(1, '/a/*', 301, '/b/')
+        self.assertEqual(record.redirect_url('c/'), '/b/')
+        self.assertEqual(record.view_kwargs('c/'), {})
+        record.carry_suffix = True
+        self.assertEqual(record.redirect_url('c/'), '/b/c/')
+        self.assertEqual(record.view_kwargs('c/'), {'path_suffix': 'c/'})
+
+
+class URLRuleTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get(id=1)
+        self.factory = RequestFactory()
+        self.content_map = models.ContentMap.objects.create(
+            view='urlographer.sample_views.sample_view',
+            options={'test_val': 'rule'})
+        ruletree.rule_trees.clear()
+        self.mock = mox.Mox()
+        run_on_commit(self.mock)
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        ruletree.rule_trees.clear()
+        models.cache.clear()
+
+    @skipUnless(hasattr(models.transaction, 'on_commit'),
+                'Django < 1.9 does not defer to the commit')
+    def test_version_waits_for_commit(self):
+        self.mock.UnsetStubs()
+        version = ruletree.rule_trees.get(self.site.id).version
+        models.URLRule.objects.create(
+            site=self.site, pattern='/old/*', status_code=410)
+        # TestCase never commits
+        self.assertEqual(
+            models.cache.get(ruletree.rule_version_key(self.site.id)),
+            version)
+
+    def test_clean(self):
+        rule = models.URLRule(site=self.site, pattern='//Reviews/Old//*',
+                              redirect_to='/reviews/new/')
+        rule.full_clean()
+        self.assertEqual(rule.pattern, '/reviews/old/*')
+
+    def test_clean_errors(self):
+        for kwargs, field in [
+                ({'pattern': '/reviews/old*'}, 'pattern'),
+                ({'pattern': 'reviews/*'}, 'pattern'),
+                ({'pattern': '/reviews/', 'carry_suffix': True},
+                 'carry_suffix'),
+                ({'pattern': '/reviews/*', 'redirect_to': ''}, 'redirect_to'),
+                ({'pattern': '/reviews/*', 'status_code': 200},
+                 'content_map')]:
+            kwargs.setdefault('redirect_to', '/new/')
+            rule = models.URLRule(site=self.site, **kwargs)
+            with self.assertRaises(ValidationError) as context:
+                rule.full_clean()
+            self.assertIn(field, context.exception.message_dict)
+
+    def test_save_and_delete_reload(self):
+        self.assertIsNone(ruletree.rule_trees.match(self.site.id, '/a/b'))
+        rule = models.URLRule.objects.create(
+            site=self.site, pattern='/a/*', redirect_to='/b/')
+        self.assertEqual(
+            ruletree.rule_trees.match(self.site.id, '/a/b')[0].id, rule.id)
+        version = models.cache.get(ruletree.rule_version_key(self.site.id))
+        self.assertIsNotNone(version)
+        with self.assertNumQueries(0):
+            ruletree.rule_trees.match(self.site.id, '/a/b')
+        rule.delete()
+        self.assertEqual(
+            models.cache.get(ruletree.rule_version_key(self.site.id)),
+            version + 1)
+        self.assertIsNone(ruletree.rule_trees.match(self.site.id, '/a/b'))
+
+    @override_settings(URLOGRAPHER_LOCAL_CACHE_CHECK_INTERVAL=0)
+    def test_reloaded_when_changed_elsewhere(self):
+        models.URLRule.objects.create(
+            site=self.site, pattern='/a/*', redirect_to='/b/')
+        ruletree.rule_trees.get(self.site.id)
+        models.URLRule.objects.filter(pattern='/a/*').update(
+            redirect_to='/c/')
+        self.assertEqual(ruletree.rule_trees.match(
+            self.site.id, '/a/b')[0].redirect_to, '/b/')
+        ruletree.mark_rules_changed(self.site.id)
+        self.assertEqual(ruletree.rule_trees.match(
+            self.site.id, '/a/b')[0].redirect_to, '/c/')
+        self.assertEqual(ruletree.rule_trees.stats()[0]['rules'], 1)
+
+    def test_route_redirect_with_suffix(self):
+        rule = models.URLRule.objects.create(
+            site=self.site, pattern='/reviews/old-brand/*',
+            redirect_to='/reviews/new-brand/', carry_suffix=True)
+        request = self.factory.get('/reviews/old-brand/some-product/')
+        response = views.route(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'],
+                         '/reviews/new-brand/some-product/')
+        self.assertEqual(request.urlmap.status_code, 301)
+        self.assertEqual(request.urlrule, rule)
+
+    def test_route_status_code(self):
+        models.URLRule.objects.create(
+            site=self.site, pattern='/reviews/*/specs/', status_code=410)
+        response = views.route(self.factory.get('/reviews/a/specs/'))
+        self.assertEqual(response.status_code, 410)
+
+    def test_route_content_map(self):
+        models.URLRule.objects.create(
+            site=self.site, pattern='/rules/*', status_code=200,
+            content_map=self.content_map)
+        response = views.route(self.factory.get('/rules/a/'))
+        self.assertEqual(response.content, 'test value=rule')
+
+    def test_route_content_map_with_suffix(self):
+        models.URLRule.objects.create(
+            site=self.site, pattern='/rules/*', status_code=200,
+            content_map=models.ContentMap.objects.create(
+                view='urlographer.sample_views.sample_suffix_view'),
+            carry_suffix=True)
+        response = views.route(self.factory.get('/rules/a/b/'))
+        self.assertEqual(response.content, 'path suffix=a/b/')
+
+    def test_route_urlmap_wins(self):
+        models.URLRule.objects.create(
+            site=self.site, pattern='/rules/*', status_code=410)
+        models.URLMap.objects.create(
+            site=self.site, path='/rules/a/', content_map=self.content_map,
+            force_secure=False)
+        response = views.route(self.factory.get('/rules/a/'))
+        self.assertEqual(response.content, 'test value=rule')
+
+    def test_route_content_map_gone(self):
+        rule = models.URLRule.objects.create(
+            site=self.site, pattern='/rules/*', status_code=200,
+            content_map=self.content_map)
+        ruletree.rule_trees.get(self.site.id)
+        models.ContentMap.objects.filter(pk=self.content_map.pk).delete()
+        models.cache.clear()
+        self.assertRaises(Http404, views.route,
+                          self.factory.get('/rules/a/'))
+        self.assertFalse(models.URLRule.objects.filter(pk=rule.pk).exists())
+
+
 class GetRedirectUrlWithQueryStringTest(TestCase):
 
     def setUp(self):
@@ -719,6 +2816,49 @@ class CanonicalizePathTest(TestCase):
     def test_non_ascii(self):
         self.assertEqual(utils.canonicalize_path(u'/te\xa0\u2013st'), '/test')
 
+    def test_edge_cases(self):
+        for path, canonical in (
+                ('', ''),
+                ('/', '/'),
+                ('///', '/'),
+                ('/a/..', '/a/..'),
+                ('/a/.', '/a/.'),
+                ('/a/../', '/'),
+                ('/../../a', '/a'),
+                ('a/b', 'a/b'),
+                ('a/b/../c', '/c'),
+                ('././a', '/a'),
+                (u'/\xe9./b', '/./b')):
+            self.assertEqual(utils.canonicalize_path(path), canonical)
+
+    def test_matches_previous_implementation(self):
+        def previous_canonicalize_path(path):
+            while '//' in path:
+                path = path.replace('//', '/')
+            if path.startswith('./'):
+                path = path[1:]
+            elif path.startswith('../'):
+                path = path[2:]
+            while '/./' in path:
+                path = path.replace('/./', '/')
+            while '/../' in path:
+                pre, post = path.split('/../', 1)
+                if pre.startswith('/') and '/' in pre[1:]:
+                    pre = '/'.join(pre.split('/')[:-1])
+                    path = '/'.join([pre, post])
+                else:
+                    path = '/' + post
+            return utils.force_ascii(path.lower())
+
+        pieces = ['/', '//', '.', '..', '...', './', '../', '/./', '/../',
+                  'a', 'B', u'\xe9', u'\xe9.']
+        generator = random.Random(0)
+        for i in xrange(20000):
+            path = u''.join(generator.choice(pieces)
+                            for j in xrange(generator.randint(0, 12)))
+            self.assertEqual(utils.canonicalize_path(path),
+                             previous_canonicalize_path(path), repr(path))
+
 
 class ForceCacheInvalidationTest(TestCase):
     def setUp(self):
@@ -783,11 +2923,11 @@ class SitemapTest(TestCase):
         self.mock.StubOutWithMock(views.URLMap.objects, 'filter')
         self.mock.StubOutWithMock(views, 'contrib_sitemap')
         self.mock.StubOutWithMock(views, 'CustomSitemap')
-        self.mock.StubOutWithMock(views.cache, 'get')
-        self.mock.StubOutWithMock(views.cache, 'set')
         self.site = Site.objects.get_current()
         self.cache_key = '%s%s_sitemap' % (
-            settings.URLOGRAPHER_CACHE_PREFIX, self.site)
+            caching.key_prefix(self.site.id), self.site)
+        self.mock.StubOutWithMock(views.cache, 'get')
+        self.mock.StubOutWithMock(views.cache, 'set')
         self.request = self.factory.get('/sitemap.xml')
         self.mock_contrib_sitemap_response = self.mock.CreateMockAnything()
         self.mock_contrib_sitemap_response.content = '<mock>Sitemap</mock>'
@@ -908,11 +3048,22 @@ class FixRedirectLoopsTaskTest(TestCase):
         self.urlG = urlmap_recipe.make(
             path='/g/', redirect=self.urlE, status_code=302)
 
+        # saving flattens chains, so recreate the ones left over from before
+        for urlmap, redirect in ((self.urlD, self.urlC),
+                                 (self.urlF, self.urlD),
+                                 (self.urlG, self.urlE)):
+            models.URLMap.objects.filter(pk=urlmap.pk).update(
+                redirect=redirect)
+            urlmap.redirect = redirect
+
         self.task = tasks.FixRedirectLoopsTask()
         self.mock = mox.Mox()
+        self.always_eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
 
     def tearDown(self):
         self.mock.UnsetStubs()
+        current_app.conf.CELERY_ALWAYS_EAGER = self.always_eager
 
     def test_get_or_create_task_user_user_does_not_exist(self):
         self.assertEqual(
@@ -935,46 +3086,67 @@ class FixRedirectLoopsTaskTest(TestCase):
         self.assertEqual(
             User.objects.filter(username=self.task.user_username).count(), 1)
 
-    def test_get_urlmaps_2_hops(self):
-        result = self.task.get_urlmaps_2_hops()
-        self.assertQuerysetEqual(
-            result,
-            [repr(self.urlD), repr(self.urlG)],
-            ordered=False
-        )
+    def test_get_redirects(self):
+        self.assertEqual(self.task.get_redirects(), {
+            self.urlC.id: self.urlA.id,
+            self.urlD.id: self.urlC.id,
+            self.urlE.id: self.urlB.id,
+            self.urlF.id: self.urlD.id,
+            self.urlG.id: self.urlE.id})
+
+    def test_get_targets(self):
+        targets, loops = self.task.get_targets({
+            3: 1, 4: 3, 5: 2, 6: 4, 7: 5})
+        self.assertEqual(targets, {4: 1, 6: 1, 7: 2})
+        self.assertEqual(loops, [])
+
+    def test_get_targets_deep_chain(self):
+        redirects = dict((id, id - 1) for id in range(2, 10001))
+        targets, loops = self.task.get_targets(redirects)
+        self.assertEqual(len(targets), 9998)
+        self.assertEqual(set(targets.values()), set([1]))
+
+    def test_get_targets_loops(self):
+        targets, loops = self.task.get_targets({
+            1: 2, 2: 3, 3: 1, 4: 1, 5: 5, 6: 7, 7: 8})
+        self.assertEqual(targets, {6: 8})
+        self.assertEqual(
+            sorted(sorted(loop) for loop in loops), [[1, 2, 3], [5]])
 
     def test_run(self):
         task_user = mommy.make('auth.User', username=self.task.user_username)
 
         self.assertEqual(self.urlD.redirect, self.urlC)
-        self.mock.StubOutWithMock(self.task, 'get_urlmaps_2_hops')
-
-        # Expected calls:
-        self.task.get_urlmaps_2_hops().AndReturn(
-            [self.urlD, self.urlG])
-
-        self.mock.ReplayAll()
-        self.task.run()
-        self.mock.VerifyAll()
+        self.assertEqual(self.task.run(), {'fixed': 3, 'loops': []})
 
         updated_url_d = models.URLMap.objects.get(pk=self.urlD.pk)
         self.assertEqual(updated_url_d.redirect, self.urlA)
         self.assertFalse(updated_url_d.on_sitemap)
+        updated_url_f = models.URLMap.objects.get(pk=self.urlF.pk)
+        self.assertEqual(updated_url_f.redirect, self.urlA)
+        self.assertFalse(updated_url_f.on_sitemap)
         updated_url_g = models.URLMap.objects.get(pk=self.urlG.pk)
         self.assertEqual(updated_url_g.redirect, self.urlB)
         self.assertFalse(updated_url_g.on_sitemap)
+        self.assertTrue(models.URLMap.objects.get(pk=self.urlC.pk).on_sitemap)
 
         # assert LogEntry entries have been created correctly
         content_type_id = ContentType.objects.get_for_model(self.urlD).pk
         url_d_logentry = LogEntry.objects.get(object_id=self.urlD.pk)
+        url_f_logentry = LogEntry.objects.get(object_id=self.urlF.pk)
         url_g_logentry = LogEntry.objects.get(object_id=self.urlG.pk)
+        self.assertEqual(LogEntry.objects.count(), 3)
 
         self.assertEqual(url_d_logentry.user, task_user)
         self.assertEqual(url_d_logentry.content_type_id, content_type_id)
         self.assertEqual(url_d_logentry.action_flag, CHANGE)
+        self.assertEqual(url_d_logentry.object_repr, str(self.urlD))
         self.assertEqual(
             url_d_logentry.change_message,
             'Updated to redirect directly to "/a/" by FixRedirectLoopsTask')
+        self.assertEqual(
+            url_f_logentry.change_message,
+            'Updated to redirect directly to "/a/" by FixRedirectLoopsTask')
 
         self.assertEqual(url_g_logentry.user, task_user)
         self.assertEqual(url_g_logentry.content_type_id, content_type_id)
@@ -983,6 +3155,149 @@ class FixRedirectLoopsTaskTest(TestCase):
             url_g_logentry.change_message,
             'Updated to redirect directly to "/b/" by FixRedirectLoopsTask')
 
+    def test_run_nothing_to_fix(self):
+        self.task.run()
+        self.assertEqual(self.task.run(), {'fixed': 0, 'loops': []})
+        self.assertEqual(LogEntry.objects.count(), 3)
+
+    def test_run_loop(self):
+        models.URLMap.objects.filter(pk=self.urlC.pk).update(
+            redirect=self.urlF)
+        result = self.task.run()
+        self.assertEqual(result['fixed'], 1)
+        self.assertEqual(sorted(result['loops'][0]),
+                         [self.urlC.id, self.urlD.id, self.urlF.id])
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlD.pk).redirect, self.urlC)
+
+    def test_fix_redirects_batches(self):
+        mommy.make('auth.User', username=self.task.user_username)
+        ContentType.objects.get_for_model(models.URLMap)
+        targets = {self.urlD.id: self.urlA.id, self.urlF.id: self.urlA.id,
+                   self.urlG.id: self.urlB.id}
+        # the user, then per batch: 2 SELECTs, savepoint, an UPDATE per
+        # target, INSERT and savepoint release
+        with self.assertNumQueries(1 + 6 * 2):
+            self.task.fix_redirects(targets, batch_size=2)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlG.pk).redirect, self.urlB)
+
+    def test_fix_redirects_updates_per_target(self):
+        mommy.make('auth.User', username=self.task.user_username)
+        ContentType.objects.get_for_model(models.URLMap)
+        targets = {self.urlD.id: self.urlA.id, self.urlF.id: self.urlA.id,
+                   self.urlG.id: self.urlB.id}
+        with self.assertNumQueries(1 + 7):
+            self.task.fix_redirects(targets)
+        self.assertEqual(
+            [models.URLMap.objects.get(pk=id).redirect_id
+             for id in sorted(targets)],
+            [targets[id] for id in sorted(targets)])
+
+    @override_settings(URLOGRAPHER_CACHE_TIMEOUT=60)
+    def test_fix_redirects_invalidates_cache(self):
+        cache_key = self.urlF.cache_key()
+        caching.set_record(cache_key, records.URLRecord.from_urlmap(self.urlF))
+        self.task.fix_redirects({self.urlF.id: self.urlA.id})
+        self.assertEqual(caching.get_entry(cache_key), None)
+
+    def test_get_redirects_range_follows_chains_out_of_it(self):
+        self.assertEqual(
+            self.task.get_redirects(self.urlF.id, self.urlF.id + 1), {
+                self.urlF.id: self.urlD.id,
+                self.urlD.id: self.urlC.id,
+                self.urlC.id: self.urlA.id})
+
+    def test_run_range(self):
+        self.assertEqual(self.task.run(start=self.urlF.id),
+                         {'fixed': 2, 'loops': []})
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlF.pk).redirect, self.urlA)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlG.pk).redirect, self.urlB)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlD.pk).redirect, self.urlC)
+
+    def test_run_checkpoints(self):
+        self.task.run(batch_size=2, start=self.urlA.id,
+                      job_id='checkpoint-job')
+        self.assertEqual(
+            tasks.get_checkpoint('checkpoint-job', self.urlA.id),
+            {'last_id': self.urlG.id, 'fixed': 3, 'loops': []})
+
+    def test_run_resumes_from_checkpoint(self):
+        tasks.set_checkpoint('resume-job', self.urlA.id, {
+            'last_id': self.urlF.id, 'fixed': 2, 'loops': None})
+        self.assertEqual(
+            self.task.run(start=self.urlA.id, job_id='resume-job'),
+            {'fixed': 3, 'loops': []})
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlG.pk).redirect, self.urlB)
+        # the batches before the checkpoint are not fixed again
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlD.pk).redirect, self.urlC)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.task.run(start=self.urlA.id, job_id='resume-job'),
+                {'fixed': 3, 'loops': []})
+
+    def test_plan_shards(self):
+        low = self.urlA.id
+        self.assertEqual(
+            tasks.plan_shards(models.URLMap.objects.all(), 3),
+            [(low, low + 3), (low + 3, low + 6), (low + 6, low + 7)])
+        self.assertEqual(
+            tasks.plan_shards(models.URLMap.objects.all(), 1),
+            [(low, low + 7)])
+        self.assertEqual(
+            tasks.plan_shards(models.URLMap.objects.none(), 3), [])
+
+    def test_run_sharded(self):
+        result = tasks.run_sharded(
+            tasks.FixRedirectLoopsTask, tasks.redirect_urlmaps(),
+            job_id='sharded-job', shards=3, batch_size=1)
+        summary = {'shards': 3, 'fixed': 3, 'loops': []}
+        self.assertEqual(result.get(), summary)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlF.pk).redirect, self.urlA)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlG.pk).redirect, self.urlB)
+        self.assertEqual(
+            tasks.cache.get(tasks.job_key('sharded-job', 'summary')), summary)
+        self.assertEqual(LogEntry.objects.count(), 3)
+
+        # resuming a finished job redoes nothing, with the same shards
+        models.URLMap.objects.filter(pk=self.urlF.pk).update(
+            redirect=self.urlD)
+        result = tasks.run_sharded(
+            tasks.FixRedirectLoopsTask, tasks.redirect_urlmaps(),
+            job_id='sharded-job', shards=1)
+        self.assertEqual(result.get(), summary)
+        self.assertEqual(
+            models.URLMap.objects.get(pk=self.urlF.pk).redirect, self.urlD)
+
+    def test_run_sharded_reports_loops_once(self):
+        models.URLMap.objects.filter(pk=self.urlC.pk).update(
+            redirect=self.urlF)
+        result = tasks.run_sharded(
+            tasks.FixRedirectLoopsTask, tasks.redirect_urlmaps(), shards=5)
+        summary = result.get()
+        self.assertEqual(summary['fixed'], 1)
+        self.assertEqual(len(summary['loops']), 1)
+
+    def test_run_sharded_nothing_to_do(self):
+        result = tasks.run_sharded(
+            tasks.FixRedirectLoopsTask, models.URLMap.objects.none())
+        self.assertEqual(result.get(), {'shards': 0})
+
+    def test_summarize_job(self):
+        self.assertEqual(
+            tasks.SummarizeJobTask().run(
+                [{'fixed': 1, 'loops': [[1, 2]]},
+                 {'fixed': 2, 'loops': [[3]]}]),
+            {'shards': 2, 'fixed': 3, 'loops': [[1, 2], [3]]})
+
 
 class HasRedirectsToItListFilterTest(TestCase):
     def setUp(self):
@@ -1217,6 +3532,30 @@ class URLMapAdminFormTest(TestCase):
         self.assertEqual(instance, saved_obj)
 
 
+class ResolvesElsewhereTest(TestCase):
+    def test_resolves_elsewhere(self):
+        for path in ['/test_page/', '/admin/', '/admin/auth/user/']:
+            self.assertTrue(views.resolves_elsewhere(path), path)
+
+    def test_resolves_to_route(self):
+        # static urls come after route in the urlconf, so never resolve
+        for path in ['/test_page', '/fake_page/', '/admin/fake_page/',
+                     '/static/file/']:
+            self.assertFalse(views.resolves_elsewhere(path), path)
+
+    def test_like_resolve(self):
+        for path in ['/', '/test_page/', '/admin/', '/admin/auth/',
+                     '/admin/fake/', '/admin/auth/user/1/', '/fake/page/']:
+            self.assertEqual(views.resolves_elsewhere(path),
+                             resolve(path).func != views.route, path)
+
+    def test_compiled_once(self):
+        compiled = views.compile_urlconf()
+        self.assertIs(views.compile_urlconf(), compiled)
+        self.assertEqual(compiled[1][1], (compiled[1][1][0], True))
+        self.assertEqual(compiled[1][2], (compiled[1][2][0], False))
+
+
 class ShouldAppendSlashTest(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
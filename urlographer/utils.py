@@ -53,22 +53,38 @@ def canonicalize_path(path):
     #. Make ../ behave as expected by eliminating parent dirs from path
        (but without unintentionally exposing files, of course)
     #. Eliminate all unicode chars using :func:`force_ascii`
+
+    Runs in a single pass over the segments of the path, so in linear time.
+    A final . or .. segment, not followed by a slash, is left as is, and a
+    relative path is made absolute by ../ or a leading ./
     """
-    while '//' in path:
-        path = path.replace('//', '/')
-    if path.startswith('./'):
-        path = path[1:]
-    elif path.startswith('../'):
-        path = path[2:]
-    while '/./' in path:
-        path = path.replace('/./', '/')
-    while '/../' in path:
-        pre, post = path.split('/../', 1)
-        if pre.startswith('/') and '/' in pre[1:]:
-            pre = '/'.join(pre.split('/')[:-1])
-            path = '/'.join([pre, post])
+    if '//' not in path and '/.' not in path and not path.startswith('.'):
+        # no empty, . or .. segments
+        return force_ascii(path.lower())
+    segments = path.split('/')
+    # the last segment is kept as is, and empty after a trailing slash
+    last = segments.pop()
+    absolute = bool(segments) and not segments[0]
+    stack = []
+    for segment in filter(None, segments):
+        if segment == '.':
+            if not stack:
+                # a leading ./ makes a relative path absolute
+                absolute = True
+        elif segment == '..':
+            if absolute:
+                if stack:
+                    stack.pop()
+            else:
+                # ../ discards the segments of a relative path before it
+                del stack[:]
+                absolute = True
         else:
-            path = '/' + post
+            stack.append(segment)
+    stack.append(last)
+    path = '/'.join(stack)
+    if absolute:
+        path = '/' + path
     return force_ascii(path.lower())
 
 
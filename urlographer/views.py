@@ -12,17 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from functools import partial
+
 from django.conf import settings
 from django.contrib.sitemaps.views import sitemap as contrib_sitemap
 from django.contrib.sitemaps import GenericSitemap
 
 
 from django.core.cache import cache
-from django.core.exceptions import ImproperlyConfigured
-from django.core.urlresolvers import resolve
+from django.core.urlresolvers import (
+    RegexURLPattern, Resolver404, get_resolver, get_urlconf)
 from django.http import (
     Http404, HttpResponse, HttpResponseNotFound, HttpResponsePermanentRedirect,
     HttpResponseRedirect)
+from django.utils import six
+from django.utils.functional import SimpleLazyObject
 
 try:
     # Django => 1.9
@@ -36,16 +40,90 @@ try:
 except:
     newrelic = False
 
-from .models import URLMap
+from .caching import key_prefix, path_memo
+from .dispatch import compiled_views, handlers
+from .models import ContentMap, URLMap, URLRule
+from .records import URLRecord
+from .ruletree import rule_trees
 from .utils import (
-    canonicalize_path,
     force_cache_invalidation,
     get_redirect_url_with_query_string,
-    get_view,
     should_append_slash
 )
 
-settings.URLOGRAPHER_HANDLERS = getattr(settings, 'URLOGRAPHER_HANDLERS', {})
+# compiled urlconfs, by urlconf
+_compiled_urlconfs = {}
+
+
+def compile_urlconf(urlconf=None):
+    """
+    Returns the root resolver of urlconf (by default ROOT_URLCONF) and its
+    patterns, each as a (regex, target) pair, computed once per resolver.
+    The target is True for patterns mapped to another view than
+    :func:`route`, False for those mapped to route, and the pattern itself
+    for includes, which resolve the rest of the path. The regex is None for
+    translated patterns, which also resolve the path themselves.
+    """
+    resolver = get_resolver(urlconf)
+    compiled = _compiled_urlconfs.get(urlconf)
+    if compiled is None or compiled[0] is not resolver:
+        patterns = []
+        for pattern in resolver.url_patterns:
+            regex = None
+            if isinstance(getattr(pattern, '_regex', None), six.string_types):
+                regex = pattern.regex
+            if regex is not None and isinstance(pattern, RegexURLPattern):
+                patterns.append((regex, pattern.callback != route))
+            else:
+                patterns.append((regex, pattern))
+        compiled = _compiled_urlconfs[urlconf] = (resolver, patterns)
+    return compiled
+
+
+def resolves_elsewhere(path):
+    """
+    Returns whether path resolves to another view than :func:`route` in the
+    current urlconf, like ``resolve(path).func != route`` but only searching
+    the regexes compiled by :func:`compile_urlconf`, and resolving just the
+    includes they match.
+    """
+    resolver, patterns = compile_urlconf(get_urlconf())
+    match = resolver.regex.search(path)
+    if match is None:
+        return False
+    path = path[match.end():]
+    for regex, target in patterns:
+        if regex is not None and not regex.search(path):
+            continue
+        if target is True or target is False:
+            return target
+        try:
+            match = target.resolve(path)
+        except Resolver404:
+            continue
+        if match is not None:
+            return match.func != route
+    return False
+
+
+def url_rule_record(url, rule, suffix):
+    """
+    Returns the :class:`~urlographer.records.URLRecord` for a path matched by
+    a :class:`~urlographer.ruletree.RuleRecord`, given the record of the
+    404 for the path, or None if the rule's ContentMap is gone
+    """
+    record = URLRecord(
+        url.id, rule.status_code, url.force_secure, url.url,
+        content_map_id=rule.content_map_id)
+    if rule.status_code in (301, 302):
+        record.redirect_url = rule.redirect_url(suffix)
+    if rule.content_map_id:
+        content = ContentMap.objects.cached_get_many(
+            [rule.content_map_id]).get(rule.content_map_id)
+        if content is None:
+            return None
+        record.set_content(content)
+    return record
 
 
 def route(request):
@@ -53,15 +131,33 @@ def route(request):
     This view is intended to be mapped to '.*' in your root urlconf.
     It does the following:
 
-    #. Redirect to URL ending in / when appropriate
+    #. Redirect to URL ending in / when appropriate: when it resolves to
+       another view (see :func:`resolves_elsewhere`), or when there is no
+       URLMap for the path. The path ending in / is prefetched along with the
+       path, in the same cache get_many and db query (see
+       :meth:`~urlographer.models.URLMapManager.cached_get`), so the
+       redirected request finds its URLMap, or its absence, cached.
     #. Redirect to canonical path based on return value of
-       :func:`urlographer.utils.canonicalize_path`
+       :func:`urlographer.utils.canonicalize_path`, memoized along with the
+       hexdigest when
+       :attr:`~urlographer.caching.settings.URLOGRAPHER_PATH_MEMO_SIZE` is
+       set (see :class:`~urlographer.caching.PathMemo`)
     #. Use :meth:`~urlographer.models.URLMapManager.cached_get` to retrieve
-       a :class:`~urlographer.models.URLMap` that exactly matches the site and
-       path, if it exists
+       the :class:`~urlographer.records.URLRecord` of the
+       :class:`~urlographer.models.URLMap` that exactly matches the site and
+       path, if it exists. The record is set as request.urlrecord, and the
+       URLMap itself as request.urlmap, which is only fetched from the db,
+       along with its *site*, *content_map* and *redirect* in one query (see
+       :meth:`~urlographer.models.URLMapManager.for_records`), if it is
+       accessed.
+    #. If there is none, use the :class:`~urlographer.models.URLRule` of the
+       site best matching the path, if any, as if it were a URLMap (see
+       :mod:`urlographer.ruletree`). It is set as request.urlrule, and only
+       fetched from the db if it is accessed.
     #. If there is a matching :class:`~urlographer.models.URLMap` with a
        *status_code* of 200, create the response using the *view* and *options*
-       specified in its :class:`~urlographer.models.ContentMap`
+       specified in its :class:`~urlographer.models.ContentMap`, as compiled
+       by :data:`~urlographer.dispatch.compiled_views`
     #. Use django.http.HttpResponseRedirect for temporary redirects
     #. Use django.http.HttpResponsePermanentRedirect for permanent redirects
     #. Use HttpResponseNotFound for 404s
@@ -69,24 +165,41 @@ def route(request):
        the :class:`~urlographer.models.URLMap`'s *status_code*
     #. Finally, process the response through any handlers matching the
        response.status configured in
-       :attr:`~urlographer.views.settings.URLOGRAPHER_HANDLERS`.
+       :attr:`~urlographer.dispatch.settings.URLOGRAPHER_HANDLERS`, as
+       compiled at startup into :data:`~urlographer.dispatch.handlers`.
     """
     if settings.APPEND_SLASH and not request.path_info.endswith('/'):
-        # the code below only works if route is mapped to .*
-        with_slash = request.path_info + '/'
-        if resolve(with_slash)[0] != route:
-            return HttpResponsePermanentRedirect(with_slash)
-    canonicalized = canonicalize_path(request.path)
+        if resolves_elsewhere(request.path_info + '/'):
+            return HttpResponsePermanentRedirect(request.path_info + '/')
     site = get_current_site(request)
+    canonicalized, hexdigest = path_memo.get(site.id, request.path)
+    invalidate = force_cache_invalidation(request)
+    view_kwargs = {}
+    prefetch = None
+    if should_append_slash(request):
+        prefetch = request.path_info + '/'
     try:
         url = URLMap.objects.cached_get(
-            site, canonicalized,
-            force_cache_invalidation=force_cache_invalidation(request))
+            site, canonicalized, force_cache_invalidation=invalidate,
+            hexdigest=hexdigest, prefetch=prefetch)
     except URLMap.DoesNotExist:
-        url = URLMap(site=site, path=canonicalized, status_code=404,
-                     force_secure=False)
-
-    request.urlmap = url
+        request.urlmap = URLMap(site=site, path=canonicalized,
+                                status_code=404, force_secure=False)
+        url = URLRecord.from_urlmap(request.urlmap)
+        match = rule_trees.match(site.id, canonicalized)
+        if match:
+            rule, suffix = match
+            record = url_rule_record(url, rule, suffix)
+            if record is not None:
+                url = record
+                request.urlmap.status_code = url.status_code
+                request.urlrule = SimpleLazyObject(
+                    partial(URLRule.objects.get, pk=rule.id))
+                view_kwargs = rule.view_kwargs(suffix)
+    else:
+        request.urlmap = SimpleLazyObject(
+            partial(URLMap.objects.for_records().get, pk=url.id))
+    request.urlrecord = url
 
     if url.force_secure and not request.is_secure():
         url_to = get_redirect_url_with_query_string(request, unicode(url))
@@ -95,26 +208,17 @@ def route(request):
         if request.path != canonicalized:
             response = HttpResponsePermanentRedirect(unicode(url))
         else:
-            view = get_view(url.content_map.view)
-            options = url.content_map.options
-
+            view = compiled_views.get(url)
             if newrelic:
-                view_name = "{}:{}.{}".format(view.__module__,
-                                              view.__name__,
-                                              request.method.lower())
                 newrelic.agent.set_transaction_name(
-                    view_name, "Python/urlographer")
-
-            if hasattr(view, 'as_view'):
-                initkwargs = options.pop('initkwargs', {})
-                response = view.as_view(**initkwargs)(request, **options)
-            else:
-                response = view(request, **options)
+                    view.transaction_name(request.method),
+                    "Python/urlographer")
+            response = view(request, **view_kwargs)
 
     elif url.status_code == 301:
-        response = HttpResponsePermanentRedirect(unicode(url.redirect))
+        response = HttpResponsePermanentRedirect(url.redirect_url)
     elif url.status_code == 302:
-        response = HttpResponseRedirect(unicode(url.redirect))
+        response = HttpResponseRedirect(url.redirect_url)
     elif url.status_code == 404:
         if should_append_slash(request):
             response = HttpResponsePermanentRedirect(request.path_info + '/')
@@ -123,27 +227,12 @@ def route(request):
     else:
         response = HttpResponse(status=url.status_code)
 
-    handler = settings.URLOGRAPHER_HANDLERS.get(response.status_code, None)
+    handler = handlers.get(response.status_code)
     if handler:
-        if callable(handler) or hasattr(handler, 'as_view'):
-            view = handler
-        elif isinstance(handler, basestring):
-            view = get_view(handler)
-        else:
-            raise ImproperlyConfigured(
-                'URLOGRAPHER_HANDLERS values must be views or import strings')
-
         if newrelic:
-            view_name = "{}:{}.{}".format(view.__module__,
-                                          view.__name__,
-                                          request.method.lower())
             newrelic.agent.set_transaction_name(
-                view_name, "Python/urlographer")
-
-        if hasattr(view, 'as_view'):
-            response = view.as_view()(request, response)
-        else:
-            response = view(request, response)
+                handler.transaction_name(request.method), "Python/urlographer")
+        response = handler(request, response)
 
     elif response.status_code == 404:
         raise Http404
@@ -167,7 +256,7 @@ def sitemap(request, invalidate_cache=False):
     :class:`~urlographer.models.URLMap`\ s with a *status_code* of 200 for the
     current site.
 
-    Caches based on the site and the
+    Caches based on the site, its generation and the
     :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_PREFIX` with a
     timeout based on
     :attr:`~urlographer.models.settings.URLOGRAPHER_CACHE_TIMEOUT`.
@@ -176,7 +265,7 @@ def sitemap(request, invalidate_cache=False):
     """
 
     site = get_current_site(request)
-    cache_key = '%s%s_sitemap' % (settings.URLOGRAPHER_CACHE_PREFIX, site)
+    cache_key = '%s%s_sitemap' % (key_prefix(site.id), site)
     if not invalidate_cache and not force_cache_invalidation(request):
         cached = cache.get(cache_key)
         if cached: